@@ -0,0 +1,248 @@
+"""Groups output records and aggregates the values of each group.
+
+The output fields chosen as group keys identify each group. Every other
+field is combined with one of the aggregate functions:
+* sum - the total of the values (missing values are skipped, text is
+  converted to a number the way sqlite does, or counted as 0)
+* count - the number of records in the group
+* min, max - the smallest/largest value (missing values are skipped)
+* first - the value from the first record in the group
+
+When every field is a plain input field (or count), getsqlquery() creates a
+query that has sqlite do the grouping over the join. Otherwise records are
+added to an Aggregator one at a time. It keeps up to maxgroups groups in
+memory; past that, the partial results are written to temporary files split
+by the hash of their key, and each file is combined separately at the end.
+"""
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+import ast
+import cPickle
+import re
+import tempfile
+from collections import OrderedDict
+
+import exprcompiler
+
+# number of temporary files the groups are split between when they spill
+SPILLPARTITIONS = 16
+# the sqlite function for each aggregate that sqlite can calculate the same
+SQLFUNCTIONS = {'sum': 'SUM', 'min': 'MIN', 'max': 'MAX'}
+# types that are added as they are
+NUMBERTYPES = (int, long, float, bool)
+# the number at the start of text, which is what sqlite converts it to
+NUMBERPREFIX = re.compile(r'\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?')
+
+
+def _tonumber(value):
+    """Convert a value to a number like sqlite's SUM does.
+
+    Text of an integer is an int, otherwise the number the text starts with
+    is a float, or 0.0 if it doesn't start with one."""
+    if not isinstance(value, basestring):
+        # blobs
+        value = str(value)
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    match = NUMBERPREFIX.match(value)
+    if match is None:
+        return 0.0
+    return float(match.group())
+
+
+def _addvalues(total, value):
+    """Add a value to a total, skipping missing values."""
+    if value is None:
+        return total
+    if type(value) not in NUMBERTYPES:
+        value = _tonumber(value)
+    if total is None:
+        return value
+    return total + value
+
+
+def _minvalue(minimum, value):
+    """Keep the smaller value, skipping missing values."""
+    if minimum is None or (value is not None and value < minimum):
+        return value
+    return minimum
+
+
+def _maxvalue(maximum, value):
+    """Keep the larger value, skipping missing values."""
+    if maximum is None or (value is not None and value > maximum):
+        return value
+    return maximum
+
+
+# AGGREGATES[name] = (first value -> state,
+#                     (state, next value) -> state,
+#                     (state, later state) -> state)
+AGGREGATES = {'sum': (lambda value: _addvalues(None, value), _addvalues,
+                      _addvalues),
+              'count': (lambda value: 1, lambda count, value: count + 1,
+                        lambda count, latercount: count + latercount),
+              'min': (lambda value: value, _minvalue, _minvalue),
+              'max': (lambda value: value, _maxvalue, _maxvalue),
+              'first': (lambda value: value, lambda first, value: first,
+                        lambda first, laterfirst: first)}
+
+
+class AggregateError(Exception):
+    """The group keys or aggregate functions aren't valid."""
+    pass
+
+
+class Aggregator(object):
+    """Groups output records by key fields and aggregates the rest."""
+    def __init__(self, fieldnames, keyfields, aggregates, maxgroups=100000):
+        """fieldnames is the order of the values in each output record.
+
+        keyfields is the list of fields to group by. aggregates[fieldname]
+        is the aggregate function name for a field, fields that aren't in it
+        use 'first'."""
+        self.fieldnames = list(fieldnames)
+        self.keyindices = []
+        for keyfield in keyfields:
+            if keyfield not in self.fieldnames:
+                raise AggregateError('Group field ' + keyfield +
+                                     ' is not an output field.')
+            self.keyindices.append(self.fieldnames.index(keyfield))
+        # (field index, aggregate name) for each field that isn't a key
+        self.aggregates = []
+        for fieldindex in range(len(self.fieldnames)):
+            if fieldindex in self.keyindices:
+                continue
+            aggregate = aggregates.get(self.fieldnames[fieldindex], 'first')
+            if aggregate not in AGGREGATES:
+                raise AggregateError('Unknown aggregate function ' +
+                                     aggregate + ' for field ' +
+                                     self.fieldnames[fieldindex] + '.')
+            self.aggregates.append((fieldindex, aggregate))
+        self.startfuncs = [(fieldindex, AGGREGATES[aggregate][0])
+                           for fieldindex, aggregate in self.aggregates]
+        self.updatefuncs = [(fieldindex, AGGREGATES[aggregate][1])
+                            for fieldindex, aggregate in self.aggregates]
+        self.mergefuncs = [AGGREGATES[aggregate][2]
+                           for _fieldindex, aggregate in self.aggregates]
+        self.maxgroups = maxgroups
+        # groups[key values] = [state of each aggregate], in first-seen order
+        self.groups = OrderedDict()
+        # temporary files the groups are written to once there are too many
+        self.spillfiles = []
+
+    def getsqlquery(self, joinquery, outputbodies, inputblanks, sqlblanks):
+        """Create a query that aggregates the join query in sqlite.
+
+        outputbodies and inputblanks are from the Calculator, sqlblanks is the
+        blank values the join query fills in. Returns None if any field needs
+        to be calculated in python."""
+        selects = []
+        groupby = []
+        aggregates = dict(self.aggregates)
+        for fieldindex in range(len(self.fieldnames)):
+            tree, args = outputbodies[self.fieldnames[fieldindex]]
+            aggregate = aggregates.get(fieldindex)
+            if aggregate == 'count':
+                selects.append('COUNT(*)')
+                continue
+            # everything else has to be just an input field
+            if not (isinstance(tree, ast.Name) and
+                    exprcompiler.PLACEHOLDERPATTERN.match(tree.id)):
+                return None
+            sqlvalue = args[0]
+            # a blank value that only python fills in
+            if sqlvalue in inputblanks and sqlvalue not in sqlblanks:
+                return None
+            if fieldindex in self.keyindices:
+                selects.append(sqlvalue)
+                groupby.append(sqlvalue)
+            elif aggregate in SQLFUNCTIONS:
+                selects.append(SQLFUNCTIONS[aggregate] + '(' + sqlvalue + ')')
+            else:
+                return None
+        return ('SELECT ' + ', '.join(selects) + ' FROM (' + joinquery +
+                ') GROUP BY ' + ', '.join(groupby))
+
+    # needs to be speedy
+    def add(self, outputvalues):
+        """Add an output record to its group."""
+        key = tuple([outputvalues[i] for i in self.keyindices])
+        states = self.groups.get(key)
+        if states is None:
+            self.groups[key] = [start(outputvalues[fieldindex])
+                                for fieldindex, start in self.startfuncs]
+            if len(self.groups) > self.maxgroups:
+                self._spill()
+        else:
+            i = 0
+            for fieldindex, update in self.updatefuncs:
+                states[i] = update(states[i], outputvalues[fieldindex])
+                i += 1
+
+    def _spill(self):
+        """Write the groups in memory to the temporary files."""
+        if not self.spillfiles:
+            self.spillfiles = [tempfile.TemporaryFile()
+                               for _counter in range(SPILLPARTITIONS)]
+        for key in self.groups:
+            cPickle.dump((key, self.groups[key]),
+                         self.spillfiles[hash(key) % SPILLPARTITIONS], 2)
+        self.groups = OrderedDict()
+
+    def results(self):
+        """Generate the output record of each group, as a tuple."""
+        if not self.spillfiles:
+            for key in self.groups:
+                yield self._getrecord(key, self.groups[key])
+            return
+        self._spill()
+        for spillfile in self.spillfiles:
+            spillfile.seek(0)
+            # every record for a key is in the same file, in the order they
+            # were written, so they can be combined one file at a time
+            groups = OrderedDict()
+            while True:
+                try:
+                    key, states = cPickle.load(spillfile)
+                except EOFError:
+                    break
+                if key not in groups:
+                    groups[key] = states
+                else:
+                    groups[key] = [merge(state, laterstate)
+                                   for merge, state, laterstate
+                                   in zip(self.mergefuncs, groups[key],
+                                          states)]
+            for key in groups:
+                yield self._getrecord(key, groups[key])
+        self.close()
+
+    def _getrecord(self, key, states):
+        """Put the key values and aggregated values in field order."""
+        record = [None] * len(self.fieldnames)
+        for fieldindex, value in zip(self.keyindices, key):
+            record[fieldindex] = value
+        for (fieldindex, _aggregate), state in zip(self.aggregates, states):
+            record[fieldindex] = state
+        return tuple(record)
+
+    def close(self):
+        """Delete the temporary files."""
+        for spillfile in self.spillfiles:
+            spillfile.close()
+        self.spillfiles = []
@@ -31,6 +31,8 @@ import random
 import sqlite3
 import re
 import os
+import sys
+from xml.sax import saxutils
 
 import gui
 import filemanager
@@ -38,6 +40,8 @@ import joinmanager
 import outputmanager
 import optionsmanager
 import calculator
+import lookuptables
+import aggregator
 import table  # for NeedTableError
 
 # event handlers
@@ -66,9 +70,17 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
         self.outputs = outputmanager.OutputManager()
         self.options = optionsmanager.OptionsManager()
         self.calc = calculator.Calculator()
+        # lets expressions look values up in any loaded file
+        self.calc.lookuptables = lookuptables.LookupTables(self.files)
 
         # load options
         self.options.loadoptions()
+        # --profile turns on profiling for this session
+        if '--profile' in sys.argv[1:]:
+            self.options['profile_calculations'] = True
+        self.files.typesamplerows = self.options['excel_type_sample_rows']
+        self.files.confirmfieldtypes = self.options['excel_confirm_types']
+        self.files.schemasamplerows = self.options['jsonl_sample_rows']
 
         # fake threading helpers
         self.joinaborted = False
@@ -78,6 +90,8 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
 
         # records used for showing sample output
         self.samplerecords = []
+        # (filename, file type, table name) of the output, set by setoutputfile
+        self.outputpath = None
 
         # clear the sqlite database that's used to store all the data
         sqlitefile = open('temp.db', 'w')
@@ -107,8 +121,9 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
         # if the target is being replaced, parse the outputfilename to get type
         if self.gui['replacetargetcheckbox'].get_active():
             # use the extension from the filename, outputtypecombo is unused
-            outputfilename, outputfiletype = outputfilename.split('.')
-            outputfiletype = '.' + outputfiletype
+            fileextlen = len(self.files.getfileext(outputfilename))
+            outputfiletype = outputfilename[-fileextlen:]
+            outputfilename = outputfilename[:-fileextlen]
         else:
             # check if the location is specificed or just the filename
             if not re.search(r'\\\/', outputfilename):
@@ -151,6 +166,8 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
         if outputfile is None:
             return
         self.outputs.setoutputfile(outputfile)
+        # stored for creating additional output files of the same type
+        self.outputpath = (outputfilename, outputfiletype, outputtablename)
 
         # needs to go before replacecolumns so that the types will be right
         fieldtypes = outputfile.getfieldtypes()
@@ -171,6 +188,47 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
             blankvalue = outputfile.getblankvalue(outputfield)
             self.calc.setblankvalue(outputfield, blankvalue)
 
+    def shardoutput(self):
+        """Replace the output file with a set of files of the same type."""
+        outputfilename, outputfiletype, outputtablename = self.outputpath
+        keyfield = self.options['shard_key_field']
+        if keyfield:
+            if keyfield not in self.outputs:
+                self.gui.messagedialog('Shard key field ' + keyfield +
+                                       ' is not an output field.')
+                return None
+            # output records are keyed by the exact field name
+            keyfield = self.outputs[keyfield].name
+        else:
+            keyfield = None
+
+        def openshard(shardname):
+            """Open an output file for one shard of the output."""
+            return self.files.openoutputfile(outputfilename + '_' + shardname,
+                                             outputfiletype, outputtablename)
+
+        def findshards():
+            """Get the names of the shards written by an earlier output."""
+            # the first extension is used if the type has several
+            fileext = outputfiletype.split(',')[0].strip()
+            outputdir = os.path.dirname(outputfilename) or '.'
+            prefix = os.path.basename(outputfilename) + '_'
+            shardnames = []
+            for filename in sorted(os.listdir(outputdir)):
+                if (filename.startswith(prefix) and
+                        filename.lower().endswith(fileext.lower())):
+                    shardname = filename[len(prefix):-len(fileext)]
+                    if re.match(r'[a-zA-Z0-9_\-]+$', shardname):
+                        shardnames.append(shardname)
+            return shardnames
+
+        return self.outputs.shardoutput(openshard,
+                                        self.options['shard_max_records'],
+                                        self.options['shard_max_bytes'],
+                                        keyfield,
+                                        self.options['shard_max_open'],
+                                        findshards)
+
     def abortoutput(self, _widget, _data=None):
         """Set a signal for the output to abort."""
         self.joinaborted = True
@@ -181,6 +239,34 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
         if len(self.outputs) == 0:
             return
 
+        # check the expressions before creating any output
+        self.calc.clear()
+        # the lookup tables may have changed since the last join
+        self.calc.lookuptables.clear()
+        self.calc.profiling = self.options['profile_calculations']
+        for field in self.outputs:
+            self.calc.createoutputfunc(field)
+        if self.calc.compileerrors:
+            self.showcompileerrors()
+            return
+        # output fields to index, if the output format supports it
+        indexfields = []
+        for indexfield in self.options['output_index_fields'].split(','):
+            indexfield = indexfield.strip()
+            if not indexfield:
+                continue
+            if indexfield not in self.outputs:
+                self.gui.messagedialog('Index field ' + indexfield +
+                                       ' is not an output field.')
+                return
+            indexfields.append(self.outputs[indexfield].name)
+        # group the output records, if configured
+        outputaggregator = None
+        if self.options['group_by_fields']:
+            outputaggregator = self.createaggregator()
+            if outputaggregator is None:
+                return
+
         # if the target is being replaced, rename it as a backup
         if self.gui['replacetargetcheckbox'].get_active():
             if self.gui['backupcheckbox'].get_active():
@@ -190,6 +276,13 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
         # call this to set the filename for the output
         self.setoutputfile(None)
         outputfile = self.outputs.outputfile
+        # split the output across several files, if configured
+        if (self.options['shard_max_records'] or
+                self.options['shard_max_bytes'] or
+                self.options['shard_key_field']):
+            outputfile = self.shardoutput()
+            if outputfile is None:
+                return
 
         # create fields
         outputfields = [self.outputs[fn] for fn in self.outputs.outputorder]
@@ -202,10 +295,10 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
                 outputfile.setfields(outputfields, overwrite=True)
             else:
                 return
-
-        self.calc.clear()
-        for field in self.outputs:
-            self.calc.createoutputfunc(field)
+        # the formats that can be indexed create them when they're closed
+        if hasattr(outputfile, 'addindex'):
+            for indexfield in indexfields:
+                outputfile.addindex(indexfield)
 
         stopbutton = self.gui['stopoutputbutton']
         stopbutton.set_sensitive(True)
@@ -214,14 +307,38 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
         restrictjoins = self.gui['restrictjoincheckbox'].get_active()
 
         # sqlite setup
-        joinquery = self.joins.getquery(restrictjoins=restrictjoins)
+        # have sqlite fill in the blank values for missed joins, if it can
+        sqlblanks = self.joins.getsqlblanks(self.calc.inputblanks)
+        joinquery = self.joins.getquery(restrictjoins=restrictjoins,
+                                        blanks=sqlblanks)
         # print joinquery
         # open the database
         conn = sqlite3.connect('temp.db')
-        conn.row_factory = sqlite3.Row
         cur = conn.cursor()
         # query for the joined input values
         cur.execute(joinquery)
+        # input rows are plain tuples, so the calculator needs the positions
+        self.calc.compileoutput([column[0] for column in cur.description],
+                                vectorize=self.options['vectorize_output'],
+                                sqlblanks=sqlblanks)
+        if self.calc.compileerrors:
+            stopbutton.set_sensitive(False)
+            outputfile.close()
+            self.showcompileerrors()
+            return
+        # have sqlite do the grouping, if it can
+        if outputaggregator is not None and not restrictjoins:
+            aggregatequery = outputaggregator.getsqlquery(
+                joinquery, self.calc.outputbodies, self.calc.inputblanks,
+                sqlblanks)
+            if aggregatequery is not None:
+                self.gui.setprogress(0, 'Grouping records')
+                cur.execute(aggregatequery)
+                outputfile.addrows(cur)
+                outputfile.close()
+                print 'processing complete'
+                self.gui.setprogress(1, 'Output complete')
+                return
         # restrict one-to-many joins from creating extra records
         # the ROWID of the target table with joins is checked against the
         # ROWID of the target without joins, to detect extra records.
@@ -230,6 +347,10 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
             rcur = conn.cursor()
             rcur.execute(self.joins.getrestrictionquery())
 
+        self.calc.resetcachestats()
+        self.calc.errors = calculator.ErrorCollector(
+            self.options['error_examples'], self.options['error_limit'])
+
         # loop through target file
         i = 0
         recordcount = self.joins.getrecordcount()
@@ -255,9 +376,12 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
                 self.gui.setprogress(0, 'Output aborted')
                 stopbutton.set_sensitive(False)
                 outputfile.close()
+                if outputaggregator is not None:
+                    outputaggregator.close()
                 return
 
             # process however many records before updating progress
+            inputrows = []
             for _counter in range(i, min(i + 1000, recordcount)):
                 # inputvalues[filealias_fieldname] = value
                 inputvalues = cur.fetchone()
@@ -267,27 +391,90 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
                     # end of file reached, the current and remaining records
                     # in the main query must be duplicates
                     if checkvalue is None:
+                        i = recordcount
                         break
                     # if the values don't match, this is an extra record
-                    while (inputvalues['restrictjoins'] !=
-                           checkvalue['restrictjoins']):
+                    # restrictjoins is the last column of the join query
+                    while inputvalues[-1] != checkvalue[0]:
                         # keep fetching until it matches
                         # XXX could optionally prompt user for choice
                         inputvalues = cur.fetchone()
                         i = i + 1
-                newrec = {}
-                outputvalues = self.calc.calculateoutput(inputvalues)
-                for fieldname, fieldvalue in outputvalues:
-                    newrec[fieldname] = fieldvalue
-
-                outputfile.addrecord(newrec)
+                inputrows.append(inputvalues)
 
                 i = i + 1
+            # the whole chunk is calculated at once, so it can be vectorized
+            try:
+                outputrows = self.calc.calculatebatch(inputrows)
+            except calculator.TooManyErrors as error:
+                self.gui.setprogress(0, 'Output aborted, ' + str(error))
+                stopbutton.set_sensitive(False)
+                outputfile.close()
+                if outputaggregator is not None:
+                    outputaggregator.close()
+                self.showcalculationerrors()
+                return
+            if outputaggregator is not None:
+                for outputvalues in outputrows:
+                    outputaggregator.add(outputvalues)
+            else:
+                # output values are in the same order as the output fields
+                outputfile.addrows(outputrows)
 
+        if outputaggregator is not None:
+            outputfile.addrows(outputaggregator.results())
         outputfile.close()
         print 'processing complete'
+        if self.calc.errors.errorcount:
+            self.showcalculationerrors()
+        if self.calc.profiler is not None:
+            print self.calc.profiler.getreport()
+        cachereport = self.calc.getcachereport()
+        if cachereport:
+            print 'Memoized functions:'
+            print cachereport
         self.gui.setprogress(1, 'Output complete')
 
+    def createaggregator(self):
+        """Create an Aggregator for the configured group fields."""
+        # output records are keyed by the exact field names
+        keyfields = []
+        for keyfield in self.options['group_by_fields'].split(','):
+            keyfield = keyfield.strip()
+            if keyfield not in self.outputs:
+                self.gui.messagedialog('Group field ' + keyfield +
+                                       ' is not an output field.')
+                return None
+            keyfields.append(self.outputs[keyfield].name)
+        aggregates = {}
+        aggregatefunctions = self.options['aggregate_functions']
+        for fieldname in aggregatefunctions:
+            if fieldname in self.outputs:
+                aggregates[self.outputs[fieldname].name] = \
+                    aggregatefunctions[fieldname].lower()
+        try:
+            return aggregator.Aggregator(self.calc.outputbodies.keys(),
+                                         keyfields, aggregates,
+                                         self.options['aggregate_max_groups'])
+        except aggregator.AggregateError as error:
+            self.gui.messagedialog(str(error))
+            return None
+
+    def showcompileerrors(self):
+        """Show the errors found in the output field expressions."""
+        report = self.calc.getcompilereport()
+        print report
+        self.gui.messagedialog('Invalid output field values:\n' +
+                               saxutils.escape(report))
+
+    def showcalculationerrors(self):
+        """Show a summary of the errors from calculating output values."""
+        print 'Errors calculating output values:'
+        print self.calc.errors.getreport()
+        self.gui.messagedialog('%d output values could not be calculated, '
+                               'see the console for details.' %
+                               self.calc.errors.errorcount)
+
     def updatesample(self, refreshrecords=None, samplesize=10):
         """Update the sample of output records"""
         if len(self.outputs) == 0:
@@ -301,6 +488,7 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
                                 sampleoutputfields)
 
         self.calc.clear()
+        self.calc.profiling = self.options['profile_calculations']
         for fieldname in sampleoutputfields:
             self.calc.createoutputfunc(self.outputs[fieldname])
 
@@ -327,12 +515,20 @@ class AveryDB(GUI_Files, GUI_JoinConfig, GUI_FieldToolbar, GUI_FieldView,
                 cur.execute(joinquery)
                 self.samplerecords = cur.fetchall()
 
+        if self.samplerecords:
+            self.calc.compileoutput(self.samplerecords[0].keys())
+        # the errors are also shown in the sample values
+        if self.calc.compileerrors:
+            print self.calc.getcompilereport()
         for inputvalues in self.samplerecords:
-            outputrecord = []
-            outputvalues = self.calc.calculateoutput(inputvalues)
-            for _fieldname, fieldvalue in outputvalues:
-                outputrecord.append(fieldvalue)
-            self.gui['sampleoutputlist'].append(outputrecord)
+            outputrecord = self.calc.calculaterecord(inputvalues)
+            self.gui['sampleoutputlist'].append(list(outputrecord))
+        if self.calc.errors.errorcount:
+            print 'Errors calculating sample output values:'
+            print self.calc.errors.getreport()
+        if self.calc.profiler is not None:
+            print 'Sample output profile:'
+            print self.calc.profiler.getreport()
 
     @classmethod
     def timetostring(cls, inputtime):
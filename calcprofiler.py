@@ -0,0 +1,141 @@
+"""Measures where the calculator spends its time.
+
+When profiling is turned on, the calculator times each output field
+separately, and wraps each library function an expression uses so its calls
+are counted and timed. getreport() lists the fields and functions by the
+share of the total calculation time they took.
+"""
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+import types
+from collections import OrderedDict
+from timeit import default_timer
+
+
+class Profiler(object):
+    """Collects call counts and times for output fields and functions."""
+    def __init__(self):
+        # fieldstats[fieldname] = [calls, seconds]
+        self.fieldstats = OrderedDict()
+        # funcstats['module.funcname'] = [calls, seconds]
+        self.funcstats = OrderedDict()
+        # wrappers[id(function)] = ProfiledFunction
+        self.wrappers = {}
+        # time spent calculating output records, including everything else
+        self.totaltime = 0.0
+
+    def timecall(self, func, *args):
+        """Call a function and add its time to the total."""
+        starttime = default_timer()
+        try:
+            return func(*args)
+        finally:
+            self.totaltime += default_timer() - starttime
+
+    def addfieldtime(self, fieldname, calls, seconds):
+        """Add calls to an output field that were timed elsewhere."""
+        stats = self.fieldstats.setdefault(fieldname, [0, 0.0])
+        stats[0] += calls
+        stats[1] += seconds
+
+    def profilerecord(self, fieldnames, fieldfuncs):
+        """Create a record function that times each field separately."""
+        fields = [(self.fieldstats.setdefault(fieldname, [0, 0.0]), fieldfunc)
+                  for fieldname, fieldfunc in zip(fieldnames, fieldfuncs)]
+
+        def profiledrecord(inputrow):
+            """Calculate the output values for a row, timing each field."""
+            outputvalues = []
+            for stats, fieldfunc in fields:
+                starttime = default_timer()
+                try:
+                    outputvalues.append(fieldfunc(inputrow))
+                finally:
+                    stats[0] += 1
+                    stats[1] += default_timer() - starttime
+            return tuple(outputvalues)
+        return profiledrecord
+
+    def wrapfunc(self, value):
+        """Wrap a library function so its calls are timed.
+
+        Anything that isn't a function is returned as it is. Classes are left
+        alone too, since they're also used for isinstance()."""
+        if (not callable(value) or
+                isinstance(value, (type, types.ClassType, types.ModuleType))):
+            return value
+        if id(value) not in self.wrappers:
+            funcname = self._getfuncname(value)
+            self.wrappers[id(value)] = ProfiledFunction(
+                value, self.funcstats.setdefault(funcname, [0, 0.0]))
+        return self.wrappers[id(value)]
+
+    @classmethod
+    def _getfuncname(cls, func):
+        """Get the name a function is called by, like streets.fullname."""
+        # calctools.BatchFunction.callrow counts as the batch function
+        func = getattr(func, 'im_self', None) or func
+        modulename = getattr(func, '__module__', None) or '__builtin__'
+        # fieldcalcs libraries are imported as fieldcalcs.libname
+        modulename = modulename.split('.')[-1]
+        if modulename == '__builtin__':
+            modulename = 'builtins'
+        return modulename + '.' + getattr(func, '__name__',
+                                          type(func).__name__)
+
+    def getreport(self):
+        """Describe the time taken by each field and function."""
+        reportlines = ['Total calculation time: %.3fs' % self.totaltime]
+        for title, allstats in [('Output fields:', self.fieldstats),
+                                ('Library functions:', self.funcstats)]:
+            reportlines.append(title)
+            # slowest first
+            for name in sorted(allstats, key=lambda name: -allstats[name][1]):
+                calls, seconds = allstats[name]
+                if not calls:
+                    continue
+                share = 0
+                if self.totaltime:
+                    share = 100.0 * seconds / self.totaltime
+                reportlines.append('    %s: %d calls, %.3fs total, '
+                                   '%.1fus mean (%.1f%%)' %
+                                   (name, calls, seconds,
+                                    seconds / calls * 1000000, share))
+        return '\n'.join(reportlines)
+
+
+class ProfiledFunction(object):
+    """Wraps a library function to count its calls and their time."""
+    def __init__(self, func, stats):
+        self.func = func
+        # [calls, seconds], shared by functions with the same name
+        self.stats = stats
+
+    def __call__(self, *args, **kwargs):
+        starttime = default_timer()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.stats[0] += 1
+            self.stats[1] += default_timer() - starttime
+
+    def callrow(self, *args, **kwargs):
+        """Call a calctools.BatchFunction for a single record."""
+        starttime = default_timer()
+        try:
+            return self.func.callrow(*args, **kwargs)
+        finally:
+            self.stats[0] += 1
+            self.stats[1] += default_timer() - starttime
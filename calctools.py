@@ -0,0 +1,157 @@
+"""Tools for writing functions in the fieldcalcs libraries.
+
+memoize - decorator that caches the results of an expensive function:
+
+    from calctools import memoize
+
+    @memoize(maxsize=10000)
+    def streetname(rawname):
+        ...
+
+The function is then only run once for each distinct set of arguments,
+including keyword arguments, as long as the argument values are hashable.
+Arguments of different types are different, even if they're equal, like 1,
+1.0 and True. The least recently used results are dropped when the cache is
+full. Hit and miss counts for every memoized function are printed after each
+output run.
+
+batchfunction - decorator for a function that calculates many records at once:
+
+    from calctools import batchfunction
+
+    @batchfunction
+    def parcelowners(propids):
+        lookup = loadownerfile()
+        return [lookup.get(propid) for propid in propids]
+
+Each argument is a list of values, one per record, and the function returns a
+list of results in the same order. The calculator calls it once for each
+chunk of records, so setup like loading a file only happens once per chunk.
+When it's used somewhere that has to be calculated one record at a time, like
+in a lambda or one branch of 'x if y else z', it's called with single-item
+lists.
+"""
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+from collections import OrderedDict
+
+# memoizedfuncs['module.funcname'] = MemoizedFunction
+# reloading a library replaces its entries
+MEMOIZEDFUNCS = OrderedDict()
+
+
+def memoize(maxsize=1024):
+    """Decorator that caches up to maxsize results of a function."""
+    def decorator(func):
+        return MemoizedFunction(func, maxsize)
+    return decorator
+
+
+class MemoizedFunction(object):
+    """Wraps a function with a least recently used cache of its results."""
+    def __init__(self, func, maxsize):
+        self.func = func
+        self.maxsize = maxsize
+        # cache[args] = result, least recently used first
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # look like the original function in the calculator window
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        self.__module__ = func.__module__
+        # fieldcalcs libraries are imported as fieldcalcs.libname
+        modulename = func.__module__.split('.')[-1]
+        MEMOIZEDFUNCS[modulename + '.' + func.__name__] = self
+
+    # needs to be speedy
+    def __call__(self, *args, **kwargs):
+        cache = self.cache
+        # 1, 1.0 and True are equal, so the types are part of the key
+        if kwargs:
+            names = sorted(kwargs)
+            values = args + tuple([kwargs[name] for name in names])
+            key = (values, tuple(names), tuple(map(type, values)))
+        else:
+            key = args + tuple(map(type, args))
+        try:
+            # move it to the end, as the most recently used
+            result = cache.pop(key)
+        except KeyError:
+            self.misses += 1
+            result = self.func(*args, **kwargs)
+            if len(cache) >= self.maxsize:
+                cache.popitem(last=False)
+        # unhashable arguments can't be cached
+        except TypeError:
+            return self.func(*args, **kwargs)
+        else:
+            self.hits += 1
+        cache[key] = result
+        return result
+
+    def clear(self):
+        """Empty the cache and reset the statistics."""
+        self.cache = OrderedDict()
+        self.resetstats()
+
+    def resetstats(self):
+        """Reset the hit and miss counts."""
+        self.hits = 0
+        self.misses = 0
+
+
+def batchfunction(func):
+    """Decorator for a function that takes lists of values for many records."""
+    return BatchFunction(func)
+
+
+class BatchFunction(object):
+    """Wraps a function that calculates a list of records at once."""
+    def __init__(self, func):
+        self.func = func
+        # look like the original function in the calculator window
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        self.__module__ = func.__module__
+
+    def __call__(self, *argcolumns):
+        return self.func(*argcolumns)
+
+    def callrow(self, *args, **kwargs):
+        """Calculate the result for a single record."""
+        for key in kwargs:
+            kwargs[key] = [kwargs[key]]
+        return self.func(*[[arg] for arg in args], **kwargs)[0]
+
+
+def getcachestats():
+    """Return (funcname, hits, misses, cachesize) for memoized functions.
+
+    Functions that haven't been called since the stats were reset are
+    skipped."""
+    stats = []
+    for funcname in MEMOIZEDFUNCS:
+        memofunc = MEMOIZEDFUNCS[funcname]
+        if memofunc.hits or memofunc.misses:
+            stats.append((funcname, memofunc.hits, memofunc.misses,
+                          len(memofunc.cache)))
+    return stats
+
+
+def resetcachestats():
+    """Reset the hit and miss counts of all memoized functions."""
+    for funcname in MEMOIZEDFUNCS:
+        MEMOIZEDFUNCS[funcname].resetstats()
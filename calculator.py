@@ -3,7 +3,8 @@
 This class serves two purposes:
 * Calculates the output values for each field
 ** Call createoutputfunc(field) for each output field
-** Call calculateoutput(inputvalues) to get all output values
+** Call compileoutput(inputnames) once and then calculaterecord(inputrow)
+   to get all output values as a tuple
 * Creates and edits custom functions that can be used for calculating output
 """
 ##
@@ -20,28 +21,134 @@ This class serves two purposes:
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 ##
+import __builtin__
+import ast
+import copy
 import re
 import os
 import sys
 import traceback
 from collections import OrderedDict
+from timeit import default_timer
+
+import calcprofiler
+import calctools
+import exprcompiler
+import exproptimizer
+# numpy is optional, it's only used to vectorize calculations
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # libraries to preload and list in the calculator dialog
 # XXX needs a menu setting to edit it. in place or make a config file?
 DEFAULT_LIBRARIES = ['default', 'temporary', 'math']
+# parts of an expression that numpy can calculate the same way python does
+VECTOR_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Num, ast.Load,
+                ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+                ast.UAdd, ast.USub)
+
+
+class TooManyErrors(Exception):
+    """More output values failed to calculate than the error limit allows."""
+    pass
+
+
+class ErrorCollector(object):
+    """Counts the errors in user code while calculating output values.
+
+    Errors are counted per output field and exception type. The traceback and
+    input values are kept for the first few of each, instead of printing every
+    one as it happens."""
+    def __init__(self, maxexamples=3, maxerrors=0):
+        # number of examples to keep of each field/exception type
+        self.maxexamples = maxexamples
+        # raise TooManyErrors after this many errors, 0 for no limit
+        self.maxerrors = maxerrors
+        # counts[(fieldname, exception type name)] = number of errors
+        self.counts = OrderedDict()
+        # examples[(fieldname, exception type name)] = [(inputs, traceback)]
+        self.examples = {}
+        self.errorcount = 0
+
+    def clear(self):
+        """Forget the errors collected so far."""
+        self.counts = OrderedDict()
+        self.examples = {}
+        self.errorcount = 0
+
+    def adderror(self, fieldname, inputvalues):
+        """Record the exception being handled for an output field.
+
+        inputvalues is a function that returns the input values the field
+        used, it's only called for the errors that are kept as examples."""
+        errortype = sys.exc_info()[0]
+        key = (fieldname, getattr(errortype, '__name__', str(errortype)))
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.errorcount += 1
+        examples = self.examples.setdefault(key, [])
+        if len(examples) < self.maxexamples:
+            examples.append((inputvalues(), traceback.format_exc()))
+        if self.maxerrors and self.errorcount >= self.maxerrors:
+            raise TooManyErrors('%d errors calculating output values' %
+                                self.errorcount)
+
+    def getreport(self):
+        """Describe the errors, with the examples of each."""
+        reportlines = []
+        for key in self.counts:
+            fieldname, errorname = key
+            reportlines.append('%s: %d x %s' % (fieldname, self.counts[key],
+                                                errorname))
+            for inputvalues, tracebacktext in self.examples[key]:
+                reportlines.append('    input values: %r' % inputvalues)
+                reportlines.extend(['    ' + line for line in
+                                    tracebacktext.rstrip().split('\n')])
+        return '\n'.join(reportlines)
 
 
 class Calculator(object):
     """This class creates custom functions for each of the output fields."""
     def __init__(self):
-        self.outputfuncs = OrderedDict()
+        # outputbodies[fieldname] = (expression tree, args), used by
+        # compileoutput
+        self.outputbodies = OrderedDict()
+        # compileerrors[fieldname] = message for an expression that's invalid
+        self.compileerrors = OrderedDict()
+        # library functions and values used by the expressions, by bound name
+        self.bindings = {}
+        self.namebinder = exprcompiler.NameBinder(self._resolvename,
+                                                  self.bindings)
+        # whole record function and per field functions from compileoutput
+        self.recordfunc = None
+        self.fieldfuncs = []
+        # fields calculated by numpy, and the rest, used by calculatebatch
+        self.vectorfields = OrderedDict()
+        self.rowfields = []
+        self.rowfieldsfunc = None
+        self.compiledfields = []
+        # (argument func, batch function, name) for each batch function call
+        self.batchcalls = []
+        # errors from calculating the output values
+        self.errors = ErrorCollector()
+        # set to time the fields and functions, compileoutput creates profiler
+        self.profiling = False
+        self.profiler = None
         self.inputblanks = {}
+        # uppercase names of the input fields the join query fills blanks in
+        self.sqlblanks = set()
+        # lookuptables.LookupTables that lookup() in expressions uses
+        self.lookuptables = None
         self.moremodules = {}
         # list of all the modules the user can edit
         self.custommodules = []
-        # stores text of libraries to detect changes
-        # this allows an external editor to be used to make changes
-        self.libtext = {}
+        # libstats[libname] = (modification time, size) of the file when it
+        # was imported, to detect changes. this allows an external editor to
+        # be used to make changes
+        self.libstats = {}
+        # libraries checked for changes since the output was last compiled
+        self.checkedlibs = set()
 
         # reset the file for storing temporary functions. resetting when the
         # program starts means the functions will remain available in case
@@ -55,49 +162,92 @@ class Calculator(object):
         # load all the libraries set to load by default
         for libname in DEFAULT_LIBRARIES:
             self._importlib(libname)
-        self.moremodules['builtins'] = __builtins__
+        self.moremodules['builtins'] = __builtin__
 
-        # import everything from the fieldcalcs directory
+        # list everything in the fieldcalcs directory, each library is
+        # imported the first time it's used
         customfuncs = os.listdir('fieldcalcs')
         for funcname in customfuncs:
             if funcname.endswith('.py'):
-                name = funcname.split('.')[0]
-                if self._importlib(name):
-                    self.libtext[name] = self._getlibtext(name)
-                    self.custommodules.append(name)
+                self.custommodules.append(funcname.split('.')[0])
 
     def clear(self):
         """Clear the list of dynamically generated output functions."""
-        self.outputfuncs = OrderedDict()
+        self.outputbodies = OrderedDict()
+        self.compileerrors = OrderedDict()
+        self.bindings = {}
+        self.namebinder = exprcompiler.NameBinder(self._resolvename,
+                                                  self.bindings)
+        self.checkedlibs = set()
+        self.recordfunc = None
+        self.fieldfuncs = []
+        self.vectorfields = OrderedDict()
+        self.rowfields = []
+        self.rowfieldsfunc = None
+        self.compiledfields = []
+        self.batchcalls = []
+        self.errors = ErrorCollector()
+        self.profiler = None
 
     def _importlib(self, libname):
-        """Import a library for the calculator to use."""
+        """Import a library for the calculator to use.
+
+        Libraries in fieldcalcs are reloaded if their file's size or
+        modification time has changed. Each is checked once per compile."""
         libname = libname.strip()
         if libname is '':
             return
-        if libname not in self.moremodules:
-            try:
-                # try this way in case it's a python library module
-                self.moremodules[libname] = __import__(libname)
-            except ImportError:
-                # check if it's a file in fieldcalcs
-                if self._getlibtext(libname) is not None:
+        if libname in self.moremodules:
+            if libname in self.libstats and libname not in self.checkedlibs:
+                self.checkedlibs.add(libname)
+                libstat = self._getlibstat(libname)
+                if libstat is not None and libstat != self.libstats[libname]:
+                    # reload the module so the new functions can be used
                     try:
-                        self.moremodules[libname] = __import__('fieldcalcs.' +
-                                                               libname,
-                                                               globals(),
-                                                               locals(),
-                                                               [libname])
+                        self.moremodules[libname] = reload(
+                            self.moremodules[libname])
                     except:
                         print "Exception in user code:"
                         print '-'*60
                         traceback.print_exc(file=sys.stdout)
                         print '-'*60
                         return False
-                else:
-                    return False
+                    self.libstats[libname] = libstat
+            return True
+        try:
+            # try this way in case it's a python library module
+            self.moremodules[libname] = __import__(libname)
+        except ImportError:
+            # check if it's a file in fieldcalcs
+            libstat = self._getlibstat(libname)
+            if libstat is None:
+                return False
+            try:
+                self.moremodules[libname] = __import__('fieldcalcs.' +
+                                                       libname,
+                                                       globals(),
+                                                       locals(),
+                                                       [libname])
+            except:
+                print "Exception in user code:"
+                print '-'*60
+                traceback.print_exc(file=sys.stdout)
+                print '-'*60
+                return False
+            self.libstats[libname] = libstat
+            self.checkedlibs.add(libname)
         return True
 
+    @classmethod
+    def _getlibstat(cls, libname):
+        """Get the (modification time, size) of a fieldcalcs library file."""
+        try:
+            libstat = os.stat(os.path.join('fieldcalcs', libname + '.py'))
+        except OSError:
+            # not a fieldcalcs module
+            return None
+        return (libstat.st_mtime, libstat.st_size)
+
     def createlib(self, libname):
         """Create a new library file in the fieldcalcs directory."""
         if libname not in self.moremodules:
@@ -109,8 +259,10 @@ class Calculator(object):
                 self.custommodules.append(libname)
 
     def getlibs(self):
-        """Get a list of all libraries currently imported for field calcs."""
-        return self.moremodules
+        """Get a list of all libraries available for field calcs."""
+        return list(self.moremodules) + [libname for libname
+                                         in self.custommodules
+                                         if libname not in self.moremodules]
 
     def getcustomlibs(self):
         """Get a list of all the custom libraries."""
@@ -120,11 +272,11 @@ class Calculator(object):
         """Get the names of all public functions in a library."""
         if libname is '':
             return
-        if libname not in self.moremodules:
-            if self._importlib(libname) == False:
-                return []
         # check if file has been updated and reload it
-        self._getlibtext(libname)
+        self.checkedlibs.discard(libname)
+        if not self._importlib(libname):
+            if libname not in self.moremodules:
+                return []
         libfuncs = []
         # get a list of all the names defined in the function
         names = dir(self.moremodules[libname])
@@ -132,8 +284,10 @@ class Calculator(object):
             libobject = getattr(self.moremodules[libname], name)
             # filter out other modules that were imported
             if callable(libobject):
-                # filter out private methods:
-                if not name.startswith('_'):
+                # filter out private methods, and calctools imported for
+                # writing the functions
+                if (not name.startswith('_') and
+                        getattr(libobject, '__module__', None) != 'calctools'):
                     # return a tuple of the function name and docstring
                     libfuncs.append((name, libobject.__doc__))
         return libfuncs
@@ -181,34 +335,16 @@ class Calculator(object):
         return (funcstart, funcend)
 
     # this is only used for custom functions defined in a fieldcalcs module
-    def _getlibtext(self, libname):
+    @classmethod
+    def _getlibtext(cls, libname):
         """Returns the text of a python library file as a list of lines."""
-        os.chdir('fieldcalcs')
         try:
-            libfile = open(libname + '.py', 'r')
+            libfile = open(os.path.join('fieldcalcs', libname + '.py'), 'r')
         except IOError:
             # not a fieldcalcs module
-            os.chdir('..')
             return None
-        os.chdir('..')
         libtext = libfile.readlines()
         libfile.close()
-        if libname not in self.libtext:
-            self.libtext[libname] = libtext
-        elif self.libtext[libname] != libtext:
-            # reload the module so the new function can be used
-            # this could cause interesting sequences of events when called
-            # from writefunctext, hopefully only if the user does unusual
-            # things like adding a broken function then saving
-            try:
-                self.moremodules[libname] = reload(self.moremodules[libname])
-                self.libtext[libname] = libtext
-            except:
-                print "Exception in user code:"
-                print '-'*60
-                traceback.print_exc(file=sys.stdout)
-                print '-'*60
-                return None
         return libtext
 
     def codeisvalid(self, codeblock):
@@ -262,15 +398,18 @@ class Calculator(object):
             libfile.close()
             os.chdir('..')
             # reload the module so the new function can be used
-            self.moremodules[libname] = reload(self.moremodules[libname])
+            if libname in self.moremodules:
+                self.moremodules[libname] = reload(self.moremodules[libname])
+                self.libstats[libname] = self._getlibstat(libname)
+            else:
+                self._importlib(libname)
 
     # Doesn't need to be speedy, but the function it creates does
-    # Not a lot of room for optimizing, that I can imagine
     def createoutputfunc(self, field):
-        """Converts an expression to a single function call.
+        """Parses an expression and looks up the functions it uses.
 
-        Converts field['value'] to a function that can be quickly executed
-        during output.
+        The expression is compiled together with the rest of the fields by
+        compileoutput().
 
         The field value can contain several types of arguments:
         * constant values: 8. 'cat', [0, 1, 2, 3]
@@ -282,109 +421,522 @@ class Calculator(object):
         (fullname function is defined in streets.py)
 
         The only novel syntax is for input field values.
-        The function assumes the user has written everything correctly.
+        Syntax errors and names that can't be found are stored in
+        compileerrors, and the field's value becomes an error message.
         """
-        newfuncname = field['name']
-        newfuncbody = field['value']
-        argpos = 0
-        # Convert all !filealias.fieldname! to usable argument references
-        args = re.findall(r'![a-zA-Z0-9_]+\.[a-zA-Z0-9_]+!', newfuncbody)
-        for arg in args:
-            internalname = 'args[' + str(argpos) + ']'
-            argpos += 1
-            newfuncbody = re.sub(arg, internalname, newfuncbody)
-
-        # Convert all the function calls to callable references
-        funcs = re.findall(r'([a-zA-Z]+[a-zA-Z0-9\._]*)\(', newfuncbody)
-        for funcname in funcs:
-            components = funcname.split('.')
-            # A single word is either a builtin, default, or temporary function
-            if len(components) == 1:
-                # first check if it's a temporary function
-                # this means temp functions will overrule default functions
-                # defaults or builtins can still be used by writing
-                # default.func or builtins.func
-                if components[0] in dir(self.moremodules['temporary']):
-                    # prepend 'temporary.' to the function name
-                    newfuncbody = re.sub(funcname,
-                                         'self.moremodules["temporary"].' +
-                                         funcname, newfuncbody)
-                # then check if it's in default
-                elif components[0] in dir(self.moremodules['default']):
-                    # prepend 'default.' to the function name
-                    newfuncbody = re.sub(funcname,
-                                         'self.moremodules["default"].' +
-                                         funcname, newfuncbody)
-                # otherwise assume it's a builtin and leave it alone
-                # XXX should check builtins and do something if it isn't there
-            else:
-                # if it has a module name, make sure the module is imported
-                module = components[0]
-                self._importlib(module)
-                if module in self.moremodules:
-                    # replace the module name with a reference to the locally
-                    # imported module
-                    newmodule = 'self.moremodules["' + module + '"]'
-                    newfuncbody = re.sub(module, newmodule, newfuncbody)
-
-        # define the new function to wrap the expression
-        # prepend func_ to avoid name conflicts
-        newfuncstr = 'def func_' + newfuncname + '(self, args):\n'
-        newfuncstr = newfuncstr + '    return ' + newfuncbody
-
-        # create the function and return it with the list of args it needs
-        tempcontext = {}
-        exec(newfuncstr) in tempcontext
-        for i in range(len(args)):
-            # trim the leading and trailing '!'s and replace '.' with '_'
-            # cast to str in case it's unicode. sqlite3.Row uses ascii keys
-            # and the dictionary of input values is an sqlite3.Row
-            args[i] = str(re.sub(r'\.', '_', args[i][1:-1]))
-        self.outputfuncs[newfuncname] = (tempcontext['func_' + newfuncname],
-                                         args)
+        fieldname = field['name']
+        try:
+            tree, args = exprcompiler.parseexpression(field['value'])
+            tree = self._bindlookups(self.namebinder.bind(tree))
+        except (SyntaxError, exprcompiler.CompileError) as error:
+            tree, args = self._geterrortree(fieldname, error), []
+        self.outputbodies[fieldname] = (tree, args)
 
-    # needs to be speedy
-    # inputvalues is an sqlite3.Row, which is like a dict but
-    # doesn't support 'in'
-    def calculateoutput(self, inputvalues):
-        """Takes all the input records and computes the output record.
-
-        Each of the output functions created by createoutputfunc() is called
-        using inputvalues."""
-        outputvalues = []
-        for outputfieldname in self.outputfuncs:
-            outputfunc, args = self.outputfuncs[outputfieldname]
-            argvalues = []
-            outputvalue = None
+    def _resolvename(self, name):
+        """Get the object a name in an expression refers to."""
+        # temporary functions overrule default functions, which overrule
+        # builtins. the others can still be used by writing default.func or
+        # builtins.func
+        for libname in ['temporary', 'default', 'builtins']:
+            # this also reloads the library if its file has changed
+            if (self._importlib(libname) and
+                    hasattr(self.moremodules[libname], name)):
+                return getattr(self.moremodules[libname], name)
+        if name == 'lookup' and self.lookuptables is not None:
+            return self.lookuptables.lookup
+        # otherwise it should be a library, make sure it's imported
+        if self._importlib(name):
+            return self.moremodules[name]
+        raise exprcompiler.CompileError('unknown name ' + name)
+
+    def _bindlookups(self, tree):
+        """Replace lookups in constant tables with the table's get method.
+
+        lookup('table', 'keyfield', 'valuefield', key) becomes get(key),
+        where get is bound to the loaded table."""
+        if self.lookuptables is None:
+            return tree
+        for node in ast.walk(tree):
+            if not (isinstance(node, ast.Call) and
+                    isinstance(node.func, ast.Name) and
+                    self.bindings.get(node.func.id) ==
+                    self.lookuptables.lookup):
+                continue
+            tableargs = node.args[:3]
+            if (len(node.args) not in (4, 5) or node.keywords or
+                    node.starargs or node.kwargs or
+                    not all([isinstance(arg, ast.Str) for arg in tableargs])):
+                # it has to look up the table for each record
+                continue
+            try:
+                table = self.lookuptables.gettable(*[arg.s for arg
+                                                     in tableargs])
+            except KeyError as error:
+                raise exprcompiler.CompileError(error.args[0])
+            node.func = self.namebinder.bindvalue(table.get, node.func)
+            node.args = node.args[3:]
+        return tree
+
+    def _geterrortree(self, fieldname, error):
+        """Record an error in a field's expression and get a tree for it."""
+        self.compileerrors[fieldname] = str(error)
+        return ast.Str(s='##ERROR: ' + str(error) + '##')
+
+    def getcompilereport(self):
+        """Describe the errors found in the output expressions."""
+        return '\n'.join([fieldname + ': ' + self.compileerrors[fieldname]
+                          for fieldname in self.compileerrors])
+
+    # Doesn't need to be speedy, but the function it creates does
+    def compileoutput(self, inputnames, vectorize=False, sqlblanks=()):
+        """Combine all the output expressions into a single function.
+
+        inputnames is the list of input field names (filealias_fieldname) in
+        the order they appear in each input row. The generated function takes
+        an input row as a tuple and returns the tuple of output values, with
+        the argument positions and blank values for missed joins inlined.
+        Library functions are bound to it as closure variables.
+
+        Input fields that aren't in inputnames are added to compileerrors.
+
+        sqlblanks is the names of the input fields that the query already
+        replaced null values of with their blank values, which then aren't
+        checked for each record.
+
+        If vectorize is set and numpy is available, expressions that are pure
+        arithmetic on input fields are evaluated on whole columns at a time
+        by calculatebatch()."""
+        self.sqlblanks = set(inputname.upper() for inputname in sqlblanks)
+        # input names are case-insensitive, like sqlite3.Row
+        inputpositions = {}
+        for inputpos in range(len(inputnames)):
+            inputpositions[str(inputnames[inputpos]).upper()] = inputpos
+        # (expression tree, {inputpos: arg}) for each output field
+        self.compiledfields = []
+        for fieldname in self.outputbodies:
+            tree, args = self.outputbodies[fieldname]
+            fieldargs = {}
             for arg in args:
-                # arg might not be a valid name of an input field
-                try:
-                    argvalue = inputvalues[arg]
-                # this should only be thrown when calculating sample output
-                # and the error should be spotted and fixed before full output
-                except IndexError:
-                    outputvalue = '##BAD ARG: ' + arg + '##'
+                if arg.upper() not in inputpositions:
+                    error = exprcompiler.CompileError('unknown input field ' +
+                                                      arg)
+                    tree = self._geterrortree(fieldname, error)
+                    fieldargs = {}
                     break
-                if argvalue is not None:
-                    argvalues.append(argvalue)
+                fieldargs[inputpositions[arg.upper()]] = arg
+            else:
+                # refer to each argument by its position in the input row
+                tree = exprcompiler.renameinputs(
+                    copy.deepcopy(tree),
+                    ['in%d' % inputpositions[arg.upper()] for arg in args])
+            self.compiledfields.append((tree, fieldargs))
+
+        # values that can't be written as a literal are bound to the functions
+        context = dict(self.bindings)
+        funcdefs = self._compilebatchcalls(len(inputnames), context)
+        # the per field functions are used to find which field failed
+        for fieldindex in range(len(self.compiledfields)):
+            funcdefs.append(self._createfunc('calculatefield%d' % fieldindex,
+                                             [self.compiledfields[fieldindex]],
+                                             context, astuple=False))
+        allfields = range(len(self.compiledfields))
+        funcdefs.append(self._createfunc('calculaterecord',
+                                         self.compiledfields, context))
+
+        # find the fields that can be calculated a column at a time
+        self.vectorfields = OrderedDict()
+        if vectorize and numpy is not None:
+            for fieldindex in allfields:
+                tree, fieldargs = self.compiledfields[fieldindex]
+                if fieldargs and self._isvectorizable(tree):
+                    expression = ast.fix_missing_locations(
+                        ast.Expression(body=copy.deepcopy(tree)))
+                    self.vectorfields[fieldindex] = compile(expression,
+                                                            '<vector>',
+                                                            'eval')
+        # and a record function for the rest of them
+        self.rowfields = [fieldindex for fieldindex in allfields
+                          if fieldindex not in self.vectorfields]
+        funcdefs.append(self._createfunc('calculaterowfields',
+                                         [self.compiledfields[fieldindex]
+                                          for fieldindex in self.rowfields],
+                                         context))
+
+        if self.profiling:
+            # time the library functions by wrapping them
+            self.profiler = calcprofiler.Profiler()
+            for name in context:
+                context[name] = self.profiler.wrapfunc(context[name])
+            self.batchcalls = [(self.profiler.wrapfunc(batchfunc), name)
+                               for batchfunc, name in self.batchcalls]
+        else:
+            self.profiler = None
+        funcs = self._bindfuncs(funcdefs, context)
+        self.batchcalls = [(funcs['batchargs%d' % i], batchfunc, name)
+                           for i, (batchfunc, name) in
+                           enumerate(self.batchcalls)]
+        self.recordfunc = funcs['calculaterecord']
+        self.rowfieldsfunc = funcs['calculaterowfields']
+        self.fieldfuncs = [funcs['calculatefield%d' % i] for i in allfields]
+        if self.profiler is not None:
+            # time each field separately
+            fieldnames = self.outputbodies.keys()
+            self.recordfunc = self.profiler.profilerecord(fieldnames,
+                                                          self.fieldfuncs)
+            self.rowfieldsfunc = self.profiler.profilerecord(
+                [fieldnames[i] for i in self.rowfields],
+                [self.fieldfuncs[i] for i in self.rowfields])
+
+    def _compilebatchcalls(self, firstpos, context):
+        """Take calls to batch functions out of the compiled fields.
+
+        The results of each call are added to the end of the input rows, at
+        firstpos onwards. Returns the definitions of the functions that get
+        the arguments for each call from an input row."""
+        # argnames[inputpos] = name of the input field, for its blank value
+        argnames = {}
+        for fieldargs in [field[1] for field in self.compiledfields]:
+            argnames.update(fieldargs)
+        extractor = exproptimizer.BatchCallExtractor(self._isbatchcall,
+                                                     firstpos)
+        self.compiledfields = [(extractor.visit(tree), fieldargs)
+                               for tree, fieldargs in self.compiledfields]
+        self.batchcalls = []
+        funcdefs = []
+        for inputpos, callnode in extractor.calls:
+            argnames[inputpos] = 'batch%d' % len(self.batchcalls)
+            argfields = [(argtree, self._getfieldargs(argtree, argnames))
+                         for argtree in callnode.args]
+            funcdefs.append(self._createfunc(
+                'batchargs%d' % len(self.batchcalls), argfields, context))
+            batchfunc = self.bindings[callnode.func.id]
+            self.batchcalls.append((batchfunc, batchfunc.__name__ + '()'))
+        self.compiledfields = [(tree, self._getfieldargs(tree, argnames))
+                               for tree, _fieldargs in self.compiledfields]
+        # calls that have to be made one row at a time
+        for tree in [field[0] for field in self.compiledfields] + funcdefs:
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Call) and self._isbatchcall(node):
+                    node.func = self.namebinder.bindvalue(
+                        self.bindings[node.func.id].callrow, node.func)
+        context.update(self.bindings)
+        return funcdefs
+
+    def _isbatchcall(self, node):
+        """Check if a call node calls a batch function."""
+        return (isinstance(node.func, ast.Name) and
+                isinstance(self.bindings.get(node.func.id),
+                           calctools.BatchFunction))
+
+    def _ispurecall(self, node):
+        """Check if a call node calls a function that has no side effects."""
+        if not isinstance(node.func, ast.Name):
+            return False
+        func = self.bindings.get(node.func.id)
+        if isinstance(func, calctools.MemoizedFunction):
+            return True
+        try:
+            return func in exproptimizer.PUREFUNCTIONS
+        # unhashable objects
+        except TypeError:
+            return False
+
+    @classmethod
+    def _getfieldargs(cls, tree, argnames):
+        """Get {inputpos: argname} for the inputs an expression uses."""
+        fieldargs = {}
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                match = re.match(r'in(\d+)$', node.id)
+                if match:
+                    inputpos = int(match.group(1))
+                    fieldargs[inputpos] = argnames[inputpos]
+        return fieldargs
+
+    @classmethod
+    def _bindfuncs(cls, funcdefs, context):
+        """Compile function definitions as closures over the context values.
+
+        Closure variables are faster to look up than globals. Returns a dict
+        of the functions by name."""
+        # def bindfuncs(context):
+        #     name = context['name'] ...
+        #     def funcname(row): ...
+        #     return {'funcname': funcname, ...}
+        binder = ast.parse('def bindfuncs(context):\n' +
+                           ''.join(['    %s = context[%r]\n' % (name, name)
+                                    for name in sorted(context)
+                                    # added by eval() in the constant folder
+                                    if name != '__builtins__']) +
+                           '    pass\n').body[0]
+        binder.body.pop()
+        binder.body.extend(funcdefs)
+        funcnames = [funcdef.name for funcdef in funcdefs]
+        binder.body.append(ast.Return(value=ast.Dict(
+            keys=[ast.Str(s=funcname) for funcname in funcnames],
+            values=[ast.Name(id=funcname, ctx=ast.Load())
+                    for funcname in funcnames])))
+        module = ast.fix_missing_locations(ast.Module(body=[binder]))
+        namespace = {}
+        exec(compile(module, '<output fields>', 'exec')) in namespace
+        return namespace['bindfuncs'](context)
+
+    def _createfunc(self, funcname, fields, context, astuple=True):
+        """Create a function definition that calculates output fields.
+
+        fields is a list of (expression tree, {inputpos: arg}).
+
+        The expressions of all the fields are optimized together: constant
+        parts are calculated now, and parts that are repeated are calculated
+        once per record."""
+        recordargs = {}
+        trees = []
+        for tree, fieldargs in fields:
+            recordargs.update(fieldargs)
+            # the optimizer changes the tree, and it's used by several funcs
+            tree = copy.deepcopy(tree)
+            trees.append(exproptimizer.foldconstants(tree, context))
+        assignments, trees = exproptimizer.hoistcommon(trees,
+                                                       self._ispurecall)
+        # load the arguments, then calculate the common sub-expressions
+        funcdef = ast.parse('def ' + funcname + '(row):\n' +
+                            self._getargstatements(recordargs, context) +
+                            '    pass\n').body[0]
+        funcdef.body.pop()
+        for name, node in assignments:
+            funcdef.body.append(ast.Assign(
+                targets=[ast.Name(id=name, ctx=ast.Store())], value=node))
+        if astuple:
+            returnvalue = ast.Tuple(elts=trees, ctx=ast.Load())
+        else:
+            returnvalue = trees[0]
+        funcdef.body.append(ast.Return(value=returnvalue))
+        return funcdef
+
+    @classmethod
+    def _isvectorizable(cls, tree):
+        """Check if an expression is only arithmetic on input fields."""
+        for node in ast.walk(ast.Expression(body=tree)):
+            if isinstance(node, ast.Name):
+                if not re.match(r'in\d+$', node.id):
+                    return False
+            elif not isinstance(node, VECTOR_NODES):
+                return False
+        return True
+
+    def _getargstatements(self, args, context):
+        """Create the statements that load arguments from an input row."""
+        statements = []
+        for inputpos in sorted(args):
+            argname = 'in%d' % inputpos
+            statements.append('    %s = row[%d]\n' % (argname, inputpos))
+            if (args[inputpos] in self.inputblanks and
+                    args[inputpos].upper() not in self.sqlblanks):
+                blankvalue = self.inputblanks[args[inputpos]]
+                # nan and inf don't have literals, so they're bound like
+                # any other object
+                if (type(blankvalue) in (str, unicode, int, long, bool) or
+                        (type(blankvalue) is float and
+                         blankvalue - blankvalue == 0)):
+                    blankstr = repr(blankvalue)
                 else:
-                    # Missed join for this record, pass a blank default value
-                    argvalues.append(self.inputblanks[arg])
-            if outputvalue is None:
+                    blankstr = 'blank%d' % inputpos
+                    context[blankstr] = blankvalue
+                # Missed join for this record, use a blank default value
+                statements.append('    if %s is None:\n' % argname +
+                                  '        %s = %s\n' % (argname, blankstr))
+        return ''.join(statements)
+
+    # needs to be speedy
+    def calculatebatch(self, inputrows):
+        """Compute the output values for a list of input rows.
+
+        Returns a list of output tuples. Fields selected by compileoutput()
+        for vectorizing are calculated a column at a time using numpy."""
+        if self.profiler is not None:
+            return self.profiler.timecall(self._calculatebatch, inputrows)
+        return self._calculatebatch(inputrows)
+
+    # needs to be speedy
+    def _calculatebatch(self, inputrows):
+        """Compute the output values for a list of input rows."""
+        if not inputrows:
+            return []
+        if self.batchcalls:
+            inputrows = self._addbatchvalues(inputrows)
+        if not self.vectorfields:
+            return [self._calculaterecord(inputrow) for inputrow in inputrows]
+        outputcolumns = [None] * len(self.compiledfields)
+        # calculate the rest of the fields first, a row at a time
+        if self.rowfields:
+            rowcolumns = zip(*[self.calculaterowfields(inputrow)
+                               for inputrow in inputrows])
+            for i in range(len(self.rowfields)):
+                outputcolumns[self.rowfields[i]] = rowcolumns[i]
+        inputcolumns = {}
+        for fieldindex in self.vectorfields:
+            starttime = default_timer()
+            outputcolumn = self._calculatecolumn(fieldindex, inputrows,
+                                                 inputcolumns)
+            if outputcolumn is None:
+                # fall back to calculating the field one row at a time
+                outputcolumn = [self._calculatefield(fieldindex, inputrow)
+                                for inputrow in inputrows]
+            outputcolumns[fieldindex] = outputcolumn
+            if self.profiler is not None:
+                fieldname = self.outputbodies.keys()[fieldindex]
+                self.profiler.addfieldtime(fieldname, len(inputrows),
+                                           default_timer() - starttime)
+        return zip(*outputcolumns)
+
+    def calculaterowfields(self, inputrow):
+        """Compute the output values for the fields that aren't vectorized."""
+        try:
+            return self.rowfieldsfunc(inputrow)
+        except Exception:
+            return tuple([self._calculatefield(i, inputrow)
+                          for i in self.rowfields])
+
+    def _calculatecolumn(self, fieldindex, inputrows, inputcolumns):
+        """Calculate one output field for all the input rows using numpy.
+
+        Returns None if the values can't be calculated as an array without
+        changing the result."""
+        fieldargs = self.compiledfields[fieldindex][1]
+        arrays = {}
+        for inputpos in fieldargs:
+            if inputpos not in inputcolumns:
+                inputcolumns[inputpos] = self._getinputcolumn(
+                    inputpos, fieldargs[inputpos], inputrows)
+            if inputcolumns[inputpos] is None:
+                return None
+            arrays['in%d' % inputpos] = inputcolumns[inputpos]
+        try:
+            # anything python would raise an exception for, numpy needs to
+            with numpy.errstate(all='raise'):
+                outputarray = eval(self.vectorfields[fieldindex], {}, arrays)
+                if outputarray.dtype.kind in 'iu':
+                    # integers wrap around instead of overflowing to long,
+                    # check against the same calculation with floats
+                    floatarrays = {}
+                    for argname in arrays:
+                        floatarrays[argname] = arrays[argname].astype(float)
+                    floatarray = eval(self.vectorfields[fieldindex], {},
+                                      floatarrays)
+                    if (numpy.abs(outputarray - floatarray) >
+                            numpy.abs(floatarray) * 1e-9 + 1).any():
+                        return None
+        except (FloatingPointError, ZeroDivisionError, OverflowError):
+            return None
+        return outputarray.tolist()
+
+    def _getinputcolumn(self, inputpos, arg, inputrows):
+        """Get the values of an input field as a numpy array, if possible."""
+        inputcolumn = [inputrow[inputpos] for inputrow in inputrows]
+        if None in inputcolumn:
+            # Missed join for some records, use a blank default value
+            blankvalue = self.inputblanks.get(arg)
+            inputcolumn = [blankvalue if value is None else value
+                           for value in inputcolumn]
+        # mixed types (like int and float) would be calculated differently
+        if len(set(map(type, inputcolumn))) != 1:
+            return None
+        inputarray = numpy.array(inputcolumn)
+        if inputarray.dtype.kind not in 'iuf':
+            return None
+        return inputarray
+
+    # needs to be speedy
+    def calculaterecord(self, inputrow):
+        """Compute the output values for an input row, as a tuple.
+
+        compileoutput() must be called first."""
+        if self.profiler is not None:
+            return self.profiler.timecall(self._calculatebatch, [inputrow])[0]
+        if self.batchcalls:
+            inputrow = self._addbatchvalues([inputrow])[0]
+        return self._calculaterecord(inputrow)
+
+    # needs to be speedy
+    def _calculaterecord(self, inputrow):
+        """Compute the output values for an input row with batch values."""
+        try:
+            return self.recordfunc(inputrow)
+        except Exception:
+            # calculate each field separately to find the one(s) that failed
+            return tuple([self._calculatefield(i, inputrow)
+                          for i in range(len(self.fieldfuncs))])
+
+    def _addbatchvalues(self, inputrows):
+        """Add the results of each batch function call to the input rows."""
+        inputrows = [tuple(inputrow) for inputrow in inputrows]
+        for argfunc, batchfunc, name in self.batchcalls:
+            # None for the rows where an argument failed to calculate
+            rowargs = []
+            for inputrow in inputrows:
                 try:
-                    outputvalue = outputfunc(self, argvalues)
-                except:
-                    # This will be shown in the sample output. Should be enough
-                    # feedback on when something is not working so '##ERROR##'
-                    # won't get written to [m]any output files
-                    print "Exception in user code:"
-                    print '-'*60
-                    traceback.print_exc(file=sys.stdout)
-                    print '-'*60
-                    outputvalue = '##ERROR##'
-
-            outputvalues.append((outputfieldname, outputvalue))
-        return outputvalues
+                    rowargs.append(argfunc(inputrow))
+                except Exception:
+                    self.errors.adderror(name, lambda: inputrow)
+                    rowargs.append(None)
+            results = iter(self._callbatch(batchfunc, name,
+                                           [args for args in rowargs
+                                            if args is not None]))
+            inputrows = [inputrow + ((results.next() if args is not None
+                                      else '##ERROR##'),)
+                         for inputrow, args in zip(inputrows, rowargs)]
+        return inputrows
+
+    def _callbatch(self, batchfunc, name, rowargs):
+        """Call a batch function with the arguments for a list of rows."""
+        if not rowargs:
+            return []
+        try:
+            results = list(batchfunc(*[list(argcolumn)
+                                       for argcolumn in zip(*rowargs)]))
+            if len(results) == len(rowargs):
+                return results
+        except Exception:
+            pass
+        # call it one row at a time to find the one(s) that failed
+        results = []
+        for args in rowargs:
+            try:
+                results.append(batchfunc.callrow(*args))
+            except Exception:
+                self.errors.adderror(name, lambda: args)
+                results.append('##ERROR##')
+        return results
+
+    def _calculatefield(self, fieldindex, inputrow):
+        """Calculate a single output value, handling errors in user code."""
+        try:
+            return self.fieldfuncs[fieldindex](inputrow)
+        except Exception:
+            fieldargs = self.compiledfields[fieldindex][1]
+            self.errors.adderror(self.outputbodies.keys()[fieldindex],
+                                 lambda: dict([(fieldargs[inputpos],
+                                                inputrow[inputpos])
+                                               for inputpos in fieldargs]))
+            # This will be shown in the sample output, and the errors are
+            # summarized after the output is written
+            return '##ERROR##'
+
+    @classmethod
+    def resetcachestats(cls):
+        """Reset the hit/miss counts of memoized library functions."""
+        calctools.resetcachestats()
+
+    @classmethod
+    def getcachereport(cls):
+        """Describe how well the memoized library functions' caches did."""
+        reportlines = []
+        for funcname, hits, misses, cachesize in calctools.getcachestats():
+            hitrate = 100.0 * hits / (hits + misses)
+            reportlines.append('%s: %d hits, %d misses (%.1f%% hit rate), '
+                               '%d results cached' %
+                               (funcname, hits, misses, hitrate, cachesize))
+        return '\n'.join(reportlines)
 
     # doesn't need to be speedy
     def setblankvalue(self, field, value):
@@ -0,0 +1,134 @@
+"""Parses output field expressions into syntax trees for the calculator.
+
+An expression is ordinary python, except for references to input fields,
+which are written as !filealias.fieldname!. parseexpression() replaces those
+with placeholder names and parses the result. NameBinder then looks up every
+other name the expression uses, once, so that:
+* library functions and values are passed to the compiled output function
+  directly, instead of being looked up in their module for each record
+* names that don't exist are reported before any records are processed
+
+renameinputs() replaces the placeholders, once the position of each input
+field in the input rows is known.
+"""
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+import ast
+import re
+import types
+
+from exproptimizer import CONSTANT_NAMES
+
+# string literals are matched too, so field references inside them are skipped
+INPUTPATTERN = re.compile(r'''("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')|''' +
+                          r'!([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)!')
+PLACEHOLDERPATTERN = re.compile(r'__input(\d+)__$')
+
+
+class CompileError(Exception):
+    """An expression refers to something that doesn't exist."""
+    pass
+
+
+def parseexpression(expression):
+    """Parse an expression that may contain !filealias.fieldname! references.
+
+    Returns the expression tree and the list of input field names
+    (filealias_fieldname) it uses. Each input field is referred to in the tree
+    by the name __inputN__, where N is its index in the list."""
+    args = []
+
+    def replaceinput(match):
+        """Replace a field reference with its placeholder name."""
+        if match.group(1) is not None:
+            return match.group(1)
+        # cast to str in case it's unicode, input rows use ascii names
+        arg = str(match.group(2) + '_' + match.group(3))
+        if arg not in args:
+            args.append(arg)
+        return '__input%d__' % args.index(arg)
+    expression = INPUTPATTERN.sub(replaceinput, expression)
+    # the newline ends any comment at the end of the expression
+    tree = ast.parse('(' + expression + '\n)', mode='eval').body
+    return tree, args
+
+
+def renameinputs(tree, names):
+    """Replace the placeholder for each input field with names[index]."""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            match = PLACEHOLDERPATTERN.match(node.id)
+            if match:
+                node.id = names[int(match.group(1))]
+    return tree
+
+
+class NameBinder(ast.NodeTransformer):
+    """Replaces the names in expressions with the objects they refer to.
+
+    resolve(name) returns the object a name refers to, or raises CompileError.
+    Each object is stored in bindings under a new name, like bound0, which
+    replaces it in the tree. Attributes of modules are looked up as well, so
+    math.sqrt is bound as the sqrt function."""
+    def __init__(self, resolve, bindings, prefix='bound'):
+        self.resolve = resolve
+        self.bindings = bindings
+        self.prefix = prefix
+        # boundnames[id(object)] = name it is bound to
+        self.boundnames = {}
+        # names assigned within the expression, eg. lambda arguments
+        self.localnames = set()
+
+    def bind(self, tree):
+        """Bind all the names an expression uses."""
+        self.localnames = set(node.id for node in ast.walk(tree)
+                              if isinstance(node, ast.Name) and
+                              not isinstance(node.ctx, ast.Load))
+        return self.visit(tree)
+
+    def visit_Name(self, node):
+        if (node.id in self.localnames or node.id in CONSTANT_NAMES or
+                PLACEHOLDERPATTERN.match(node.id)):
+            return node
+        return self.bindvalue(self.resolve(node.id), node)
+
+    def visit_Attribute(self, node):
+        node.value = self.visit(node.value)
+        if not isinstance(node.ctx, ast.Load):
+            return node
+        module = self._getboundvalue(node.value)
+        if not isinstance(module, types.ModuleType):
+            return node
+        try:
+            value = getattr(module, node.attr)
+        except AttributeError:
+            raise CompileError(module.__name__ + ' has no attribute ' +
+                               node.attr)
+        return self.bindvalue(value, node)
+
+    def _getboundvalue(self, node):
+        """Get the object a node was bound to, if it's a bound name."""
+        if isinstance(node, ast.Name) and node.id in self.bindings:
+            return self.bindings[node.id]
+        return None
+
+    def bindvalue(self, value, node):
+        """Get a name node that refers to an object."""
+        if id(value) not in self.boundnames:
+            name = self.prefix + str(len(self.boundnames))
+            self.boundnames[id(value)] = name
+            self.bindings[name] = value
+        return ast.copy_location(ast.Name(id=self.boundnames[id(value)],
+                                          ctx=ast.Load()), node)
@@ -0,0 +1,226 @@
+"""Optimizes the output expressions of all fields together.
+
+The calculator combines the expressions for every output field into a single
+function. Before that function is compiled:
+* foldconstants() calculates the parts of an expression that don't depend on
+  the input, so they're calculated once per run instead of once per record
+* hoistcommon() finds sub-expressions that are repeated, in one field or
+  across several fields, and has them calculated once per record
+* BatchCallExtractor takes calls to batch functions (see calctools) out of
+  the expressions, so they can be calculated for a chunk of records at once
+
+Function calls are only shared when the function is known to have no side
+effects and to return the same result for the same arguments: memoized
+functions (see calctools) and the functions in PUREFUNCTIONS. Any other call
+is made every time it appears, since it could return a new list or a random
+number, or count something.
+"""
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+import ast
+import math
+
+# operations that can be calculated ahead of time if their operands are
+# constant. Lists, dicts and sets are left alone because they can be modified.
+FOLDABLE_NODES = (ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.Tuple)
+# names that are always constant
+CONSTANT_NAMES = ('True', 'False', 'None')
+# expressions worth calculating once when they are repeated. calls are only
+# hoisted if they're pure
+HOISTABLE_NODES = (ast.Call, ast.BinOp, ast.Compare, ast.Subscript)
+# built-in functions with no side effects, that return immutable values
+PUREFUNCTIONS = frozenset(
+    [abs, bool, chr, cmp, divmod, float, hex, int, len, long, max, min, oct,
+     ord, pow, repr, round, str, unichr, unicode] +
+    [getattr(math, name) for name in dir(math)
+     if callable(getattr(math, name))])
+
+
+def foldconstants(tree, context):
+    """Replace constant parts of an expression tree with their values.
+
+    Values that can't be written as a literal are stored in context, which
+    must be the global namespace the expression is run in."""
+    return ConstantFolder(context).visit(tree)
+
+
+def hoistcommon(trees, ispurecall=None, prefix='common'):
+    """Find sub-expressions that occur more than once in a list of trees.
+
+    ispurecall(node) checks if a call node calls a function that has no side
+    effects. Sub-expressions with any other calls aren't hoisted, and without
+    ispurecall no calls are.
+
+    Returns the list of (name, expression) assignments that need to be run
+    first, in order, and the trees with those sub-expressions replaced by
+    their names."""
+    hoister = CommonHoister(prefix, ispurecall)
+    for tree in trees:
+        hoister.visit(tree)
+    hoister.counting = False
+    trees = [hoister.visit(tree) for tree in trees]
+    return hoister.assignments, trees
+
+
+class ConstantFolder(ast.NodeTransformer):
+    """Calculates the parts of an expression that have no variables."""
+    def __init__(self, context):
+        self.context = context
+        # names of the values this has stored in context
+        self.constantnames = []
+
+    def visit(self, node):
+        # fold the operands first, so they can be checked for being constant
+        node = self.generic_visit(node)
+        if not isinstance(node, FOLDABLE_NODES) or not self._isconstant(node):
+            return node
+        try:
+            value = eval(compile(ast.Expression(node), '<constant>', 'eval'),
+                         self.context)
+        # leave errors to happen when the field is calculated, like they would
+        # have before
+        except Exception:
+            return node
+        if type(value) in (int, long, float, complex):
+            newnode = ast.Num(n=value)
+        elif type(value) in (str, unicode):
+            newnode = ast.Str(s=value)
+        else:
+            constantname = 'constant%d' % len(self.constantnames)
+            self.constantnames.append(constantname)
+            self.context[constantname] = value
+            newnode = ast.Name(id=constantname, ctx=ast.Load())
+        return ast.copy_location(newnode, node)
+
+    def _isconstant(self, node):
+        """Check that all of the operands of a node are constants."""
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.Num, ast.Str)):
+                continue
+            elif isinstance(child, ast.Name):
+                if (child.id not in CONSTANT_NAMES and
+                        child.id not in self.constantnames):
+                    return False
+            # operators and contexts are nodes too, but not expressions
+            elif isinstance(child, ast.expr):
+                return False
+        return True
+
+
+class UnconditionalTransformer(ast.NodeTransformer):
+    """Only visits the parts of an expression that are always evaluated.
+
+    Sub-expressions that might not be evaluated, like the branches of
+    'x if y else z', are skipped, since calculating them up front could raise
+    an error that otherwise wouldn't happen."""
+    def visit_IfExp(self, node):
+        node.test = self.visit(node.test)
+        return node
+
+    def visit_BoolOp(self, node):
+        # only the first value is always evaluated
+        node.values[0] = self.visit(node.values[0])
+        return node
+
+    # these define their own variables, leave them alone
+    def visit_Lambda(self, node):
+        return node
+
+    def visit_ListComp(self, node):
+        return node
+
+    def visit_GeneratorExp(self, node):
+        return node
+
+    def visit_SetComp(self, node):
+        return node
+
+    def visit_DictComp(self, node):
+        return node
+
+
+class CommonHoister(UnconditionalTransformer):
+    """Replaces repeated sub-expressions with a reference to a variable.
+
+    The first pass (counting = True) counts each sub-expression. The second
+    pass replaces the ones that were found more than once."""
+    def __init__(self, prefix, ispurecall=None):
+        self.prefix = prefix
+        self.ispurecall = ispurecall
+        self.counting = True
+        # counts[ast.dump(expression)] = number of times it occurs
+        self.counts = {}
+        # names[ast.dump(expression)] = name of the variable that holds it
+        self.names = {}
+        self.assignments = []
+
+    def generic_visit(self, node):
+        if not isinstance(node, HOISTABLE_NODES) or not self._ispure(node):
+            return super(CommonHoister, self).generic_visit(node)
+        # identify the expression before its parts are replaced
+        key = ast.dump(node)
+        if self.counting:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            return super(CommonHoister, self).generic_visit(node)
+        node = super(CommonHoister, self).generic_visit(node)
+        if self.counts[key] < 2:
+            return node
+        # the first occurence is assigned to a variable, with any parts of it
+        # that are repeated already replaced, so the order of the assignments
+        # is also the order they need to be calculated in
+        if key not in self.names:
+            name = self.prefix + str(len(self.assignments))
+            self.names[key] = name
+            self.assignments.append((name, node))
+        return ast.copy_location(ast.Name(id=self.names[key], ctx=ast.Load()),
+                                 node)
+
+    def _ispure(self, node):
+        """Check that every call in an expression is to a pure function."""
+        for child in ast.walk(node):
+            if isinstance(child, ast.Call) and (self.ispurecall is None or
+                                                not self.ispurecall(child)):
+                return False
+        return True
+
+
+class BatchCallExtractor(UnconditionalTransformer):
+    """Replaces calls to batch functions with a reference to an input.
+
+    isbatchcall(node) checks if a call node is calling a batch function.
+    Calls that only have positional arguments are replaced by the name inN,
+    counting up from firstpos, so their results can be added to the end of
+    each input row. Calls inside the arguments of a call are replaced first.
+    Calls that are repeated use the same position."""
+    def __init__(self, isbatchcall, firstpos):
+        self.isbatchcall = isbatchcall
+        self.nextpos = firstpos
+        # (position, call node) in the order they need to be calculated
+        self.calls = []
+        # positions[ast.dump(call node)] = position of its results
+        self.positions = {}
+
+    def visit_Call(self, node):
+        node = self.generic_visit(node)
+        if (not self.isbatchcall(node) or not node.args or node.keywords or
+                node.starargs or node.kwargs):
+            return node
+        key = ast.dump(node)
+        if key not in self.positions:
+            self.positions[key] = self.nextpos
+            self.calls.append((self.nextpos, node))
+            self.nextpos += 1
+        return ast.copy_location(ast.Name(id='in%d' % self.positions[key],
+                                          ctx=ast.Load()), node)
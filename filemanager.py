@@ -43,6 +43,12 @@ class FileManager(object):
         # the file just has the wrong extension. csv is last in the registry
         # becauase it is likely to get a false-positive.
         self.filehandlers = OrderedDict()
+        # records checked to detect field types, 0 for all of them
+        self.typesamplerows = 0
+        # show the detected field types to the user to confirm or change
+        self.confirmfieldtypes = False
+        # records read to find the fields of files without a fixed schema
+        self.schemasamplerows = 1000
         # XXX do this separate from init?
         self.initfiletypes()
 
@@ -50,7 +56,12 @@ class FileManager(object):
         """Loads a module for handling a filetype."""
         extension = extension.upper()
         module = __import__('filetypes.' + modulename, fromlist=[None])
-        self.filehandlers[extension] = module.__dict__[classname]
+        handler = module.__dict__[classname]
+        # some extensions of a format need an optional library
+        if (hasattr(handler, 'supportsextension') and
+                not handler.supportsextension(extension)):
+            raise ImportError('No library available for ' + extension)
+        self.filehandlers[extension] = handler
 
     def initfiletypes(self):
         """Create a dictionary for use by a file dialog to filter files."""
@@ -100,7 +111,7 @@ class FileManager(object):
 
         alias = self.createalias(filename, tablename)
         # create new file
-        fileext = '.' + filename.split('.')[-1]
+        fileext = self.getfileext(filename)
         try:
             if tablename is None:
                 if fieldtypes is None:
@@ -123,7 +134,7 @@ class FileManager(object):
                 return None
             return e.tablelist
         except AmbiguousFieldTypesError as e:
-            return (e.fieldnames, e.fieldvalues, e.fieldtypes)
+            return self.resolvefieldtypes(filename, tablename, fileext, e)
         # invalid dbf data
         except InvalidDataError as e:
             print 'Data not readable'
@@ -154,7 +165,8 @@ class FileManager(object):
                         return None
                     return e.tablelist
                 except AmbiguousFieldTypesError as e:
-                    return (e.fieldnames, e.fieldvalues, e.fieldtypes)
+                    return self.resolvefieldtypes(filename, tablename,
+                                                  fileext, e)
                 # invalid dbf data
                 except InvalidDataError as e:
                     print 'Data not readable'
@@ -170,16 +182,45 @@ class FileManager(object):
                 print 'Unsupported data format'
                 return None
 
+        if hasattr(newfile, 'samplerows'):
+            newfile.samplerows = self.schemasamplerows
         self.filesbyfilename[fullfilename] = newfile
         self.filenamesbyalias[alias] = fullfilename
 
         return alias
 
+    def resolvefieldtypes(self, filename, tablename, fileext, fieldtypeerror):
+        """Open a file using detected field types, if the format can.
+
+        Otherwise, or if they should be confirmed, returns (field names,
+        sample values, possible types, detected types or None) for the
+        user to choose from."""
+        handler = self.filehandlers[fileext.upper()]
+        detectedtypes = None
+        if hasattr(handler, 'detectfieldtypes'):
+            detectedtypes = handler.detectfieldtypes(filename, tablename,
+                                                     self.typesamplerows)
+            if not self.confirmfieldtypes:
+                return self.addfile(filename, tablename, detectedtypes)
+        return (fieldtypeerror.fieldnames, fieldtypeerror.fieldvalues,
+                fieldtypeerror.fieldtypes, detectedtypes)
+
+    def getfileext(self, filename):
+        """Get the extension of a file, which may be several parts long."""
+        # check for multipart extensions like .csv.gz first
+        for fileext in sorted(self.filehandlers, key=len, reverse=True):
+            if filename.upper().endswith(fileext):
+                return fileext
+        return '.' + filename.split('.')[-1].upper()
+
     def createalias(self, inputname, tablename=None):
         """Creates a unique alias for a file."""
+        # strip the extension, which may have several parts (.csv.gz)
+        fileext = self.getfileext(inputname)
+        if inputname.upper().endswith(fileext):
+            inputname = inputname[:-len(fileext)]
         filenamesplit = re.findall('[a-zA-Z0-9]+', inputname)
-        # assumes the filename ends with 'name.extension'
-        alias = filenamesplit[-2]
+        alias = filenamesplit[-1]
         # don't start an alias with a number, sqlite dislikes it
         if alias[0].isdigit():
             alias = '_' + alias
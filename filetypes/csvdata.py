@@ -13,13 +13,39 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 ##
+import bz2
 import csv
+import gzip
+import io
 import re
 import os
+import time
+# xz support is in the standard library for python 3, and available for
+# python 2 with the backports.lzma package
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 import table
 import field
 
+# buffer size used when reading or writing compressed files
+COMPRESSEDBUFFERSIZE = 1024 * 1024
+# buffer size used when writing uncompressed files. the buffer is written
+# out whenever it fills, and at least every FLUSHINTERVAL seconds while
+# batches of rows are being added, so the file can be watched as it grows
+OUTPUTBUFFERSIZE = 1024 * 1024
+FLUSHINTERVAL = 5.0
+# compressed file extensions and the library that handles each of them
+COMPRESSORS = {'.gz': gzip.GzipFile,
+               '.bz2': bz2.BZ2File}
+if lzma is not None:
+    COMPRESSORS['.xz'] = lzma.LZMAFile
+
 
 # GenericFile is just an interface
 class CSVData(table.Table):
@@ -28,6 +54,10 @@ class CSVData(table.Table):
         super(CSVData, self).__init__(filename, tablename)
         self.outputfile = None
         self.writer = None
+        # names of the output fields, in the order of their values in rows
+        self.fieldnames = []
+        # when the output file was last flushed
+        self.flushtime = None
         if mode == 'r':
             self.dialect = self._getdialect()
         else:
@@ -35,17 +65,42 @@ class CSVData(table.Table):
         self.fieldattrorder = ['Name', 'Value']
         self.namelenlimit = None
 
+    @classmethod
+    def supportsextension(cls, extension):
+        """Check that the library for a compressed extension is available."""
+        compression = '.' + extension.lower().split('.')[-1]
+        return compression in COMPRESSORS or compression == '.csv'
+
+    def _openfile(self, mode):
+        """Open the file, (de)compressing it if the extension calls for it."""
+        compression = os.path.splitext(self.filename)[1].lower()
+        if compression not in COMPRESSORS:
+            if mode == 'r':
+                return open(self.filename, mode)
+            return open(self.filename, mode, OUTPUTBUFFERSIZE)
+        # bz2 has its own buffering, the others are wrapped in a large buffer
+        if compression == '.bz2':
+            # appending isn't supported by the python 2 bz2 library
+            if mode == 'a':
+                raise NotImplementedError
+            return bz2.BZ2File(self.filename, mode + 'b',
+                               buffering=COMPRESSEDBUFFERSIZE)
+        compressedfile = COMPRESSORS[compression](self.filename, mode + 'b')
+        if mode == 'r':
+            return io.BufferedReader(compressedfile, COMPRESSEDBUFFERSIZE)
+        return io.BufferedWriter(compressedfile, COMPRESSEDBUFFERSIZE)
+
     def _getdialect(self):
         """Get the dialect of the csv file."""
         try:
-            with open(self.filename, 'r') as inputfile:
+            with self._openfile('r') as inputfile:
                 return csv.Sniffer().sniff(inputfile.read(1024))
         except csv.Error as e:
             # it failed for some reason, so try my own delimiter testing
             # TODO store candidates in options
             candidates = ['\b', '\t', ',']
             for delimiter in candidates:
-                with open(self.filename, 'r') as inputfile:
+                with self._openfile('r') as inputfile:
                     tempreader = csv.reader(inputfile, delimiter=delimiter)
                     numfields = len(tempreader.next())
                     if numfields == 1:
@@ -65,7 +120,7 @@ class CSVData(table.Table):
 
     def getfields(self):
         """Get the fields from the csv file as a list of Field objects"""
-        with open(self.filename, 'r') as inputfile:
+        with self._openfile('r') as inputfile:
             reader = csv.DictReader(inputfile, dialect=self.dialect)
             fieldnames = reader.fieldnames
             fieldtype = {}
@@ -95,15 +150,46 @@ class CSVData(table.Table):
 
     def setfields(self, newfields):
         """Add a field to the csv file. Used before any records are added."""
-        fieldnames = [newfield.name for newfield in newfields]
-        self.outputfile = open(self.filename, 'w')
-        self.outputfile.truncate(0)
-        self.writer = csv.DictWriter(self.outputfile, fieldnames)
-        self.writer.writeheader()
+        self.fieldnames = [newfield.name for newfield in newfields]
+        self.outputfile = self._openfile('w')
+        self.writer = csv.writer(self.outputfile)
+        self.writer.writerow(self.fieldnames)
+        self.flushtime = time.time()
+
+    def reopen(self, newfields):
+        """Continue writing to a csv file after it was closed.
+
+        Raises NotImplementedError if the file's compression can't append."""
+        self.fieldnames = [newfield.name for newfield in newfields]
+        self.outputfile = self._openfile('a')
+        self.writer = csv.writer(self.outputfile)
+        self.flushtime = time.time()
 
     def addrecord(self, newrecord):
         """Append a new record to the csv file."""
-        self.writer.writerow(newrecord)
+        # missing values are left empty, like csv.DictWriter
+        self.addrow([newrecord.get(fieldname, '')
+                     for fieldname in self.fieldnames])
+
+    def addrow(self, row):
+        """Append a new record, given as a row, to the csv file."""
+        self.writer.writerow(row)
+
+    def addrows(self, rows):
+        """Append several records, given as rows, to the csv file."""
+        self.writer.writerows(rows)
+        if time.time() - self.flushtime >= FLUSHINTERVAL:
+            self.outputfile.flush()
+            self.flushtime = time.time()
+
+    def getsize(self):
+        """Get the number of bytes written, including any still buffered.
+
+        Compressed files are measured on disk, without what the compressor
+        is still holding."""
+        if os.path.splitext(self.filename)[1].lower() in COMPRESSORS:
+            return os.path.getsize(self.filename)
+        return self.outputfile.tell()
 
     def close(self):
         """Close the csv file."""
@@ -146,9 +232,28 @@ class CSVData(table.Table):
             backupcount += 1
         os.rename(self.filename, backupname)
 
+    def readrows(self):
+        """Iterate through the records as tuples, without the header."""
+        with self._openfile('r') as inputfile:
+            reader = csv.reader(inputfile, dialect=self.dialect)
+            header = reader.next()
+            fieldcount = len(header)
+            # the columns of repeated field names that are used, if any
+            columns = table.getcolumns(header)
+            for row in reader:
+                # skip blank lines, like csv.DictReader
+                if not row:
+                    continue
+                if len(row) != fieldcount:
+                    # missing values are None, extra values are dropped
+                    row = (row + [None] * fieldcount)[:fieldcount]
+                if columns is not None:
+                    row = [row[column] for column in columns]
+                yield tuple(row)
+
     # iterate through all the records
     def __iter__(self):
-        with open(self.filename, 'r') as inputfile:
+        with self._openfile('r') as inputfile:
             reader = csv.DictReader(inputfile, dialect=self.dialect)
             for row in reader:
                 yield row
@@ -50,6 +50,8 @@ class DBFData(table.Table):
                                         ('NUMERIC', 0), ('REAL', 0.0),
                                         ('LOGICAL', ' ')])
         self.namelenlimit = 10
+        # encodeValue of each field of an output file, used by addrows()
+        self.encoders = None
 
     def getfields(self):
         """Returns the fields of the file as a list of Field objects"""
@@ -75,6 +77,11 @@ class DBFData(table.Table):
                                        dbffield['length'],
                                        dbffield['decimals']))
 
+    def reopen(self, _fields):
+        """Continue writing to a dbf file after it was closed."""
+        self.filehandler = dbf.Dbf(self.filename)
+        self.encoders = None
+
     def addrecord(self, newrecord):
         """Append a new record to an output dbf file."""
         rec = self.filehandler.newRecord()
@@ -82,6 +89,34 @@ class DBFData(table.Table):
             rec[fieldname] = newrecord[fieldname]
         rec.store()
 
+    def addrow(self, row):
+        """Append a new record, given as a row, to an output dbf file."""
+        rec = self.filehandler.RecordClass(self.filehandler, data=row)
+        rec.store()
+
+    def addrows(self, rows):
+        """Append several records, given as rows, to an output dbf file.
+
+        Each batch of records is encoded into one string and appended with a
+        single write. The record count in the header is written by close()."""
+        header = self.filehandler.header
+        if self.encoders is None:
+            self.encoders = [fielddef.encodeValue
+                             for fielddef in header.fields]
+        encoders = self.encoders
+        stream = self.filehandler.stream
+        for batch in table.batches(rows):
+            # the first byte of each record is the deleted flag
+            encoded = [' ' + ''.join([encode(value) for encode, value
+                                      in zip(encoders, row)])
+                       for row in batch]
+            stream.seek(header.headerLength +
+                        header.recordCount * header.recordLength)
+            # followed by the end of file marker, the next batch overwrites it
+            stream.write(''.join(encoded) + '\x1A')
+            header.recordCount += len(encoded)
+            header.changed = True
+
     def close(self):
         """Close the dbf file handler."""
         # will be None if this was a dummy file
@@ -138,6 +173,11 @@ class DBFData(table.Table):
             backupcount += 1
         os.rename(self.filename, backupname)
 
+    def readrows(self):
+        """Iterate through the records as tuples of values."""
+        for record in self:
+            yield tuple(record.fieldData)
+
     def __iter__(self):
         """Iterate through all the records in the file."""
         recordcount = self.filehandler.recordCount
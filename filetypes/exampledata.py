@@ -26,6 +26,9 @@ The only required attributes is
 # explanation that setfields gets called once and then addrecord gets called multiple times, always in that order, so setfields can be used to set up the output file and other necessary variables.
 # input can open and close the file in a single function (getfields, getrecordcount, getitem)
 # output opens the file in setfields(), writes to it with addrecord(), and closes it with close()
+# records are also read with readrows() and written with addrow() as tuples of
+# values in field order. table.Table has a readrows() that uses __iter__, and
+# an addrows() that calls addrow() for each row.
 # close() gets called for both, it just doesn't need to do anything with input files.
 
 # if a format has extra attributes for fields (beyond a field name), they
@@ -90,6 +93,11 @@ class ExampleData(table.Table):
         # store fieldvalue somehow
         self.filehandler.addrecord(recordvalues)
 
+    # called instead of addrecord by the main output
+    def addrow(self, row):
+        """Write a record (a tuple of values in field order)."""
+        self.filehandler.addrecord(list(row))
+
     def close(self):
         """Close the open file, if any."""
         self.filehandler.close()
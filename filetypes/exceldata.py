@@ -15,6 +15,7 @@
 ##
 # wrapper for xlrd and xlwt libraries
 from collections import OrderedDict
+import itertools
 import os
 from datetime import datetime
 from datetime import time
@@ -22,45 +23,109 @@ from datetime import time
 
 from filetypes.libraries import xlrd
 from filetypes.libraries import xlwt
+from filetypes import xlsxreader
+from filetypes import xlsxwriter
 
 import table
 import field
 
+# rows per sheet in .xls files, including the field names
+XLSMAXROWS = 65536
+# parsed workbooks, shared by the ExcelData objects of the same file
+# openbooks[(path, modification time, size)] = [xlrd Book or XLSXReader,
+#                                               number of holders],
+# least recently used first
+OPENBOOKS = OrderedDict()
+# books without holders that are kept. held books are never evicted
+MAXOPENBOOKS = 4
+# converted dates kept per sheet, since the same dates tend to repeat
+MAXCACHEDDATES = 100000
+# the field type of a column whose cells are all one type
+CELLFIELDTYPES = {xlrd.XL_CELL_TEXT: 'Text', xlrd.XL_CELL_NUMBER: 'Numeric',
+                  xlrd.XL_CELL_DATE: 'Date', xlrd.XL_CELL_BOOLEAN: 'Logical'}
+# cell types that don't say anything about a column's type
+NOVALUECELLTYPES = (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK,
+                    xlrd.XL_CELL_ERROR)
+
+
+def openbook(filename, hold=False):
+    """Get the parsed workbook of a file, parsing it if it isn't cached.
+
+    The cache is by path, modification time and size, so a file that's been
+    changed is parsed again. .xls sheets are loaded from a memory map when
+    they're first used. With hold, the book isn't closed until it's given
+    to releasebook()."""
+    filestat = os.stat(filename)
+    bookkey = (os.path.abspath(filename), filestat.st_mtime,
+               filestat.st_size)
+    if bookkey in OPENBOOKS:
+        # move it to the end, as the most recently used
+        bookentry = OPENBOOKS.pop(bookkey)
+    else:
+        if filename.lower().endswith('.xlsx'):
+            book = xlsxreader.XLSXReader(filename)
+        else:
+            book = xlrd.open_workbook(filename, on_demand=True,
+                                      use_mmap=True)
+        bookentry = [book, 0]
+        # close the least recently used books that nothing holds
+        for oldkey in OPENBOOKS.keys():
+            if len(OPENBOOKS) < MAXOPENBOOKS:
+                break
+            if OPENBOOKS[oldkey][1] == 0:
+                OPENBOOKS.pop(oldkey)[0].release_resources()
+    if hold:
+        bookentry[1] += 1
+    OPENBOOKS[bookkey] = bookentry
+    return bookentry[0]
+
+
+def releasebook(book):
+    """Stop holding a workbook, closing it if nothing else holds it."""
+    for bookkey, bookentry in OPENBOOKS.items():
+        if bookentry[0] is book:
+            bookentry[1] -= 1
+            if bookentry[1] <= 0:
+                del OPENBOOKS[bookkey]
+                book.release_resources()
+            return
+
 
 # GenericFile is just an interface
 class ExcelData(table.Table):
     """Wraps the x library with a set of standard functions."""
     def __init__(self, filename, tablename=None, mode='r', fieldtypes=None):
         super(ExcelData, self).__init__(filename, tablename)
+        # .xlsx sheets are read as they're parsed, instead of by xlrd, and
+        # written by xlsxwriter instead of xlwt
+        self.streaming = filename.lower().endswith('.xlsx')
+        # set when the workbook is read
+        self.datemode = 0
+        # the workbook this reads from, held until close()
+        self.inputbook = None
 
         # If no table name was passed
         if tablename is None:
             # open the workbook
             if mode == 'r':
-                with xlrd.open_workbook(filename) as book:
-                    tablenames = book.sheet_names()
-                    # and return the list of sheet names in an exception
-                    raise table.NeedTableError(tablenames)
+                tablenames = openbook(filename).sheet_names()
+                # and return the list of sheet names in an exception
+                raise table.NeedTableError(tablenames)
             else:
                 raise table.NeedTableError([])
 
         # check that the data opens
         if mode == 'r':
-            with xlrd.open_workbook(self.filename, on_demand=True) as book:
-                if fieldtypes is None:
-                    sheet = book.sheet_by_name(self.tablename)
-                    fieldnames = sheet.row_values(0)
-                    fieldvalues = []
-                    for i in range(1, 10):
-                        try:
-                            fieldvalues.append(sheet.row_values(i))
-                        # fewer than 9 records in the file
-                        except IndexError:
-                            break
-                    fieldtypes = ['Text', 'Numeric', 'Date', 'Logical']
-                    raise table.AmbiguousFieldTypesError(fieldnames,
-                                                         fieldvalues,
-                                                         fieldtypes)
+            if fieldtypes is None:
+                # the column names and up to 9 records
+                rows = list(itertools.islice(self._iterrows(), 10))
+                self._releasebook()
+                fieldnames = rows[0]
+                fieldvalues = rows[1:]
+                fieldtypes = ['Text', 'Numeric', 'Date', 'Logical']
+                raise table.AmbiguousFieldTypesError(fieldnames,
+                                                     fieldvalues,
+                                                     fieldtypes)
 
         self.fieldattrorder = ['Name', 'Value']
         self.types = {0: 'EMPTY', 1: 'TEXT', 2: 'NUMERIC', 3: 'DATE',
@@ -72,48 +137,147 @@ class ExcelData(table.Table):
         self.namelenlimit = 255 # for Excel 2003
 
         self.book = None
+        # xlsxwriter.XLSXWriter, for .xlsx output
+        self.writer = None
+        # number of sheets in the .xls output so far
+        self.sheetcount = 0
         self.fieldtypes = fieldtypes
 
+    def _getbook(self):
+        """Get the parsed workbook, holding it until close()."""
+        if self.inputbook is None:
+            self.inputbook = openbook(self.filename, hold=True)
+        return self.inputbook
+
+    def _releasebook(self):
+        """Stop holding the parsed workbook, if it's held."""
+        if self.inputbook is not None:
+            releasebook(self.inputbook)
+            self.inputbook = None
+
+    def _iterrows(self):
+        """Iterate through the rows of the sheet as lists of values.
+
+        The first row is the column names. Sets self.datemode before the
+        first row."""
+        book = self._getbook()
+        self.datemode = book.datemode
+        if self.streaming:
+            for rowvalues in book.iterrows(self.tablename):
+                yield rowvalues
+        else:
+            sheet = book.sheet_by_name(self.tablename)
+            for i in xrange(sheet.nrows):
+                yield sheet.row_values(i)
+
+    @classmethod
+    def detectfieldtypes(cls, filename, tablename, samplerows=0):
+        """Get the type of each column from the types of its cells.
+
+        Checks the first samplerows records, or all of them if it's 0. A
+        column of one type of cell gets the matching field type, apart from
+        empty cells and errors. Mixed or empty columns are Text."""
+        book = openbook(filename)
+        if filename.lower().endswith('.xlsx'):
+            rowtypes = book.iterrowtypes(tablename)
+            # the first row is the column names
+            columncount = len(next(rowtypes))
+            columntypes = [set() for _colx in xrange(columncount)]
+            if samplerows:
+                rowtypes = itertools.islice(rowtypes, samplerows)
+            for celltypes in rowtypes:
+                for colx in xrange(min(columncount, len(celltypes))):
+                    columntypes[colx].add(celltypes[colx])
+        else:
+            sheet = book.sheet_by_name(tablename)
+            endrowx = samplerows + 1 if samplerows else None
+            columntypes = [set(sheet.col_types(colx, 1, endrowx))
+                           for colx in xrange(sheet.ncols)]
+        fieldtypes = []
+        for celltypes in columntypes:
+            celltypes.difference_update(NOVALUECELLTYPES)
+            if len(celltypes) == 1:
+                fieldtypes.append(CELLFIELDTYPES[celltypes.pop()])
+            else:
+                fieldtypes.append('Text')
+        return fieldtypes
+
     def getfields(self):
         """Get the fields from the csv file as a list of Field objects"""
-        with xlrd.open_workbook(self.filename, on_demand=True) as book:
-            # print 'self.tablename:', self.tablename
-            sheet = book.sheet_by_name(self.tablename)
-            # get column names from first row, hope they're unique
-            fieldnames = sheet.row_values(0)
-
-            # fieldcandidates = {}
-            fieldlist = []
-            for fieldindex in xrange(len(fieldnames)):
-                fieldname = fieldnames[fieldindex]
-                attributes = {'type': self.fieldtypes[fieldindex].upper()}
-                newfield = field.Field(fieldname, attributes, namelen=self.namelenlimit)
-                fieldlist.append(newfield)
-            return fieldlist
+        # get column names from first row, hope they're unique
+        fieldnames = next(self._iterrows())
+
+        # fieldcandidates = {}
+        fieldlist = []
+        for fieldindex in xrange(len(fieldnames)):
+            fieldname = fieldnames[fieldindex]
+            attributes = {'type': self.fieldtypes[fieldindex].upper()}
+            newfield = field.Field(fieldname, attributes, namelen=self.namelenlimit)
+            fieldlist.append(newfield)
+        return fieldlist
 
     def setfields(self, fields):
         """Set the field definitions. Used before any records are added."""
-        self.book = xlwt.Workbook()
-        self.sheet = self.book.add_sheet(self.tablename)
-        for i in xrange(len(fields)):
-            fieldname = fields[i]['name']
+        for outputfield in fields:
             # store field name for use in addrecord()
-            self.fields[fieldname] = None
-            self.sheet.row(0).write(i, fieldname)
+            self.fields[outputfield['name']] = None
+        if self.streaming:
+            self.writer = xlsxwriter.XLSXWriter(self.filename, self.tablename)
+            self.writer.setfields(self.fields.keys())
+            return
+        self.book = xlwt.Workbook()
+        self._addsheet()
+
+    def _addsheet(self):
+        """Start a new .xls sheet, with a row of field names."""
+        self.sheetcount += 1
+        self.sheet = self.book.add_sheet(
+            xlsxwriter.getsheetname(self.tablename, self.sheetcount))
+        fieldnames = self.fields.keys()
+        for i in xrange(len(fieldnames)):
+            self.sheet.row(0).write(i, fieldnames[i])
         self.currow = 1
 
     def addrecord(self, newrecord):
         """Append a new record to an output dbf file."""
-        curcol = 0
-        for fieldname in self.fields:
-            self.sheet.write(self.currow, curcol, newrecord[fieldname])
-            curcol += 1
+        self.addrow([newrecord[fieldname] for fieldname in self.fields])
+
+    def addrow(self, row):
+        """Append a new record, given as a row, to the sheet."""
+        if self.writer is not None:
+            self.writer.addrow(row)
+            return
+        # continue on another sheet when this one is full
+        if self.currow >= XLSMAXROWS:
+            self._addsheet()
+        for curcol in xrange(len(row)):
+            self.sheet.write(self.currow, curcol, row[curcol])
         self.currow += 1
 
+    def addrows(self, rows):
+        """Append several records, given as rows."""
+        if self.writer is not None:
+            self.writer.addrows(rows)
+        else:
+            super(ExcelData, self).addrows(rows)
+
+    def getsize(self):
+        """Get the size of .xlsx output so far, before compression.
+
+        Returns None for .xls output, which isn't written until it's
+        closed."""
+        if self.writer is not None:
+            return self.writer.getsize()
+        return None
+
     def close(self):
         """Close output file, if this was an output file"""
-        if self.book is not None:
+        if self.writer is not None:
+            self.writer.close()
+        elif self.book is not None:
             self.book.save(self.filename)
+        else:
+            self._releasebook()
 
     def convertfield(self, sourcefield):
         """Convert a field to excel format."""
@@ -134,9 +298,10 @@ class ExcelData(table.Table):
         return ''
 
     def getrecordcount(self):
-        with xlrd.open_workbook(self.filename, on_demand=True) as book:
-            sheet = book.sheet_by_name(self.tablename)
-            return sheet.nrows
+        book = self._getbook()
+        if self.streaming:
+            return book.getrowcount(self.tablename)
+        return book.sheet_by_name(self.tablename).nrows
 
     def backup(self):
         """Rename the Excel file to filename.xls.old (or xlsx)"""
@@ -149,28 +314,85 @@ class ExcelData(table.Table):
             backupcount += 1
         os.rename(self.filename, backupname)
 
-    def __iter__(self):
-        with xlrd.open_workbook(self.filename, on_demand=True) as book:
+    def _getconverters(self):
+        """Get (field index, conversion function) for the columns to convert.
+
+        self.datemode has to be set first."""
+        datemode = self.datemode
+        # dates[date number] = date string
+        dates = {}
+
+        def convertdate(value):
+            """Convert a date number to a date tuple, then to a str."""
+            # empty and text cells are left as they are
+            if type(value) is not float:
+                return value
+            if value in dates:
+                return dates[value]
+            try:
+                datetuple = xlrd.xldate_as_tuple(value, datemode)
+            except xlrd.xldate.XLDateAmbiguous:
+                return value
+            try:
+                datestr = str(datetime(*datetuple))
+            except ValueError:
+                datestr = str(time(*datetuple[3:]))
+            if len(dates) < MAXCACHEDDATES:
+                dates[value] = datestr
+            return datestr
+
+        def convertlogical(value):
+            """Convert a logical cell to a bool."""
+            return value == 1
+
+        converters = []
+        for fieldindex in range(len(self.fieldtypes)):
+            if self.fieldtypes[fieldindex] == 'Date':
+                converters.append((fieldindex, convertdate))
+            elif self.fieldtypes[fieldindex] == 'Logical':
+                converters.append((fieldindex, convertlogical))
+        return converters
+
+    def readrows(self):
+        """Get the records from the sheet as tuples."""
+        fieldcount = len(self.fieldtypes)
+        if not self.streaming:
+            # the whole sheet is in memory, so convert a column at a time
+            book = self._getbook()
+            self.datemode = book.datemode
             sheet = book.sheet_by_name(self.tablename)
-            # get column names from first row, hope they're unique
-            colnames = sheet.row_values(0)
-            # get values for a "record"
-            for i in xrange(1, sheet.nrows):
-                rowvalues = sheet.row_values(i)
-                # convert dates to a date tuple, then to a str
-                for fieldindex in range(len(rowvalues)):
-                    if self.fieldtypes[fieldindex] == 'Date':
-                        fieldval = rowvalues[fieldindex]
-                        try:
-                            fieldval = xlrd.xldate_as_tuple(rowvalues[fieldindex],
-                                                            book.datemode)
-                        except xlrd.xldate.XLDateAmbiguous:
-                            pass
-                        try:
-                            rowvalues[fieldindex] = str(datetime(*fieldval))
-                        except ValueError:
-                            rowvalues[fieldindex] = str(time(*fieldval[3:]))
-                    elif self.fieldtypes[fieldindex] == 'Logical':
-                        rowvalues[fieldindex] = rowvalues[fieldindex] == 1
-                # create a dictionary of the column names and values
-                yield dict(zip(colnames, rowvalues))
+            # the first row is the column names
+            columns = [sheet.col_values(colx, 1)
+                       for colx in xrange(min(fieldcount, sheet.ncols))]
+            while len(columns) < fieldcount:
+                columns.append([''] * (sheet.nrows - 1))
+            for fieldindex, convert in self._getconverters():
+                columns[fieldindex] = map(convert, columns[fieldindex])
+            # the columns of repeated field names that are used, if any
+            usedcolumns = table.getcolumns(sheet.row_values(0))
+            if usedcolumns is not None:
+                columns = [columns[colx] for colx in usedcolumns]
+            for row in itertools.izip(*columns):
+                yield row
+            return
+        rows = self._iterrows()
+        # the first row is the column names
+        usedcolumns = table.getcolumns(next(rows))
+        converters = self._getconverters()
+        # get values for a "record"
+        for rowvalues in rows:
+            # streamed rows stop at the last cell with a value
+            if len(rowvalues) != fieldcount:
+                rowvalues = (rowvalues + [''] * fieldcount)[:fieldcount]
+            for fieldindex, convert in converters:
+                rowvalues[fieldindex] = convert(rowvalues[fieldindex])
+            if usedcolumns is not None:
+                rowvalues = [rowvalues[colx] for colx in usedcolumns]
+            yield tuple(rowvalues)
+
+    def __iter__(self):
+        # get column names from first row, a repeated name is one field
+        colnames = OrderedDict.fromkeys(next(self._iterrows())).keys()
+        for row in self.readrows():
+            # create a dictionary of the column names and values
+            yield dict(zip(colnames, row))
@@ -0,0 +1,350 @@
+"""FixedWidthData is used to provide standard interfaces to fixed-width text.
+
+The columns are defined by a layout file next to the data file, named
+data.layout or data.txt.layout for data.txt. It's a csv file with a header
+row of name,start,length,type and one line per field. start is the column
+the field starts at, counting from 1. type is TEXT, INTEGER or REAL, and can
+be left blank to detect it from a sample of the records.
+
+Every record is the same length, so the file is memory mapped and each
+record is found by its offset instead of by searching for line breaks. The
+records can be counted from the file size, and any one of them can be read
+with getrow().
+"""
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+from collections import OrderedDict
+import csv
+import mmap
+import os
+import struct
+
+import table
+import field
+
+# records spread through the file that are checked to detect field types
+TYPESAMPLESIZE = 100
+# width of output fields that don't have a length. numbers get enough room
+# for any 64 bit integer or the repr() of any float
+DEFAULTWIDTHS = {'TEXT': 254, 'INTEGER': 20, 'REAL': 24}
+# the fixed-width type of the types of other formats
+INTEGERTYPES = ('INTEGER', 'SMALLINT', 'OID')
+REALTYPES = ('REAL', 'NUMERIC', 'SINGLE', 'DOUBLE', 'FLOAT')
+# buffer size used when writing
+OUTPUTBUFFERSIZE = 1024 * 1024
+
+
+class ValueTooLongError(ValueError):
+    """A number doesn't fit in the width of its output field."""
+    pass
+
+
+def getlayoutfilename(filename):
+    """Get the name of the layout file of a data file.
+
+    data.txt.layout is used if it exists, otherwise data.layout."""
+    layoutfilename = filename + '.layout'
+    if os.path.isfile(layoutfilename):
+        return layoutfilename
+    return os.path.splitext(filename)[0] + '.layout'
+
+
+class FixedWidthData(table.Table):
+    """Reads and writes fixed-width text files, using a layout file."""
+    def __init__(self, filename, tablename=None, mode='r'):
+        super(FixedWidthData, self).__init__(filename, tablename)
+        self.fieldattrorder = ['Name', 'Type', 'Start', 'Length', 'Value']
+        self.namelenlimit = None
+        # the data file, and the memory map of it when reading
+        self.datafile = None
+        self.buffer = None
+        # format string of an output record
+        self.rowformat = None
+        if mode == 'r':
+            # (name, start offset, length, type) of each field
+            self.layout = self._readlayout()
+            self._openbuffer()
+
+    def _readlayout(self):
+        """Read the name, position, length and type of each field."""
+        layout = []
+        with open(getlayoutfilename(self.filename), 'rb') as layoutfile:
+            for row in csv.DictReader(layoutfile):
+                fieldtype = (row.get('type') or '').strip().upper() or None
+                layout.append((row['name'].strip(), int(row['start']) - 1,
+                               int(row['length']), fieldtype))
+        if not layout:
+            raise table.InvalidDataError
+        return layout
+
+    def _openbuffer(self):
+        """Memory map the data and set up the unpacking of each record."""
+        # unpack the fields in the order they're in the record, skipping any
+        # columns between them
+        fieldsbystart = sorted(range(len(self.layout)),
+                               key=lambda i: self.layout[i][1])
+        structformat = ''
+        position = 0
+        for i in fieldsbystart:
+            _name, start, length, _type = self.layout[i]
+            if start < position:
+                raise table.InvalidDataError
+            if start > position:
+                structformat += str(start - position) + 'x'
+            structformat += str(length) + 's'
+            position = start + length
+        self.recordstruct = struct.Struct(structformat)
+        # used to put the unpacked values back in layout order, if needed
+        if fieldsbystart == range(len(self.layout)):
+            self.fieldorder = None
+        else:
+            self.fieldorder = [fieldsbystart.index(i)
+                               for i in range(len(self.layout))]
+
+        self.datafile = open(self.filename, 'rb')
+        filesize = os.fstat(self.datafile.fileno()).st_size
+        if filesize == 0:
+            # empty files can't be mapped
+            self.buffer = ''
+        else:
+            self.buffer = mmap.mmap(self.datafile.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        # records may be padded past the last field and end in a line break
+        linebreak = self.buffer.find('\n')
+        if linebreak == -1:
+            linelength = position
+            self.recordlength = position
+        else:
+            linelength = linebreak
+            if linebreak > 0 and self.buffer[linebreak - 1] == '\r':
+                linelength -= 1
+            self.recordlength = linebreak + 1
+        # the last record doesn't need a line break
+        lastlength = filesize % self.recordlength
+        if linelength < position or lastlength not in (0, linelength):
+            self.close()
+            raise table.InvalidDataError
+        self.recordcount = filesize // self.recordlength
+        if lastlength:
+            self.recordcount += 1
+
+    def getrow(self, recordindex):
+        """Get one record, by its position in the file, as a tuple."""
+        if not 0 <= recordindex < self.recordcount:
+            raise IndexError('record index out of range')
+        values = [value.strip() for value in self.recordstruct.unpack_from(
+            self.buffer, recordindex * self.recordlength)]
+        if self.fieldorder is not None:
+            values = [values[i] for i in self.fieldorder]
+        return tuple(values)
+
+    @classmethod
+    def _detecttype(cls, fieldindex, samplerows):
+        """Detect the type of a field from the values of some records."""
+        fieldtype = None
+        for row in samplerows:
+            value = row[fieldindex]
+            # blanks could be any type
+            if value == '':
+                continue
+            # fields can hold or step down in type, from integer, to real,
+            # and finally text
+            if fieldtype in ('INTEGER', None):
+                try:
+                    int(value)
+                    fieldtype = 'INTEGER'
+                    continue
+                except ValueError:
+                    pass
+            try:
+                number = float(value)
+            except ValueError:
+                return 'TEXT'
+            # nan and inf are text
+            if number - number != 0:
+                return 'TEXT'
+            fieldtype = 'REAL'
+        if fieldtype is None:
+            return 'TEXT'
+        return fieldtype
+
+    def getfields(self):
+        """Get the fields from the layout as a list of Field objects."""
+        samplerows = None
+        fieldlist = []
+        for fieldindex in range(len(self.layout)):
+            fieldname, start, length, fieldtype = self.layout[fieldindex]
+            if fieldtype is None:
+                if samplerows is None:
+                    # spread the sample through the file
+                    step = max(self.recordcount // TYPESAMPLESIZE, 1)
+                    samplerows = [self.getrow(i) for i in
+                                  xrange(0, self.recordcount, step)]
+                fieldtype = self._detecttype(fieldindex, samplerows)
+            attributes = OrderedDict([('type', fieldtype),
+                                      ('start', start + 1),
+                                      ('length', length)])
+            newfield = field.Field(fieldname, attributes, namelen=None,
+                                   dataformat='fixedwidth')
+            fieldlist.append(newfield)
+        return fieldlist
+
+    def setfields(self, newfields):
+        """Write the layout file and start the data file."""
+        self.layout = []
+        start = 0
+        for newfield in newfields:
+            length = int(newfield['length'])
+            self.layout.append((newfield.name, start, length,
+                                newfield['type']))
+            start += length
+        with open(getlayoutfilename(self.filename), 'wb') as layoutfile:
+            writer = csv.writer(layoutfile)
+            writer.writerow(['name', 'start', 'length', 'type'])
+            for fieldname, start, length, fieldtype in self.layout:
+                writer.writerow([fieldname, start + 1, length, fieldtype])
+        self.datafile = open(self.filename, 'wb', OUTPUTBUFFERSIZE)
+
+    def addrecord(self, newrecord):
+        """Append a new record to the file."""
+        self.addrow([newrecord.get(fieldname, '')
+                     for fieldname, _start, _length, _type in self.layout])
+
+    def _getline(self, row):
+        """Get the text of a record, each value padded to its field.
+
+        Text that's too long is cut, at a whole utf-8 character. Raises
+        ValueTooLongError if a number is too long for its field."""
+        values = []
+        for value, (fieldname, _start, length, fieldtype) in zip(row,
+                                                                self.layout):
+            if value is None:
+                value = ''
+            elif isinstance(value, unicode):
+                value = value.encode('utf-8')
+            elif isinstance(value, float):
+                # str() rounds to 12 digits
+                value = repr(value)
+            elif not isinstance(value, str):
+                value = str(value)
+            # line breaks would throw off the position of every record after
+            if '\n' in value or '\r' in value:
+                value = value.replace('\r', ' ').replace('\n', ' ')
+            if len(value) > length:
+                if fieldtype in ('INTEGER', 'REAL'):
+                    raise ValueTooLongError(
+                        value + ' is longer than the ' + str(length) +
+                        ' characters of field ' + fieldname)
+                value = value[:length]
+                # drop a character that was cut partway through
+                try:
+                    value.decode('utf-8')
+                except UnicodeDecodeError as e:
+                    if e.start >= length - 3:
+                        value = value[:e.start]
+            values.append(value.ljust(length))
+        return ''.join(values) + '\n'
+
+    def addrow(self, row):
+        """Append a new record, given as a row, to the file."""
+        self.datafile.write(self._getline(row))
+
+    def addrows(self, rows):
+        """Append several records, given as rows, in one write."""
+        self.datafile.write(''.join([self._getline(row) for row in rows]))
+
+    def getsize(self):
+        """Get the number of bytes written, including any still buffered."""
+        return self.datafile.tell()
+
+    def close(self):
+        """Close the data file."""
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.buffer = None
+        if self.datafile is not None:
+            self.datafile.close()
+            self.datafile = None
+
+    @classmethod
+    def convertfield(cls, unknownfield):
+        """Convert a field of unknown type to a fixed-width field."""
+        fixedwidthfield = unknownfield.copy()
+        if fixedwidthfield.hasformat('fixedwidth'):
+            fixedwidthfield.setformat('fixedwidth')
+        else:
+            attributes = OrderedDict()
+            fieldtype = str(unknownfield.getattribute('type')).upper()
+            if fieldtype in INTEGERTYPES:
+                attributes['type'] = 'INTEGER'
+            elif fieldtype in REALTYPES:
+                attributes['type'] = 'REAL'
+            else:
+                attributes['type'] = 'TEXT'
+            # numbers keep the width of the source, if it has one
+            if unknownfield.hasattribute('length'):
+                attributes['length'] = unknownfield['length']
+            else:
+                attributes['length'] = DEFAULTWIDTHS[attributes['type']]
+            fixedwidthfield.setformat('fixedwidth', attributes)
+        fixedwidthfield.namelenlimit = None
+        fixedwidthfield.resetname()
+        return fixedwidthfield
+
+    @classmethod
+    def getfieldtypes(cls):
+        """Return a list of field types to populate a combo box."""
+        return ['TEXT', 'INTEGER', 'REAL']
+
+    @classmethod
+    def getblankvalue(cls, _outputfield):
+        """Return an empty string as the blank value for any field."""
+        return ''
+
+    def getrecordcount(self):
+        """Get the number of records, from the size of the file."""
+        return self.recordcount
+
+    def backup(self):
+        """Rename the file to filename.old, and its layout file with it."""
+        backupcount = 1
+        backupname = self.filename + '.old'
+        backupnamelen = len(backupname)
+        # don't overwrite existing backups, if any
+        while os.path.isfile(backupname):
+            backupname = backupname[:backupnamelen] + str(backupcount)
+            backupcount += 1
+        layoutfilename = getlayoutfilename(self.filename)
+        os.rename(self.filename, backupname)
+        if os.path.isfile(layoutfilename):
+            os.rename(layoutfilename, backupname + '.layout')
+
+    def readrows(self):
+        """Iterate through the records as tuples, in layout order."""
+        unpack = self.recordstruct.unpack_from
+        data = self.buffer
+        fieldorder = self.fieldorder
+        for offset in xrange(0, self.recordcount * self.recordlength,
+                             self.recordlength):
+            values = [value.strip() for value in unpack(data, offset)]
+            if fieldorder is not None:
+                values = [values[i] for i in fieldorder]
+            yield tuple(values)
+
+    def __iter__(self):
+        fieldnames = [fieldname for fieldname, _start, _length, _type
+                      in self.layout]
+        for row in self.readrows():
+            yield dict(zip(fieldnames, row))
@@ -125,12 +125,14 @@ class GDBData(table.Table):
 
     def addrecord(self, newrecord):
         """Write a record (stored as a dictionary) to the output file."""
+        self.addrow([newrecord[fn] for fn in self.fieldnames])
+
+    def addrow(self, row):
+        """Write a record, given as a row, to the output file."""
         if self.cur is None:
             self.conn = sqlite3.connect(self.filename)
             self.cur = self.conn.cursor()
-        else:
-            values = [newrecord[fn] for fn in self.fieldnames]
-            self.cur.execute(self.insertquery, values)
+        self.cur.execute(self.insertquery, row)
 
     def close(self):
         """Close the open file, if any."""
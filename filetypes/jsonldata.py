@@ -0,0 +1,218 @@
+"""JSONLData is used to provide standard interfaces to JSON Lines files.
+
+Each line of the file is a JSON object, one per record. The fields are the
+keys of the objects in a sample from the start of the file, in the order
+they're first seen, and keys that only appear later are left out. Objects
+and arrays within a record are kept as JSON text.
+"""
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+from collections import OrderedDict
+import itertools
+import json
+import os
+
+import table
+import field
+
+# records read to find the fields and their types, 0 for the whole file
+SAMPLEROWS = 1000
+# buffer size used when reading or writing
+BUFFERSIZE = 1024 * 1024
+# values that are kept as JSON text
+NESTEDTYPES = (dict, list)
+# the field type of each type of JSON value. bools are read as True and
+# False, which sqlite stores as 1 and 0
+VALUETYPES = {bool: 'INTEGER', int: 'INTEGER', long: 'INTEGER',
+              float: 'REAL', unicode: 'TEXT', str: 'TEXT',
+              dict: 'TEXT', list: 'TEXT'}
+
+
+class JSONLData(table.Table):
+    """Reads and writes JSON Lines files one record at a time."""
+    def __init__(self, filename, tablename=None, mode='r'):
+        super(JSONLData, self).__init__(filename, tablename)
+        self.fieldattrorder = ['Name', 'Value']
+        self.namelenlimit = None
+        # records read to detect the fields, set by the FileManager
+        self.samplerows = SAMPLEROWS
+        # (field names, field types), read from the sample when first needed
+        self.schema = None
+        self.outputfile = None
+        # names of the output fields, in the order of their values in rows
+        self.fieldnames = []
+        # each output line, with a %s for the JSON of each value
+        self.linetemplate = None
+        # used for nested values that are read, and by encodevalue()
+        self.encode = json.JSONEncoder(separators=(',', ':'),
+                                       default=unicode).encode
+        if mode == 'r':
+            # check that the first record is an object
+            with open(self.filename, 'rb') as inputfile:
+                for line in inputfile:
+                    if line.strip():
+                        if not isinstance(json.loads(line), dict):
+                            raise table.InvalidDataError
+                        break
+
+    def _getschema(self):
+        """Get the field names and types from a sample of the records."""
+        if self.schema is not None:
+            return self.schema
+        fieldtypes = OrderedDict()
+        with open(self.filename, 'rb', BUFFERSIZE) as inputfile:
+            lines = (line for line in inputfile if line.strip())
+            if self.samplerows:
+                lines = itertools.islice(lines, self.samplerows)
+            for line in lines:
+                record = json.loads(line, object_pairs_hook=OrderedDict)
+                for key, value in record.iteritems():
+                    valuetype = VALUETYPES.get(type(value))
+                    currenttype = fieldtypes.get(key)
+                    # nulls could be any type
+                    if valuetype is None or valuetype == currenttype:
+                        fieldtypes.setdefault(key, None)
+                    elif currenttype is None:
+                        fieldtypes[key] = valuetype
+                    # fields step down in type, from integer, to real, to
+                    # text
+                    elif set((valuetype, currenttype)) == set(('INTEGER',
+                                                               'REAL')):
+                        fieldtypes[key] = 'REAL'
+                    else:
+                        fieldtypes[key] = 'TEXT'
+        self.schema = (fieldtypes.keys(),
+                       [fieldtype or 'TEXT'
+                        for fieldtype in fieldtypes.values()])
+        return self.schema
+
+    def getfields(self):
+        """Get the fields from the sample of records."""
+        fieldnames, fieldtypes = self._getschema()
+        fieldlist = []
+        for fieldname, fieldtype in zip(fieldnames, fieldtypes):
+            newfield = field.Field(fieldname, {'type': fieldtype},
+                                   namelen=None)
+            fieldlist.append(newfield)
+        return fieldlist
+
+    def setfields(self, newfields):
+        """Start the output file. Used before any records are added."""
+        self.fieldnames = [newfield.name for newfield in newfields]
+        keys = [json.dumps(fieldname).replace('%', '%%')
+                for fieldname in self.fieldnames]
+        self.linetemplate = '{' + ','.join([key + ':%s'
+                                            for key in keys]) + '}'
+        self.outputfile = open(self.filename, 'wb', BUFFERSIZE)
+
+    def encodevalue(self, value):
+        """Get the JSON of an output value.
+
+        Byte strings that aren't utf-8 are decoded as cp1252, which most
+        dbf and csv files in other encodings are. nan and inf are null."""
+        valuetype = type(value)
+        if valuetype is str:
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                value = value.decode('cp1252', 'replace')
+        elif valuetype is float and value - value != 0:
+            return 'null'
+        return self.encode(value)
+
+    def addrecord(self, newrecord):
+        """Append a new record to the file."""
+        # missing values are null
+        self.addrow([newrecord.get(fieldname)
+                     for fieldname in self.fieldnames])
+
+    def addrow(self, row):
+        """Append a new record, given as a row, to the file."""
+        self.outputfile.write(self.linetemplate %
+                              tuple(map(self.encodevalue, row)) + '\n')
+
+    def addrows(self, rows):
+        """Append several records, given as rows, in one write."""
+        encodevalue = self.encodevalue
+        linetemplate = self.linetemplate
+        lines = [linetemplate % tuple(map(encodevalue, row)) for row in rows]
+        if lines:
+            self.outputfile.write('\n'.join(lines) + '\n')
+
+    def getsize(self):
+        """Get the number of bytes written, including any still buffered."""
+        return self.outputfile.tell()
+
+    def close(self):
+        """Close the output file, if this was an output file."""
+        if self.outputfile is not None:
+            self.outputfile.close()
+            self.outputfile = None
+
+    @classmethod
+    def convertfield(cls, unknownfield):
+        """Convert a field of unknown type to a JSON Lines field."""
+        jsonlfield = unknownfield.copy()
+        # strip the attributes
+        jsonlfield.attributes = {}
+        jsonlfield.namelenlimit = None
+        jsonlfield.resetname()
+        return jsonlfield
+
+    @classmethod
+    def getfieldtypes(cls):
+        """Return a list of field types to populate a combo box."""
+        return ['TEXT']
+
+    @classmethod
+    def getblankvalue(cls, _outputfield):
+        """Return null as the blank value for any field."""
+        return None
+
+    @classmethod
+    def getrecordcount(cls):
+        """Counting the lines of the file isn't worthwhile."""
+        return None
+
+    def backup(self):
+        """Rename the file to filename.jsonl.old"""
+        backupcount = 1
+        backupname = self.filename + '.old'
+        backupnamelen = len(backupname)
+        # don't overwrite existing backups, if any
+        while os.path.isfile(backupname):
+            backupname = backupname[:backupnamelen] + str(backupcount)
+            backupcount += 1
+        os.rename(self.filename, backupname)
+
+    def readrows(self):
+        """Iterate through the records as tuples, in field order."""
+        fieldnames = self._getschema()[0]
+        loads = json.loads
+        encode = self.encode
+        with open(self.filename, 'rb', BUFFERSIZE) as inputfile:
+            for line in inputfile:
+                # skip blank lines
+                if not line.strip():
+                    continue
+                values = map(loads(line).get, fieldnames)
+                yield tuple([encode(value)
+                             if type(value) in NESTEDTYPES else value
+                             for value in values])
+
+    def __iter__(self):
+        fieldnames = self._getschema()[0]
+        for row in self.readrows():
+            yield dict(zip(fieldnames, row))
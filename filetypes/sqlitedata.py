@@ -21,6 +21,14 @@ import os
 import table
 import field
 
+# rows written to an output table between commits
+COMMITINTERVAL = 100000
+# used for the output connection while records are written, only if the
+# output created the database. a crash during the output can leave the
+# database corrupt, not just the output table
+OUTPUTPRAGMAS = ['PRAGMA synchronous = OFF',
+                 'PRAGMA journal_mode = MEMORY']
+
 
 class SQLiteData(table.Table):
     """Handle all input and output for SQLite databases."""
@@ -58,6 +66,13 @@ class SQLiteData(table.Table):
         # connection/cursor used for insert queries, closed by self.close()
         self.conn = None
         self.cur = None
+        # rows inserted since the last commit
+        self.uncommitted = 0
+        # fields to index once the records are written
+        self.indexfields = []
+        # if the output creates the database, so there's nothing to lose if
+        # the database is corrupted
+        self.newfile = mode == 'w' and not os.path.isfile(self.filename)
         self.namelenlimit = None
 
     # converts fields to universal types
@@ -98,22 +113,41 @@ class SQLiteData(table.Table):
         # combine them into one string
         # ex: 'itemID INTEGER, itemName TEXT'
         fieldstr = ', '.join(fieldlist)
-        # connect to the database
+        # connect to the database, the same connection is used for output
+        self._connect()
+        # create the table
+        try:
+            self.cur.execute('CREATE TABLE ' + self.tablename +
+                             '(' + fieldstr + ')')
+        # table exists. improbable for a different error to occur
+        except sqlite3.OperationalError:
+            if overwrite:
+                self.cur.execute('DROP TABLE ' + self.tablename)
+                self.cur.execute('CREATE TABLE ' + self.tablename +
+                                 '(' + fieldstr + ')')
+            else:
+                self.close()
+                raise table.TableExistsError
+        self.conn.commit()
+        self._initinsertquery(newfields)
+
+    def tableexists(self):
+        """Check if the database already has the table."""
+        if not os.path.isfile(self.filename):
+            return False
         with sqlite3.connect(self.filename) as conn:
             cur = conn.cursor()
-            # create the table
-            try:
-                cur.execute('CREATE TABLE ' + self.tablename +
-                            '(' + fieldstr + ')')
-            # table exists. improbable for a different error to occur
-            except sqlite3.OperationalError:
-                if overwrite:
-                    cur.execute('DROP TABLE ' + self.tablename)
-                    conn.commit()
-                    cur.execute('CREATE TABLE ' + self.tablename +
-                                '(' + fieldstr + ')')
-                else:
-                    raise table.TableExistsError
+            cur.execute("SELECT name FROM sqlite_master "
+                        "WHERE type='table' AND name=?", (self.tablename,))
+            return cur.fetchone() is not None
+
+    def reopen(self, newfields):
+        """Continue writing to the table after the file was closed."""
+        self.fieldnames = [newfield.name for newfield in newfields]
+        self._initinsertquery(newfields)
+
+    def _initinsertquery(self, newfields):
+        """Init the query used to insert records."""
         # init the string of ?'s used for insertion queries
         qmarklist = []
         for _counter in range(len(newfields)):
@@ -122,18 +156,54 @@ class SQLiteData(table.Table):
         self.insertquery = ('INSERT INTO ' + self.tablename +
                             ' VALUES (' + qmarks + ');')
 
-    def addrecord(self, newrecord):
-        """Write a record (stored as a dictionary) to the output file."""
-        if self.cur is None:
+    def _connect(self):
+        """Open the connection used for output, if it isn't open."""
+        if self.conn is None:
             self.conn = sqlite3.connect(self.filename)
             self.cur = self.conn.cursor()
-        values = [newrecord[fn] for fn in self.fieldnames]
-        self.cur.execute(self.insertquery, values)
+            if self.newfile:
+                for pragma in OUTPUTPRAGMAS:
+                    self.cur.execute(pragma)
+            self.uncommitted = 0
+
+    def addindex(self, fieldname):
+        """Index an output field, after all the records are written."""
+        self.indexfields.append(fieldname)
+
+    def addrecord(self, newrecord):
+        """Write a record (stored as a dictionary) to the output file."""
+        self.addrow([newrecord[fn] for fn in self.fieldnames])
+
+    def addrow(self, row):
+        """Write a record, given as a row, to the output file."""
+        self._connect()
+        self.cur.execute(self.insertquery, row)
+        self.uncommitted += 1
+        if self.uncommitted >= COMMITINTERVAL:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def addrows(self, rows):
+        """Write several records, given as rows, to the output file."""
+        self._connect()
+        for batch in table.batches(rows):
+            self.cur.executemany(self.insertquery, batch)
+            self.uncommitted += len(batch)
+            if self.uncommitted >= COMMITINTERVAL:
+                self.conn.commit()
+                self.uncommitted = 0
 
     def close(self):
         """Close the open file, if any."""
         if self.conn is not None:
             self.conn.commit()
+            # indexing once is faster than updating the index for each record
+            for fieldname in self.indexfields:
+                self.cur.execute('CREATE INDEX IF NOT EXISTS ' +
+                                 self.tablename + '_' + fieldname +
+                                 '_index ON ' + self.tablename + '(' +
+                                 fieldname + ')')
+            self.conn.commit()
             self.conn.close()
             self.cur = None
             self.conn = None
@@ -192,6 +262,21 @@ class SQLiteData(table.Table):
                         " RENAME TO " + backupname)
             conn.commit()
 
+    def readrows(self):
+        """Get the records from an input file as tuples."""
+        if self.fields:
+            # in the same order as the fields, whatever order the table has.
+            # quoted in case a name is a keyword, like CAST or CURRENT_TIME
+            columns = ', '.join(['"' + fieldname.replace('"', '""') + '"'
+                                 for fieldname in self.fields])
+        else:
+            columns = '*'
+        with sqlite3.connect(self.filename) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT ' + columns + ' FROM ' + self.tablename)
+            for row in cur:
+                yield row
+
     def __iter__(self):
         """Get the records from an input file in sequence."""
         # connect to the database
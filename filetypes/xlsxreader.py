@@ -0,0 +1,291 @@
+"""XLSXReader streams the rows of .xlsx sheets as they're parsed.
+
+xlrd reads a whole .xlsx sheet into memory before any of it can be used.
+This parses the sheet's xml incrementally and throws each row away once it's
+been yielded, so memory use doesn't depend on the size of the sheet. The
+values are the same as xlrd's row_values(): numbers (including dates) are
+floats, booleans are 1 or 0, and empty cells are ''. The cell types can be
+read the same way, as xlrd's XL_CELL_* numbers.
+"""
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+from collections import OrderedDict
+import re
+import zipfile
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+MAINNS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELNS = ('{http://schemas.openxmlformats.org/officeDocument/2006/'
+         'relationships}')
+PACKAGERELNS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+CELLREFPATTERN = re.compile(r'([A-Z]+)(\d+)$')
+RANGEPATTERN = re.compile(r'[A-Z]*(\d+)$')
+# cell types, the same numbers as xlrd's XL_CELL_* constants
+EMPTY, TEXT, NUMBER, DATE, BOOLEAN, ERROR = range(6)
+# built in number formats that show a date or time
+DATEFORMATIDS = set(range(14, 23) + range(45, 48))
+# parts of a number format that aren't date codes: quoted or escaped text,
+# and bracketed colors, locales and conditions
+FORMATTEXTPATTERN = re.compile(r'"[^"]*"|\\.|\[[^\]]*\]')
+DATECODEPATTERN = re.compile(r'[dmyhs]', re.IGNORECASE)
+
+
+def getcolumnindex(cellref):
+    """Get the index of a cell's column from a reference like 'AB12'."""
+    letters = CELLREFPATTERN.match(cellref).group(1)
+    colindex = 0
+    for letter in letters:
+        colindex = colindex * 26 + ord(letter) - ord('A') + 1
+    return colindex - 1
+
+
+class XLSXReader(object):
+    """Reads the sheets of an .xlsx workbook one row at a time."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.zipfile = zipfile.ZipFile(filename)
+        # member names are case-insensitive
+        self.membernames = {}
+        for membername in self.zipfile.namelist():
+            self.membernames[membername.lower()] = membername
+        # 1 if dates count from 1904 instead of 1900, like xlrd's datemode
+        self.datemode = 0
+        # sheetparts[sheet name] = name of the sheet's xml file in the zip
+        self.sheetparts = OrderedDict()
+        self._readworkbook()
+        # read when the first row is
+        self.sharedstrings = None
+        # indices of the cell styles that format numbers as dates, read when
+        # the first cell types are
+        self.datestyles = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_excinfo):
+        self.close()
+
+    def close(self):
+        """Close the workbook file."""
+        self.zipfile.close()
+
+    # the same as xlrd's Book
+    release_resources = close
+
+    def _openmember(self, membername):
+        """Open a file within the workbook, or return None if it's missing."""
+        membername = self.membernames.get(membername.lower())
+        if membername is None:
+            return None
+        return self.zipfile.open(membername)
+
+    def _readworkbook(self):
+        """Find the sheet names, their xml files, and the date mode."""
+        # relationship ids of the sheets, and the files they refer to
+        targets = {}
+        relsfile = self._openmember('xl/_rels/workbook.xml.rels')
+        for element in ElementTree.parse(relsfile).getroot():
+            if element.tag == PACKAGERELNS + 'Relationship':
+                target = element.get('Target')
+                if target.startswith('/'):
+                    targets[element.get('Id')] = target[1:]
+                else:
+                    targets[element.get('Id')] = 'xl/' + target
+        workbook = ElementTree.parse(self._openmember('xl/workbook.xml'))
+        workbookpr = workbook.find(MAINNS + 'workbookPr')
+        if (workbookpr is not None and
+                workbookpr.get('date1904') in ('1', 'true')):
+            self.datemode = 1
+        for sheet in workbook.getroot().iter(MAINNS + 'sheet'):
+            self.sheetparts[sheet.get('name')] = targets[
+                sheet.get(RELNS + 'id')]
+
+    def _readsharedstrings(self):
+        """Read the table of strings that cells refer to by index."""
+        self.sharedstrings = []
+        stringsfile = self._openmember('xl/sharedStrings.xml')
+        if stringsfile is None:
+            return
+        for _event, element in ElementTree.iterparse(stringsfile):
+            if element.tag == MAINNS + 'si':
+                self.sharedstrings.append(self._gettext(element))
+                element.clear()
+
+    @classmethod
+    def _gettext(cls, element):
+        """Get the text of a string element, leaving out phonetic runs."""
+        texts = []
+        for child in element:
+            if child.tag == MAINNS + 't':
+                texts.append(child.text or u'')
+            elif child.tag == MAINNS + 'r':
+                for run in child.iter(MAINNS + 't'):
+                    texts.append(run.text or u'')
+        return u''.join(texts)
+
+    def _readstyles(self):
+        """Find the cell styles whose number formats are dates."""
+        self.datestyles = set()
+        stylesfile = self._openmember('xl/styles.xml')
+        if stylesfile is None:
+            return
+        styles = ElementTree.parse(stylesfile).getroot()
+        dateformatids = set(DATEFORMATIDS)
+        numfmts = styles.find(MAINNS + 'numFmts')
+        if numfmts is not None:
+            for numfmt in numfmts:
+                formatcode = FORMATTEXTPATTERN.sub(
+                    '', numfmt.get('formatCode', ''))
+                if DATECODEPATTERN.search(formatcode):
+                    dateformatids.add(int(numfmt.get('numFmtId')))
+        cellxfs = styles.find(MAINNS + 'cellXfs')
+        if cellxfs is not None:
+            for styleindex, xf in enumerate(cellxfs):
+                if int(xf.get('numFmtId', 0)) in dateformatids:
+                    self.datestyles.add(styleindex)
+
+    def sheet_names(self):
+        """Get the names of the sheets, like xlrd's Book.sheet_names()."""
+        return self.sheetparts.keys()
+
+    def getrowcount(self, sheetname):
+        """Get the number of rows from the sheet's dimensions, if it has them.
+
+        Only the start of the sheet is parsed. Returns None if the sheet
+        doesn't give its dimensions."""
+        sheetfile = self._openmember(self.sheetparts[sheetname])
+        for _event, element in ElementTree.iterparse(sheetfile,
+                                                     events=('start',)):
+            if element.tag == MAINNS + 'dimension':
+                match = RANGEPATTERN.search(element.get('ref', ''))
+                if match:
+                    return int(match.group(1))
+                return None
+            elif element.tag == MAINNS + 'sheetData':
+                return None
+        return None
+
+    def iterrows(self, sheetname):
+        """Iterate through the rows of a sheet, as lists of values.
+
+        Rows that are missing from the file (because they're empty) are
+        yielded as empty lists, so the position of every row is kept."""
+        if self.sharedstrings is None:
+            self._readsharedstrings()
+        for rowelement in self._iterrowelements(sheetname):
+            if rowelement is None:
+                yield []
+            else:
+                yield self._getrowvalues(rowelement)
+
+    def iterrowtypes(self, sheetname):
+        """Iterate through the rows of a sheet, as lists of cell types.
+
+        Like xlrd's row_types(), numbers formatted as dates are DATE."""
+        if self.datestyles is None:
+            self._readstyles()
+        for rowelement in self._iterrowelements(sheetname):
+            if rowelement is None:
+                yield []
+            else:
+                yield self._getrowtypes(rowelement)
+
+    def _iterrowelements(self, sheetname):
+        """Iterate through the row elements of a sheet, None for gaps.
+
+        Each element is cleared after it's been used."""
+        sheetfile = self._openmember(self.sheetparts[sheetname])
+        rowtag = MAINNS + 'row'
+        nextrow = 1
+        sheetdata = None
+        for event, element in ElementTree.iterparse(sheetfile,
+                                                    events=('start', 'end')):
+            if event == 'start':
+                if element.tag == MAINNS + 'sheetData':
+                    sheetdata = element
+                continue
+            if element.tag != rowtag:
+                continue
+            rownumber = int(element.get('r', nextrow))
+            while nextrow < rownumber:
+                yield None
+                nextrow += 1
+            yield element
+            nextrow += 1
+            # rows that have been used don't need to be kept
+            if sheetdata is not None:
+                sheetdata.clear()
+
+    def _getrowvalues(self, rowelement):
+        """Get the values of the cells in a row element."""
+        rowvalues = []
+        for cell in rowelement:
+            cellref = cell.get('r')
+            if cellref is not None:
+                colindex = getcolumnindex(cellref)
+                # missing cells are empty
+                if colindex > len(rowvalues):
+                    rowvalues.extend([''] * (colindex - len(rowvalues)))
+            celltype = cell.get('t', 'n')
+            if celltype == 'inlineStr':
+                inlinestring = cell.find(MAINNS + 'is')
+                if inlinestring is None:
+                    rowvalues.append('')
+                else:
+                    rowvalues.append(self._gettext(inlinestring))
+                continue
+            value = cell.findtext(MAINNS + 'v')
+            if value is None:
+                rowvalues.append('')
+            elif celltype == 'n':
+                rowvalues.append(float(value))
+            elif celltype == 's':
+                rowvalues.append(self.sharedstrings[int(value)])
+            elif celltype == 'b':
+                rowvalues.append(int(value))
+            else:
+                # formula strings, error codes like #N/A and iso dates
+                rowvalues.append(value)
+        return rowvalues
+
+    def _getrowtypes(self, rowelement):
+        """Get the types of the cells in a row element."""
+        rowtypes = []
+        for cell in rowelement:
+            cellref = cell.get('r')
+            if cellref is not None:
+                colindex = getcolumnindex(cellref)
+                if colindex > len(rowtypes):
+                    rowtypes.extend([EMPTY] * (colindex - len(rowtypes)))
+            celltype = cell.get('t', 'n')
+            if celltype == 'inlineStr':
+                rowtypes.append(TEXT)
+            elif cell.find(MAINNS + 'v') is None:
+                rowtypes.append(EMPTY)
+            elif celltype == 'n':
+                if int(cell.get('s', 0)) in self.datestyles:
+                    rowtypes.append(DATE)
+                else:
+                    rowtypes.append(NUMBER)
+            elif celltype == 'b':
+                rowtypes.append(BOOLEAN)
+            elif celltype == 'e':
+                rowtypes.append(ERROR)
+            else:
+                rowtypes.append(TEXT)
+        return rowtypes
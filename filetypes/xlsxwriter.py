@@ -0,0 +1,200 @@
+"""XLSXWriter streams rows into an .xlsx workbook.
+
+Rows are written to a temporary xml file for each sheet as they're added, so
+memory use doesn't depend on the size of the output. The workbook is zipped
+together from those files by close(). Strings are written inline instead of
+in a shared strings table, which would have to be kept in memory. When a
+sheet is full, the rest of the rows go on a new sheet, which starts with the
+field names again.
+"""
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+import os
+import re
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+# including the row of field names
+MAXROWS = 1048576
+# longest name Excel allows for a sheet
+MAXSHEETNAMELEN = 31
+# characters that aren't allowed in xml, even escaped
+INVALIDXMLPATTERN = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+# buffer size of the temporary sheet files
+SHEETBUFFERSIZE = 1024 * 1024
+
+CONTENTTYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+    'content-types"><Default Extension="rels" ContentType="application/'
+    'vnd.openxmlformats-package.relationships+xml"/><Default Extension="xml" '
+    'ContentType="application/xml"/><Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.'
+    'spreadsheetml.sheet.main+xml"/>%s</Types>')
+SHEETCONTENTTYPE = (
+    '<Override PartName="/xl/worksheets/sheet%d.xml" ContentType="'
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet'
+    '+xml"/>')
+PACKAGERELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+    'relationships"><Relationship Id="rId1" Type="http://schemas.'
+    'openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/></Relationships>')
+WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/'
+    'main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/'
+    'relationships"><sheets>%s</sheets></workbook>')
+WORKBOOKSHEET = '<sheet name=%s sheetId="%d" r:id="rId%d"/>'
+WORKBOOKRELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+    'relationships">%s</Relationships>')
+WORKBOOKSHEETREL = (
+    '<Relationship Id="rId%d" Type="http://schemas.openxmlformats.org/'
+    'officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet%d.xml"/>')
+SHEETSTART = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/'
+    'main"><sheetData>')
+SHEETEND = '</sheetData></worksheet>'
+
+
+def getsheetname(tablename, sheetnumber):
+    """Get the name of a sheet: tablename, then tablename_2, tablename_3..."""
+    if sheetnumber == 1:
+        return tablename[:MAXSHEETNAMELEN]
+    suffix = '_' + str(sheetnumber)
+    return tablename[:MAXSHEETNAMELEN - len(suffix)] + suffix
+
+
+class XLSXWriter(object):
+    """Writes rows to an .xlsx file, one sheet at a time."""
+    def __init__(self, filename, tablename, maxrows=MAXROWS):
+        self.filename = filename
+        self.tablename = tablename
+        self.maxrows = maxrows
+        self.fieldnames = []
+        # (sheet name, temporary file path) of each finished sheet
+        self.sheets = []
+        # the sheet being written
+        self.sheetfile = None
+        self.sheetpath = None
+        self.rowcount = 0
+
+    def setfields(self, fieldnames):
+        """Start the first sheet with a row of field names."""
+        self.fieldnames = list(fieldnames)
+        self._startsheet()
+
+    def _startsheet(self):
+        """Open a temporary file for the next sheet's xml."""
+        filehandle, self.sheetpath = tempfile.mkstemp(suffix='.xml')
+        self.sheetfile = os.fdopen(filehandle, 'wb', SHEETBUFFERSIZE)
+        self.sheetfile.write(SHEETSTART)
+        self.rowcount = 0
+        self.addrow(self.fieldnames)
+
+    def _finishsheet(self):
+        """Close the xml of the current sheet."""
+        self.sheetfile.write(SHEETEND)
+        self.sheetfile.close()
+        self.sheets.append((getsheetname(self.tablename,
+                                         len(self.sheets) + 1),
+                            self.sheetpath))
+        self.sheetfile = None
+
+    def addrow(self, row):
+        """Write a row of values to the current sheet."""
+        if self.rowcount >= self.maxrows:
+            self._finishsheet()
+            self._startsheet()
+        self.rowcount += 1
+        cells = [self._getcell(value) for value in row]
+        self.sheetfile.write('<row r="%d">%s</row>' % (self.rowcount,
+                                                      ''.join(cells)))
+
+    def addrows(self, rows):
+        """Write several rows."""
+        for row in rows:
+            self.addrow(row)
+
+    @classmethod
+    def _getcell(cls, value):
+        """Get the xml of a cell holding a value, as utf-8."""
+        valuetype = type(value)
+        if value is None or value == '':
+            return '<c/>'
+        if valuetype is bool:
+            return '<c t="b"><v>%d</v></c>' % value
+        if valuetype in (int, long):
+            return '<c><v>%d</v></c>' % value
+        # nan and inf can't be stored as numbers
+        if valuetype is float and value - value == 0:
+            return '<c><v>%r</v></c>' % value
+        if valuetype is str:
+            value = value.decode('utf-8', 'replace')
+        elif valuetype is not unicode:
+            value = unicode(value)
+        value = INVALIDXMLPATTERN.sub(u'', value)
+        return ('<c t="inlineStr"><is><t xml:space="preserve">' +
+                escape(value).encode('utf-8') + '</t></is></c>')
+
+    def getsize(self):
+        """Get the size of the sheets written so far, before compression."""
+        size = sum([os.path.getsize(sheetpath)
+                    for _sheetname, sheetpath in self.sheets])
+        if self.sheetfile is not None:
+            size += self.sheetfile.tell()
+        return size
+
+    def close(self):
+        """Zip the sheets into the workbook."""
+        if self.sheetfile is None:
+            return
+        self._finishsheet()
+        sheetnumbers = range(1, len(self.sheets) + 1)
+        workbooksheets = []
+        for number, (sheetname, _sheetpath) in zip(sheetnumbers, self.sheets):
+            if isinstance(sheetname, unicode):
+                sheetname = sheetname.encode('utf-8')
+            workbooksheets.append(WORKBOOKSHEET % (quoteattr(sheetname),
+                                                   number, number))
+        try:
+            # sheets over 2GB need zip64
+            with zipfile.ZipFile(self.filename, 'w', zipfile.ZIP_DEFLATED,
+                                 allowZip64=True) as workbook:
+                workbook.writestr('[Content_Types].xml',
+                                  CONTENTTYPES % ''.join(
+                                      [SHEETCONTENTTYPE % number
+                                       for number in sheetnumbers]))
+                workbook.writestr('_rels/.rels', PACKAGERELS)
+                workbook.writestr('xl/workbook.xml',
+                                  WORKBOOK % ''.join(workbooksheets))
+                workbook.writestr('xl/_rels/workbook.xml.rels',
+                                  WORKBOOKRELS % ''.join(
+                                      [WORKBOOKSHEETREL % (number, number)
+                                       for number in sheetnumbers]))
+                for number, (_sheetname, sheetpath) in zip(sheetnumbers,
+                                                          self.sheets):
+                    workbook.write(sheetpath,
+                                   'xl/worksheets/sheet%d.xml' % number)
+        finally:
+            for _sheetname, sheetpath in self.sheets:
+                os.remove(sheetpath)
+            self.sheets = []
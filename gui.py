@@ -259,7 +259,8 @@ class GUI(object):
                 newcolumn = gtk.TreeViewColumn(colname, newcell, text=i)
             view.append_column(newcolumn)
 
-    def initconfiginputwindow(self, fieldnames, fieldvalues, fieldtypes):
+    def initconfiginputwindow(self, fieldnames, fieldvalues, fieldtypes,
+                              detectedtypes=None):
         dialog = gtk.Dialog('Define input', self['mainwindow'],
                             gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
                             (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
@@ -312,6 +313,10 @@ class GUI(object):
             inputfieldtypecombo.add_attribute(cell=inputtypecell,
                                               attribute='text',
                                               column=0)
+            # start with the detected type selected
+            if detectedtypes is not None:
+                inputfieldtypecombo.set_active(
+                    fieldtypes.index(detectedtypes[i]))
             self.typecomboboxes.append(inputfieldtypecombo)
             # pack the two main objects
             inputfieldvbox.pack_start(inputfieldview, expand=True)
@@ -69,15 +69,18 @@ class GUI_FieldView(object):
             joinquery = self.joins.getquery()
             # open the database
             conn = sqlite3.connect('temp.db')
-            conn.row_factory = sqlite3.Row
             cur = conn.cursor()
             recordcount = self.joins.getrecordcount()
             i = 0
+            cur.execute(joinquery)
+            self.calc.compileoutput([column[0] for column in cur.description])
+            outputnames = self.calc.outputbodies.keys()
             # calculate all the outputs to find the max lengths
-            for inputvalues in cur.execute(joinquery):
-                outputvalues = self.calc.calculateoutput(inputvalues)
+            for inputvalues in cur:
+                outputvalues = self.calc.calculaterecord(inputvalues)
                 # compare outputvalues to find the longest for each
-                for fieldname, fieldvalue in outputvalues:
+                for fieldname, fieldvalue in zip(outputnames,
+                                                 outputvalues):
                     if fieldname in newlengths:
                         newlengths[fieldname] = max(newlengths[fieldname],
                                                     len(fieldvalue))
@@ -121,8 +121,9 @@ class GUI_Files(object):
         self.gui['tabledialog'].response(1)
 
     def clarifyfieldtypes(self, filename, fielddata, tablename=None):
-        fieldnames, fieldvalues, fieldtypes = fielddata
-        dialog = self.gui.initconfiginputwindow(fieldnames, fieldvalues, fieldtypes)
+        fieldnames, fieldvalues, fieldtypes, detectedtypes = fielddata
+        dialog = self.gui.initconfiginputwindow(fieldnames, fieldvalues,
+                                                fieldtypes, detectedtypes)
         response = dialog.run()
         dialog.destroy()
         if response == gtk.RESPONSE_OK:
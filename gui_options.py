@@ -25,6 +25,7 @@ class GUI_Options(object):
         """Load all the settings from the config file into the gui."""
         self.gui['defaultoutputentry'].set_text(self.options['default_output_dir'])
         self.gui['extrafieldlengthspin'].set_value(self.options['extra_field_length'])
+        self.gui['profilecheckbox'].set_active(self.options['profile_calculations'])
         self.gui['optionswindow'].show_all()
 
     def saveoptions(self, _widget, _data=None):
@@ -36,6 +37,8 @@ class GUI_Options(object):
         extrafieldlengthspin.update()
         self.options['extra_field_length'] = extrafieldlengthspin.get_value_as_int()
         print 'extra_field_length:', self.options['extra_field_length']
+        # Print where the time goes when calculating output
+        self.options['profile_calculations'] = self.gui['profilecheckbox'].get_active()
         self.options.saveoptions()
 
     def savecloseoptions(self, _widget, _data=None):
@@ -116,14 +116,49 @@ class JoinManager(object):
                 alljoins.extend(self.joins[filealias])
         return alljoins
 
-    def getquery(self, sampling=None, restrictjoins=False):
-        """Create an sql query string that will perform the join."""
+    @classmethod
+    def getsqlblanks(cls, blanks):
+        """Get the blank values that sqlite can fill in for missed joins.
+
+        blanks[input field name] = blank value, like Calculator.inputblanks.
+        Returns {input field name: sql literal} for the values that sqlite
+        returns unchanged, to pass to getquery()."""
+        sqlblanks = {}
+        for inputname in blanks:
+            blankvalue = blanks[inputname]
+            # bools would come back as ints, and large ints as floats
+            if type(blankvalue) in (int, long):
+                if -2 ** 63 <= blankvalue < 2 ** 63:
+                    sqlblanks[inputname] = str(blankvalue)
+            # nan and inf have no sql literal
+            elif type(blankvalue) is float:
+                if blankvalue - blankvalue == 0:
+                    sqlblanks[inputname] = repr(blankvalue)
+            elif type(blankvalue) in (str, unicode):
+                sqlblanks[inputname] = ("'" + blankvalue.replace("'", "''") +
+                                        "'")
+        return sqlblanks
+
+    def getquery(self, sampling=None, restrictjoins=False, blanks=None):
+        """Create an sql query string that will perform the join.
+
+        blanks is from getsqlblanks(). Null values of those fields, from
+        missed joins or in the tables, are replaced with the blank value."""
+        # input names are case-insensitive, like sqlite
+        sqlblanks = {}
+        if blanks is not None:
+            for inputname in blanks:
+                sqlblanks[inputname.upper()] = blanks[inputname]
         query = ['SELECT']
         selectfieldaliases = []
         # add fields from the target table
         for fieldname in self.targetdata.fields:
-            sqlname = (self.targetdata.sqlname + '.' +
-                       self.targetdata.fields[fieldname].sqlname)
+            fieldsqlname = self.targetdata.fields[fieldname].sqlname
+            sqlname = self.targetdata.sqlname + '.' + fieldsqlname
+            if fieldsqlname.upper() in sqlblanks:
+                sqlname = ('COALESCE(' + sqlname + ', ' +
+                           sqlblanks[fieldsqlname.upper()] + ') AS ' +
+                           fieldsqlname)
             selectfieldaliases.append(sqlname)
         # add fields from all the joined tables
         for curjoin in self.getjoins():
@@ -132,8 +167,11 @@ class JoinManager(object):
                 for fieldname in curjoin.jointable.fields:
                     sqlname = (curjoin.jointable.sqlname + '.' +
                                curjoin.jointable.fields[fieldname].sqlname)
-                    selectstr = (sqlname + ' AS ' +
-                                 curjoin.joinalias + '_' + fieldname)
+                    inputname = curjoin.joinalias + '_' + fieldname
+                    if inputname.upper() in sqlblanks:
+                        sqlname = ('COALESCE(' + sqlname + ', ' +
+                                   sqlblanks[inputname.upper()] + ')')
+                    selectstr = sqlname + ' AS ' + inputname
                     selectfieldaliases.append(selectstr)
         # add the target table rowid, used to check for extra records created
         # by a one-to-many left join, which causes problems in some circumstances
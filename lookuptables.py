@@ -0,0 +1,115 @@
+"""Code tables that output field expressions can look values up in.
+
+An expression like lookup('statecodes', 'CODE', 'NAME', !addr.state!) gives
+the NAME of the record in the statecodes file with that CODE, or None if
+there isn't one. The file has to be loaded, but doesn't need to be joined.
+
+Each (table, key field, value field) is read into a dict the first time it's
+used in a join, and shared by every field that uses it. When the table and
+field names are constants, the calculator binds the dict's get() method to
+the expression directly, so each lookup is just a dict lookup.
+"""
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+import sqlite3
+
+
+class LookupTables(object):
+    """Loads and caches the tables used by lookup()."""
+    def __init__(self, files):
+        # the FileManager, or anything that gives a Table for an alias
+        self.files = files
+        # tables[(Table, keyfield, valuefield)] = {key: value}
+        self.tables = {}
+
+    def clear(self):
+        """Forget the loaded tables, so they're read again when next used."""
+        self.tables = {}
+
+    def lookup(self, tablename, keyfield, valuefield, key, default=None):
+        """Get the value for a key from a table, or default if it's not there.
+
+        This is the function expressions call as lookup()."""
+        return self.gettable(tablename, keyfield, valuefield).get(key, default)
+
+    def gettable(self, tablename, keyfield, valuefield):
+        """Get the {key: value} dict for two fields of a table.
+
+        The table is referred to by its alias. Raises KeyError if the table
+        or either field doesn't exist."""
+        datatable = self.files[tablename]
+        if datatable is None:
+            raise KeyError('unknown table ' + tablename)
+        if not datatable.fields:
+            datatable.initfields()
+        keyfield = self._getfield(datatable, tablename, keyfield)
+        valuefield = self._getfield(datatable, tablename, valuefield)
+        tablekey = (datatable, keyfield.originalname, valuefield.originalname)
+        if tablekey not in self.tables:
+            self.tables[tablekey] = self._loadtable(datatable, keyfield,
+                                                    valuefield)
+        return self.tables[tablekey]
+
+    @classmethod
+    def _getfield(cls, datatable, tablename, fieldname):
+        """Find a field in a table, ignoring case like sqlite does."""
+        for originalname in datatable.fields:
+            if originalname.upper() == fieldname.upper():
+                return datatable.fields[originalname]
+        raise KeyError('unknown field ' + tablename + '.' + fieldname)
+
+    @classmethod
+    def _loadtable(cls, datatable, keyfield, valuefield):
+        """Read two fields of a table into a dict."""
+        if datatable.sqlname is not None:
+            # use the converted values, so they match the joined values
+            with sqlite3.connect('temp.db') as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT ' + keyfield.sqlname + ', ' +
+                            valuefield.sqlname + ' FROM ' + datatable.sqlname)
+                records = cur.fetchall()
+        else:
+            fieldnames = datatable.fields.keys()
+            keyindex = fieldnames.index(keyfield.originalname)
+            valueindex = fieldnames.index(valuefield.originalname)
+            # pass the values through a table with the same column types as
+            # convertdata() would use, so keys read as text, like those of
+            # csv files, are converted the same way as when they're joined
+            conn = sqlite3.connect(':memory:')
+            try:
+                cur = conn.cursor()
+                cur.execute('CREATE TABLE lookup (key ' +
+                            (keyfield.getattribute('type') or '') +
+                            ', value ' +
+                            (valuefield.getattribute('type') or '') + ')')
+                insertquery = 'INSERT INTO lookup VALUES (?, ?)'
+                for row in datatable.readrows():
+                    values = (row[keyindex], row[valueindex])
+                    try:
+                        cur.execute(insertquery, values)
+                    # on Windows it doesn't like ascii byte strings
+                    except sqlite3.ProgrammingError:
+                        cur.execute(insertquery,
+                                    [unicode(value) for value in values])
+                cur.execute('SELECT key, value FROM lookup')
+                records = cur.fetchall()
+            finally:
+                conn.close()
+        table = {}
+        # the first record with a key is used, like a restricted join
+        for key, value in records:
+            if key not in table:
+                table[key] = value
+        return table
@@ -15,16 +15,53 @@
 ##
 import json
 
+# values used for any option missing from the config file, so that a config
+# saved by an older version keeps working
+DEFAULT_OPTIONS = {'default_output_dir': '',
+                   'extra_field_length': 0,
+                   # start a new output file after this many records/bytes
+                   'shard_max_records': 0,
+                   'shard_max_bytes': 0,
+                   # output field used to route records to one file per value
+                   'shard_key_field': '',
+                   # how many shard files can be open at once
+                   'shard_max_open': 32,
+                   # calculate arithmetic output fields with numpy
+                   'vectorize_output': False,
+                   # errors in field calculations to show per field/error type
+                   'error_examples': 3,
+                   # stop the output after this many errors, 0 for no limit
+                   'error_limit': 0,
+                   # time each output field and library function
+                   'profile_calculations': False,
+                   # comma separated output fields to group records by
+                   'group_by_fields': '',
+                   # aggregate_functions[output field] = sum, count, min, max
+                   # or first (the default)
+                   'aggregate_functions': {},
+                   # groups kept in memory before spilling to temporary files
+                   'aggregate_max_groups': 100000,
+                   # comma separated output fields to index, for sqlite
+                   'output_index_fields': '',
+                   # records checked to detect Excel field types, 0 for all
+                   'excel_type_sample_rows': 0,
+                   # show the detected Excel field types to confirm them
+                   'excel_confirm_types': False,
+                   # records read to find the fields of JSON Lines files,
+                   # 0 for the whole file
+                   'jsonl_sample_rows': 1000}
+
 
 class OptionsManager(object):
     """docstring for Options"""
     def __init__(self):
         self.optionspath = 'averydb.config'
-        self.optionsdata = {}
+        self.optionsdata = dict(DEFAULT_OPTIONS)
 
     def loadoptions(self):
         optionsfile = open(self.optionspath)
-        self.optionsdata = json.load(optionsfile)
+        self.optionsdata = dict(DEFAULT_OPTIONS)
+        self.optionsdata.update(json.load(optionsfile))
 
     def saveoptions(self):
         optionsfile = open(self.optionspath, 'w')
@@ -13,8 +13,15 @@
 #   limitations under the License.
 ##
 # handles the initialization and configuration of the output
+import os
+import re
+from collections import OrderedDict
 
 import field
+import table
+
+# how many records are written to a shard between checks of its file size
+SIZECHECKINTERVAL = 1000
 
 
 class OutputManager(object):
@@ -40,6 +47,20 @@ class OutputManager(object):
             newfield = filehandler.convertfield(self.outputfields[fieldname])
             self.outputfields[fieldname] = newfield
 
+    def shardoutput(self, openshard, maxrecords=0, maxbytes=0, keyfield=None,
+                    maxopen=32, findshards=None):
+        """Split the output across several files of the output format.
+
+        openshard(shardname) is called to get a new file handler for each
+        shard that's needed. findshards() gets the names of the shards left
+        by an earlier output."""
+        # the single output file is replaced, and was never written to
+        if self.outputfile is not None:
+            self.outputfile.close()
+        self.outputfile = ShardedOutput(openshard, maxrecords, maxbytes,
+                                        keyfield, maxopen, findshards)
+        return self.outputfile
+
     def getoutputtype(self):
         """Returns the output file format."""
         return self.outputtype
@@ -140,3 +161,259 @@ class OutputManager(object):
 
     def __contains__(self, fieldname):
         return fieldname.upper() in self.outputfields
+
+
+class ShardedOutput(object):
+    """Stands in for an output file handler and writes to several files.
+
+    A new shard is started after maxrecords records or maxbytes bytes have
+    been written to the current one. If keyfield is set, records are also
+    routed to a separate shard for each value of that field, eg. one file per
+    county code. Only maxopen shards are kept open, when another is needed the
+    least recently used one is closed.
+
+    The size of a shard is taken from the handler's getsize() if it has one,
+    which counts output that's still buffered, otherwise from the size of the
+    file. .xls shards are only written when they're closed, so they can't be
+    split by size."""
+    def __init__(self, openshard, maxrecords=0, maxbytes=0, keyfield=None,
+                 maxopen=32, findshards=None):
+        """findshards() gets the names of the shards left by an earlier
+        output, which are replaced when the fields are set."""
+        self.openshard = openshard
+        self.findshards = findshards
+        self.maxrecords = maxrecords
+        self.maxbytes = maxbytes
+        self.keyfield = keyfield
+        self.maxopen = max(1, maxopen)
+        self.fields = None
+        self.overwrite = False
+        # position of the key field in rows, set by setfields
+        self.keyindex = None
+        # fields indexed in each shard, if the format supports it
+        self.indexfields = []
+        # openshards[shardname] = file handler, least recently used first
+        self.openshards = OrderedDict()
+        # number of records written to each shard
+        self.recordcounts = {}
+        # current part number for each key, incremented on rollover
+        self.partnumbers = {}
+        # names of all shards created, in the order they were created
+        self.shardnames = []
+        # keynames[key value] = the key's part of its shard names
+        self.keynames = {}
+        # lowercase names of the keys, and shardkeys[lowercase shard name] =
+        # key, so that no two are the same file on a case-insensitive file
+        # system
+        self.usedkeynames = set()
+        self.shardkeys = {}
+
+    def setfields(self, fields, overwrite=False):
+        """Store the field definitions, used whenever a shard is created.
+
+        Raises TableExistsError if a shard left by an earlier output already
+        has the table, unless overwrite is set, so that it's raised here
+        instead of partway through the output."""
+        self.close()
+        self.recordcounts = {}
+        self.partnumbers = {}
+        self.shardnames = []
+        self.keynames = {}
+        self.usedkeynames = set()
+        self.shardkeys = {}
+        self.fields = fields
+        self.overwrite = overwrite
+        if self.keyfield:
+            self.keyindex = [field.name for field in fields].index(
+                self.keyfield)
+        if overwrite or self.findshards is None:
+            return
+        for shardname in self.findshards():
+            shard = self.openshard(shardname)
+            try:
+                if hasattr(shard, 'tableexists') and shard.tableexists():
+                    raise table.TableExistsError
+            finally:
+                shard.close()
+
+    def addindex(self, fieldname):
+        """Index a field in each shard, after its records are written."""
+        self.indexfields.append(fieldname)
+
+    def addrecord(self, newrecord):
+        """Write a record to the shard it belongs in."""
+        self.addrow([newrecord[field.name] for field in self.fields])
+
+    def addrow(self, row):
+        """Write a record, given as a row, to the shard it belongs in."""
+        if self.keyfield:
+            key = self._getkeyname(row[self.keyindex])
+        else:
+            key = ''
+        shardname, shard = self._getshard(key)
+        shard.addrow(row)
+        self.recordcounts[shardname] += 1
+        # the size is only checked every so often
+        if self.recordcounts[shardname] % SIZECHECKINTERVAL == 0:
+            self._checkfull(key, shardname, shard, True)
+        else:
+            self._checkfull(key, shardname, shard, False)
+
+    def addrows(self, rows):
+        """Write several records given as rows, a batch per shard."""
+        if self.keyfield:
+            # groups[key] = rows, in the order the keys are first seen
+            groups = OrderedDict()
+            keyindex = self.keyindex
+            keynames = self.keynames
+            for row in rows:
+                key = row[keyindex]
+                if key in keynames:
+                    key = keynames[key]
+                else:
+                    key = self._getkeyname(key)
+                if key in groups:
+                    groups[key].append(row)
+                else:
+                    groups[key] = [row]
+        else:
+            groups = {'': list(rows)}
+        for key in groups:
+            grouprows = groups[key]
+            while grouprows:
+                shardname, shard = self._getshard(key)
+                # only as many as still fit in the shard
+                if self.maxrecords:
+                    room = self.maxrecords - self.recordcounts[shardname]
+                    batch = grouprows[:room]
+                    grouprows = grouprows[room:]
+                else:
+                    batch = grouprows
+                    grouprows = []
+                shard.addrows(batch)
+                self.recordcounts[shardname] += len(batch)
+                self._checkfull(key, shardname, shard, True)
+
+    def _checkfull(self, key, shardname, shard, checksize):
+        """Start a new part for a key if its current shard is full."""
+        if self.maxrecords and self.recordcounts[shardname] >= self.maxrecords:
+            self._rollover(key, shardname)
+        elif self.maxbytes and checksize:
+            size = self._getsize(shard)
+            if size is not None and size >= self.maxbytes:
+                self._rollover(key, shardname)
+
+    @classmethod
+    def _getsize(cls, shard):
+        """Get the number of bytes written to a shard, None if unknown."""
+        if hasattr(shard, 'getsize'):
+            return shard.getsize()
+        if os.path.isfile(shard.filename):
+            return os.path.getsize(shard.filename)
+        return None
+
+    def close(self):
+        """Close all the shards that are still open."""
+        for shardname in self.openshards:
+            self.openshards[shardname].close()
+        self.openshards = OrderedDict()
+
+    def _getkeyname(self, key):
+        """Get the name of a key value to use in its shards' filenames.
+
+        Characters that can't be used in a filename are replaced by _. If
+        that makes two values the same, ignoring case, the later one gets a
+        number added, like key-2."""
+        if key in self.keynames:
+            return self.keynames[key]
+        if isinstance(key, str):
+            cleankey = key.decode('utf-8', 'replace')
+        else:
+            cleankey = unicode(key)
+        cleankey = str(re.sub(r'[^a-zA-Z0-9_\-]', '_', cleankey.strip()))
+        if cleankey == '':
+            cleankey = 'blank'
+        keyname = cleankey
+        copynumber = 1
+        while keyname.lower() in self.usedkeynames:
+            copynumber += 1
+            keyname = cleankey + '-' + str(copynumber)
+        self.usedkeynames.add(keyname.lower())
+        self.keynames[key] = keyname
+        return keyname
+
+    def _getshardname(self, key):
+        """Name of the shard currently used for a key."""
+        namepieces = []
+        if key:
+            namepieces.append(key)
+        if key not in self.partnumbers:
+            self.partnumbers[key] = 0
+        # the first part for a key doesn't get a number, unless records are
+        # only split by size, in which case all the parts do
+        part = self.partnumbers[key]
+        if part > 0 or not key:
+            namepieces.append(str(part))
+        return '_'.join(namepieces)
+
+    def _getshard(self, key):
+        """Get the open file handler for a key, opening it if needed."""
+        while True:
+            shardname = self._getshardname(key)
+            # a part of another key can have the same name, like part 1 of
+            # a and the first part of a_1
+            if self.shardkeys.get(shardname.lower(), key) != key:
+                self.partnumbers[key] += 1
+                continue
+            shard = self._openshard(shardname)
+            if shard is not None:
+                self.shardkeys[shardname.lower()] = key
+                return shardname, shard
+            # it was closed and can't be continued, so use a new part
+            self.partnumbers[key] += 1
+
+    def _openshard(self, shardname):
+        """Get the open file handler of a shard, creating it if needed.
+
+        Returns None if the shard was closed to make room for others and its
+        format can't continue a file."""
+        if shardname in self.openshards:
+            # move it to the end, as the most recently used
+            shard = self.openshards.pop(shardname)
+            self.openshards[shardname] = shard
+            return shard
+        shard = self.openshard(shardname)
+        if shardname in self.recordcounts:
+            reopened = False
+            if hasattr(shard, 'reopen'):
+                # compressed csv files may not be able to append
+                try:
+                    shard.reopen(self.fields)
+                    reopened = True
+                except NotImplementedError:
+                    pass
+            if not reopened:
+                shard.close()
+                return None
+        else:
+            if self.overwrite:
+                shard.setfields(self.fields, overwrite=True)
+            else:
+                shard.setfields(self.fields)
+            self.recordcounts[shardname] = 0
+            self.shardnames.append(shardname)
+        # indexes are created when the shard is closed
+        if hasattr(shard, 'addindex'):
+            for fieldname in self.indexfields:
+                shard.addindex(fieldname)
+        # make room for it
+        if len(self.openshards) >= self.maxopen:
+            _oldname, oldshard = self.openshards.popitem(last=False)
+            oldshard.close()
+        self.openshards[shardname] = shard
+        return shard
+
+    def _rollover(self, key, shardname):
+        """Close the current shard for a key and start a new part."""
+        self.openshards.pop(shardname).close()
+        self.partnumbers[key] += 1
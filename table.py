@@ -12,9 +12,38 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 ##
+import itertools
 import sqlite3
 from collections import OrderedDict
 
+# number of rows in each list from readbatches()
+BATCHSIZE = 1000
+
+
+def getcolumns(fieldnames):
+    """Get the column of each field, if any field names are repeated.
+
+    fieldnames is the header of a file, in column order. A repeated name is
+    one field, in the position it first appears, with the value of its last
+    column, like csv.DictReader. Returns None if every name is different."""
+    if len(set(fieldnames)) == len(fieldnames):
+        return None
+    lastcolumns = {}
+    for column in xrange(len(fieldnames)):
+        lastcolumns[fieldnames[column]] = column
+    return [lastcolumns[fieldname]
+            for fieldname in OrderedDict.fromkeys(fieldnames)]
+
+
+def batches(rows, batchsize=BATCHSIZE):
+    """Split an iterable of rows into lists of up to batchsize rows."""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batchsize))
+        if not batch:
+            return
+        yield batch
+
 
 class Table(object):
     """Used to open, read and write all files of all supported types."""
@@ -69,28 +98,31 @@ class Table(object):
             i = 0
             insertquery = ('INSERT INTO ' + self.sqlname +
                            ' VALUES (' + qmarks + ');')
-            # insert each record from the input file
+            # insert the records from the input file a batch at a time
             useunicode = False
             # try:
-            for record in self:
+            for batch in self.readbatches():
                 if useunicode:
-                    values = [unicode(record[fn]) for fn in self.fields]
-                else:
-                    values = [record[fn] for fn in self.fields]
+                    batch = [[unicode(value) for value in values]
+                             for values in batch]
                 try:
-                    cur.execute(insertquery, values)
+                    cur.executemany(insertquery, batch)
                 # on Windows it doesn't like ascii byte strings
                 except sqlite3.ProgrammingError:
-                    values = [unicode(record[fn]) for fn in self.fields]
-                    cur.execute(insertquery, values)
+                    # remove the part of the batch that was inserted. the
+                    # table is new, so the rowids are the record numbers
+                    cur.execute('DELETE FROM ' + self.sqlname +
+                                ' WHERE rowid > ?', (i,))
+                    batch = [[unicode(value) for value in values]
+                             for values in batch]
+                    cur.executemany(insertquery, batch)
                     useunicode = True
-                i += 1
+                i += len(batch)
                 # Take a break so the gui can be used
-                if i % 250 == 0:
-                    if recordcount is None:
-                        yield 'pulse'
-                    else:
-                        yield float(i) / recordcount
+                if recordcount is None:
+                    yield 'pulse'
+                else:
+                    yield float(i) / recordcount
             # raised if the file is closed during conversion
             # except ValueError:
             #     cur.execute('DROP TABLE ' + self.sqlname)
@@ -109,6 +141,25 @@ class Table(object):
             # print query
             cur.execute(query)
 
+    # Records can also be read and written as rows: tuples of values in field
+    # order, which is the order of getfields() for input files and the order
+    # of the fields passed to setfields() for output files. Formats override
+    # readrows() and implement addrow() to skip building a dict per record.
+    def readrows(self):
+        """Iterate through the records as tuples of values in field order."""
+        fieldnames = self.fields.keys()
+        for record in self:
+            yield tuple([record[fieldname] for fieldname in fieldnames])
+
+    def readbatches(self, batchsize=BATCHSIZE):
+        """Iterate through the records as lists of up to batchsize rows."""
+        return batches(self.readrows(), batchsize)
+
+    def addrows(self, rows):
+        """Write several records given as rows."""
+        for row in rows:
+            self.addrow(row)
+
     # XXX call it getattributeorder() instead?
     def getattributenames(self):
         return self.fieldattrorder
@@ -0,0 +1,363 @@
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+import unittest
+import ast
+import os
+import sqlite3
+import sys
+import types
+# the calculator loads its libraries relative to the program directory
+PROGRAMDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PROGRAMDIR)
+
+import aggregator
+import calctools
+import calculator
+import exproptimizer
+import field
+import joinmanager
+import lookuptables
+
+INPUTNAMES = ['parcels_propid', 'parcels_name', 'values_land']
+
+
+class TestCalculator(unittest.TestCase):
+    def setUp(self):
+        self.startdir = os.getcwd()
+        os.chdir(PROGRAMDIR)
+        self.calc = calculator.Calculator()
+        self.calc.inputblanks = {'parcels_propid': 0, 'parcels_name': '',
+                                 'values_land': 0}
+
+    def createfuncs(self, fieldvalues):
+        for i in range(len(fieldvalues)):
+            self.calc.createoutputfunc({'name': 'field' + str(i),
+                                        'value': fieldvalues[i]})
+
+    def test_calculaterecord(self):
+        self.createfuncs(['!parcels.propid!',
+                          'propertyfrompropid(!parcels.propid!)',
+                          '!values.land! * 2 + !parcels.propid!',
+                          "'constant'"])
+        self.calc.compileoutput(INPUTNAMES)
+        self.assertEqual(self.calc.calculaterecord((12, 'a', 100)),
+                         (12, 'R0012', 212, 'constant'))
+        # missed joins get the blank value
+        self.assertEqual(self.calc.calculaterecord((12, 'a', None)),
+                         (12, 'R0012', 12, 'constant'))
+
+    def test_calculaterecord_errors(self):
+        self.createfuncs(['!parcels.propid!', '1 / !values.land!',
+                          '!parcels.missing!', 'nosuchfunction(1)',
+                          'math.nosuchfunction(1)', '(1'])
+        self.calc.compileoutput(INPUTNAMES)
+        outputvalues = self.calc.calculaterecord((12, 'a', 0))
+        self.assertEqual(outputvalues[:2], (12, '##ERROR##'))
+        # the rest are found when compiling
+        self.assertEqual(sorted(self.calc.compileerrors.keys()),
+                         ['field2', 'field3', 'field4', 'field5'])
+        self.assertEqual(outputvalues[2],
+                         '##ERROR: unknown input field parcels_missing##')
+        # errors while calculating are counted, with the inputs of the first
+        self.calc.calculaterecord((13, 'b', 0))
+        self.assertEqual(self.calc.errors.counts,
+                         {('field1', 'ZeroDivisionError'): 2})
+        self.assertEqual(self.calc.errors.examples[
+            ('field1', 'ZeroDivisionError')][0][0], {'values_land': 0})
+        self.calc.errors = calculator.ErrorCollector(maxerrors=3)
+        self.calc.calculaterecord((12, 'a', 0))
+        self.calc.calculaterecord((12, 'a', 0))
+        self.assertRaises(calculator.TooManyErrors,
+                          self.calc.calculaterecord, (12, 'a', 0))
+
+    def test_createoutputfunc_names(self):
+        # names that contain other names, and field references in strings
+        self.createfuncs(['len(!parcels.name!) + math.floor(1.5)',
+                          "'!parcels.name!' + !parcels.name!",
+                          'map(lambda x: x * 2, [!values.land!])'])
+        self.calc.compileoutput(INPUTNAMES)
+        self.assertEqual(self.calc.compileerrors.keys(), [])
+        self.assertEqual(self.calc.calculaterecord((12, 'abc', 5)),
+                         (4.0, '!parcels.name!abc', [10]))
+
+    @unittest.skipIf(calculator.numpy is None, 'numpy is not installed')
+    def test_calculatebatch_vectorized(self):
+        self.createfuncs(['!values.land! * 2 + !parcels.propid!',
+                          '!values.land! / 3',
+                          'propertyfrompropid(!parcels.propid!)',
+                          '!parcels.name! * 2'])
+        inputrows = [(i, 'n', i * 7 if i % 5 else None) for i in range(50)]
+        self.calc.compileoutput(INPUTNAMES)
+        expected = self.calc.calculatebatch(inputrows)
+        self.calc.compileoutput(INPUTNAMES, vectorize=True)
+        self.assertEqual(self.calc.vectorfields.keys(), [0, 1, 3])
+        self.assertEqual(self.calc.calculatebatch(inputrows), expected)
+        self.assertEqual(self.calc.calculatebatch([]), [])
+
+    def test_batchfunction(self):
+        calls = []
+
+        @calctools.batchfunction
+        def double(values):
+            calls.append(len(values))
+            return [value * 2 for value in values]
+        testlib = types.ModuleType('testlib')
+        testlib.double = double
+        self.calc.moremodules['testlib'] = testlib
+        self.createfuncs(['testlib.double(!values.land!) + 1',
+                          'testlib.double(testlib.double(!parcels.propid!))',
+                          'testlib.double(1) if !parcels.propid! else 0'])
+        self.calc.compileoutput(INPUTNAMES)
+        self.assertEqual(self.calc.calculatebatch([(1, 'a', 10),
+                                                   (2, 'b', None)]),
+                         [(21, 4, 2), (1, 8, 2)])
+        # one call per chunk, except in a branch that might not be evaluated
+        self.assertEqual(calls, [2, 2, 2, 1, 1])
+        self.assertEqual(self.calc.calculaterecord((3, 'c', 5)), (11, 12, 2))
+
+    def test_libraryreload(self):
+        libpath = os.path.join('fieldcalcs', 'testreloadlib.py')
+        try:
+            with open(libpath, 'w') as libfile:
+                libfile.write('def value():\n    return 1\n')
+            calc = calculator.Calculator()
+            # libraries are listed at start up, but imported when first used
+            self.assertTrue('testreloadlib' in calc.getcustomlibs())
+            self.assertFalse('testreloadlib' in calc.moremodules)
+            calc.createoutputfunc({'name': 'value',
+                                   'value': 'testreloadlib.value()'})
+            calc.compileoutput(INPUTNAMES)
+            self.assertEqual(calc.calculaterecord((1, 'a', 0)), (1,))
+            # an edited file is reloaded the next time the output is compiled
+            with open(libpath, 'w') as libfile:
+                libfile.write('def value():\n    return 22\n')
+            libtime = os.stat(libpath).st_mtime + 10
+            os.utime(libpath, (libtime, libtime))
+            calc.clear()
+            calc.createoutputfunc({'name': 'value',
+                                   'value': 'testreloadlib.value()'})
+            calc.compileoutput(INPUTNAMES)
+            self.assertEqual(calc.calculaterecord((1, 'a', 0)), (22,))
+        finally:
+            for filename in (libpath, libpath + 'c'):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+            sys.modules.pop('fieldcalcs.testreloadlib', None)
+
+    def test_memoize(self):
+        calls = []
+
+        @calctools.memoize(maxsize=2)
+        def scale(value, factor=1):
+            calls.append((value, factor))
+            return value * factor
+        calctools.resetcachestats()
+        self.assertEqual(scale(2), 2)
+        self.assertEqual(scale(2), 2)
+        self.assertEqual(scale(2, factor=3), 6)
+        self.assertEqual(scale(2, factor=3), 6)
+        # 2 is the least recently used, so it's dropped for 4
+        self.assertEqual(scale(4), 4)
+        self.assertEqual(scale(2), 2)
+        # unhashable arguments aren't cached
+        self.assertEqual(scale([1], factor=2), [1, 1])
+        self.assertEqual(calls, [(2, 1), (2, 3), (4, 1), (2, 1), ([1], 2)])
+        self.assertEqual(calctools.getcachestats(),
+                         [('testcalculator.scale', 2, 4, 2)])
+        self.assertEqual(self.calc.getcachereport(),
+                         'testcalculator.scale: 2 hits, 4 misses '
+                         '(33.3% hit rate), 2 results cached')
+        del calctools.MEMOIZEDFUNCS['testcalculator.scale']
+
+        # equal arguments of different types are cached separately
+        @calctools.memoize()
+        def describe(value, unit=''):
+            return repr(value) + repr(unit)
+        self.assertEqual([describe(1), describe(1.0), describe(True)],
+                         ["1''", "1.0''", "True''"])
+        self.assertEqual([describe(1, unit=1), describe(1, unit=True)],
+                         ['11', '1True'])
+        del calctools.MEMOIZEDFUNCS['testcalculator.describe']
+
+    def test_profiling(self):
+        self.calc.profiling = True
+        self.createfuncs(['propertyfrompropid(!parcels.propid!)',
+                          '!values.land! * 2'])
+        self.calc.compileoutput(INPUTNAMES)
+        self.calc.calculatebatch([(12, 'a', 100), (13, 'b', 200)])
+        profiler = self.calc.profiler
+        self.assertEqual([stats[0] for stats in profiler.fieldstats.values()],
+                         [2, 2])
+        self.assertEqual(profiler.funcstats['default.propertyfrompropid'][0],
+                         2)
+        self.assertTrue('default.propertyfrompropid' in profiler.getreport())
+
+    def test_lookup(self):
+        codetable = CodeTable([{'CODE': 'MN', 'NAME': 'Minnesota'},
+                               {'CODE': 'WI', 'NAME': 'Wisconsin'}])
+        lookups = lookuptables.LookupTables({'statecodes': codetable})
+        self.calc.lookuptables = lookups
+        self.createfuncs(["lookup('statecodes', 'code', 'name', "
+                          "!parcels.name!)",
+                          "lookup('statecodes', 'CODE', 'NAME', "
+                          "!parcels.name!, '?') + '!'",
+                          "lookup('statecodes', 'CODE', 'POP', 1)"])
+        self.calc.compileoutput(INPUTNAMES)
+        self.assertEqual(self.calc.compileerrors.keys(), ['field2'])
+        self.assertEqual(self.calc.calculaterecord((12, 'WI', 0))[:2],
+                         ('Wisconsin', 'Wisconsin!'))
+        self.assertEqual(self.calc.calculaterecord((12, 'XX', 0))[:2],
+                         (None, '?!'))
+        # both fields share one copy of the table
+        self.assertEqual(len(lookups.tables), 1)
+        lookups.clear()
+        self.assertEqual(lookups.tables, {})
+        # keys read as text are converted to the type of the key field
+        idtable = CodeTable([{'ID': '12', 'NAME': 'Minnesota'},
+                             {'ID': '007', 'NAME': 'Wisconsin'}],
+                            {'ID': 'INTEGER', 'NAME': 'TEXT'})
+        lookups = lookuptables.LookupTables({'stateids': idtable})
+        self.assertEqual(lookups.lookup('stateids', 'ID', 'NAME', 12),
+                         'Minnesota')
+        self.assertEqual(lookups.lookup('stateids', 'ID', 'NAME', 7),
+                         'Wisconsin')
+        self.assertEqual(lookups.lookup('stateids', 'ID', 'NAME', '12'),
+                         None)
+
+    def test_aggregator(self):
+        fieldnames = ['name', 'land', 'count']
+        groups = aggregator.Aggregator(fieldnames, ['name'],
+                                       {'land': 'sum', 'count': 'count'},
+                                       maxgroups=1)
+        for record in [('a', 1, None), ('b', 2, None), ('a', None, None),
+                       ('c', 4, None), ('a', 5, None)]:
+            groups.add(record)
+        # more groups than maxgroups, so they're combined from the spill files
+        self.assertEqual(sorted(groups.results()),
+                         [('a', 6, 3), ('b', 2, 1), ('c', 4, 1)])
+        self.calc.createoutputfunc({'name': 'name', 'value': '!parcels.name!'})
+        self.calc.createoutputfunc({'name': 'land', 'value': '!values.land!'})
+        self.calc.createoutputfunc({'name': 'count', 'value': '1'})
+        sqlblanks = joinmanager.JoinManager.getsqlblanks(
+            self.calc.inputblanks)
+        self.assertEqual(groups.getsqlquery('join', self.calc.outputbodies,
+                                            self.calc.inputblanks, sqlblanks),
+                         "SELECT parcels_name, SUM(values_land), COUNT(*) "
+                         "FROM (join) GROUP BY parcels_name")
+        # blanks that the join query doesn't fill in
+        self.assertEqual(groups.getsqlquery('join', self.calc.outputbodies,
+                                            self.calc.inputblanks, {}), None)
+        # text is summed like sqlite does, whichever one does the grouping
+        textvalues = ['12', ' 3', '1e2', '12abc', 'abc', '', None]
+        with sqlite3.connect(':memory:') as conn:
+            conn.execute('CREATE TABLE landvalues (name TEXT, land TEXT)')
+            conn.executemany('INSERT INTO landvalues VALUES (?, ?)',
+                             [(str(i), value) for i, value
+                              in enumerate(textvalues)] +
+                             [('all', value) for value in textvalues])
+            sqlresults = conn.execute(
+                'SELECT name, SUM(land) FROM landvalues GROUP BY name'
+            ).fetchall()
+        textgroups = aggregator.Aggregator(['name', 'land'], ['name'],
+                                           {'land': 'sum'})
+        for i, value in enumerate(textvalues):
+            textgroups.add((unicode(i), value))
+            textgroups.add((u'all', value))
+        results = sorted(textgroups.results())
+        self.assertEqual(results, sorted(sqlresults))
+        self.assertEqual([type(land) for _name, land in results],
+                         [type(land) for _name, land in sorted(sqlresults)])
+        # calculated fields can't be grouped by sqlite
+        self.calc.createoutputfunc({'name': 'land',
+                                    'value': '!values.land! * 2'})
+        self.assertEqual(groups.getsqlquery('join', self.calc.outputbodies,
+                                            self.calc.inputblanks, sqlblanks),
+                         None)
+
+    def test_sqlblanks(self):
+        self.calc.inputblanks['values_date'] = object()
+        self.calc.inputblanks['values_rate'] = float('nan')
+        sqlblanks = joinmanager.JoinManager.getsqlblanks(
+            self.calc.inputblanks)
+        self.assertEqual(sqlblanks, {'parcels_propid': '0',
+                                     'parcels_name': "''",
+                                     'values_land': '0'})
+        self.createfuncs(['!parcels.name! + "x"', '!values.land! + 1'])
+        self.calc.compileoutput(INPUTNAMES, sqlblanks=['values_land'])
+        # the query fills in values_land, the function fills in parcels_name
+        self.assertEqual(self.calc.calculaterecord((1, None, 5)), ('x', 6))
+        self.assertEqual(self.calc.calculaterecord((1, None, None))[0], 'x')
+        self.assertEqual(self.calc.calculaterecord((1, None, None))[1],
+                         '##ERROR##')
+        # blanks without a literal, like inf, are bound to the function
+        self.calc.clear()
+        self.calc.inputblanks['values_land'] = float('inf')
+        self.createfuncs(['!values.land!'])
+        self.calc.compileoutput(INPUTNAMES)
+        self.assertEqual(self.calc.compileerrors, {})
+        self.assertEqual(self.calc.calculaterecord((1, None, None)),
+                         (float('inf'),))
+
+    def test_optimizeexpressions(self):
+        context = {}
+        trees = [ast.parse(expr, mode='eval').body
+                 for expr in ['f(a) + 1', 'g(f(a)) + (f(b) if a else 0)',
+                              'a * (2 * 30)']]
+        trees = [exproptimizer.foldconstants(tree, context)
+                 for tree in trees]
+        assignments, trees = exproptimizer.hoistcommon(
+            trees, lambda node: node.func.id in ('f', 'g'))
+        # f(a) is repeated, f(b) is in a branch that might not be evaluated
+        self.assertEqual([ast.dump(node) for _name, node in assignments],
+                         [ast.dump(ast.parse('f(a)', mode='eval').body)])
+        self.assertEqual(ast.dump(trees[2].right), ast.dump(ast.Num(n=60)))
+        # calls that might have side effects are never shared, nor is
+        # anything that contains them
+        trees = [ast.parse(expr, mode='eval').body
+                 for expr in ['h(a) + 1', 'h(a) + 1', 'a[0] * 2', 'a[0]']]
+        assignments, trees = exproptimizer.hoistcommon(
+            trees, lambda node: node.func.id != 'h')
+        self.assertEqual([ast.dump(node) for _name, node in assignments],
+                         [ast.dump(ast.parse('a[0]', mode='eval').body)])
+        # the same in the calculator, where each field gets its own list
+        self.createfuncs(['list(!parcels.name!)',
+                          'list(!parcels.name!).pop()',
+                          'abs(!values.land!) + abs(!values.land!)'])
+        self.calc.compileoutput(INPUTNAMES)
+        self.assertEqual(self.calc.calculaterecord((1, 'ab', -2)),
+                         (['a', 'b'], 'b', 4))
+
+    def tearDown(self):
+        os.chdir(self.startdir)
+
+
+class CodeTable(object):
+    """A table that hasn't been converted to sqlite."""
+    def __init__(self, records, fieldtypes=None):
+        self.records = records
+        self.sqlname = None
+        self.fields = {}
+        for fieldname in records[0]:
+            attributes = {}
+            if fieldtypes is not None:
+                attributes['type'] = fieldtypes[fieldname]
+            self.fields[fieldname] = field.Field(fieldname, attributes)
+
+    def readrows(self):
+        for record in self.records:
+            yield tuple([record[fieldname] for fieldname in self.fields])
+
+if __name__ == '__main__':
+    unittest.main()
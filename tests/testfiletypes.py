@@ -0,0 +1,504 @@
+##
+#   Copyright 2013 Chad Spratt
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+##
+import unittest
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import zipfile
+from collections import OrderedDict
+PROGRAMDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, PROGRAMDIR)
+
+import field
+import outputmanager
+import table
+from filetypes import csvdata
+from filetypes import exceldata
+from filetypes import fixedwidthdata
+from filetypes import jsonldata
+from filetypes import sqlitedata
+from filetypes import xlsxreader
+# the bundled dbfpy needs its memo module, which some copies are missing
+try:
+    from filetypes import dbfdata
+except ImportError:
+    dbfdata = None
+
+ROWS = [(1, 'Alice'), (2, 'Bob, Jr.'), (3, '')]
+# enough records for csv.Sniffer to find the delimiter
+MOREROWS = [(i, 'Name %d' % i) for i in range(4, 40)]
+# the parts of an .xlsx file that XLSXReader reads
+XLSXPARTS = {
+    'xl/workbook.xml':
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/'
+    'main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/'
+    'relationships"><workbookPr date1904="1"/><sheets>'
+    '<sheet name="people" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels':
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+    'relationships"><Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+    'relationships/worksheet"/></Relationships>',
+    'xl/sharedStrings.xml':
+    '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<si><t>ID</t></si><si><t>NAME</t></si><si><t>WHEN</t></si>'
+    '<si><r><t>Al</t></r><r><t>ice</t></r></si></sst>',
+    'xl/worksheets/sheet1.xml':
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/'
+    'main"><dimension ref="A1:C4"/><sheetData>'
+    '<row r="1"><c r="A1" t="s"><v>0</v></c><c r="B1" t="s"><v>1</v></c>'
+    '<c r="C1" t="s"><v>2</v></c></row>'
+    '<row r="2"><c r="A2"><v>1</v></c><c r="B2" t="s"><v>3</v></c>'
+    '<c r="C2"><v>1</v></c></row>'
+    '<row r="4"><c r="A4"><v>3.5</v></c><c r="B4" t="inlineStr"><is><t>Bob'
+    '</t></is></c></row></sheetData></worksheet>'}
+
+
+class TestFileTypes(unittest.TestCase):
+    def setUp(self):
+        self.startdir = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+        self.fields = [field.Field('ID', {'type': 'INTEGER'}),
+                       field.Field('NAME', {'type': 'TEXT'})]
+
+    def test_csvrows(self):
+        filename = os.path.join(self.tempdir, 'people.csv')
+        outputfile = csvdata.CSVData(filename, mode='w')
+        outputfile.setfields(self.fields)
+        outputfile.addrows(MOREROWS)
+        outputfile.addrows(ROWS[:2])
+        outputfile.addrecord({'ID': 3})
+        outputfile.close()
+        inputfile = csvdata.CSVData(filename)
+        # csv values are read back as strings
+        self.assertEqual(list(inputfile.readrows())[-3:],
+                         [('1', 'Alice'), ('2', 'Bob, Jr.'), ('3', '')])
+        self.assertEqual(list(inputfile)[-2],
+                         {'ID': '2', 'NAME': 'Bob, Jr.'})
+
+    def test_repeatedfieldnames(self):
+        os.chdir(self.tempdir)
+        filename = os.path.join(self.tempdir, 'people.csv')
+        with open(filename, 'wb') as csvfile:
+            csvfile.write('ID,NAME,ID\r\n')
+            for i, name in MOREROWS:
+                csvfile.write('%d,%s,%d\r\n' % (i, name, i * 10))
+            csvfile.write('1,Bob\r\n')
+        inputfile = csvdata.CSVData(filename)
+        inputfile.initfields()
+        # one field, with the value of the last column, like csv.DictReader
+        self.assertEqual(inputfile.fields.keys(), ['ID', 'NAME'])
+        expectedrows = [(str(i * 10), name) for i, name in MOREROWS]
+        self.assertEqual(list(inputfile.readrows()),
+                         expectedrows + [(None, 'Bob')])
+        for _progress in inputfile.convertdata('people'):
+            pass
+        with sqlite3.connect('temp.db') as conn:
+            self.assertEqual(conn.execute('SELECT * FROM table_people')
+                             .fetchall(),
+                             [(int(i), name) for i, name in expectedrows] +
+                             [(None, 'Bob')])
+        filename = os.path.join(self.tempdir, 'people.xlsx')
+        with zipfile.ZipFile(filename, 'w') as xlsxfile:
+            for partname in XLSXPARTS:
+                xlsxfile.writestr(partname, XLSXPARTS[partname].replace(
+                    '<t>WHEN</t>', '<t>ID</t>'))
+        inputfile = exceldata.ExcelData(filename, 'people',
+                                        fieldtypes=['Numeric', 'Text',
+                                                    'Numeric'])
+        self.assertEqual(list(inputfile.readrows()),
+                         [(1.0, 'Alice'), ('', ''), ('', 'Bob')])
+        self.assertEqual(list(inputfile)[0], {'ID': 1.0, 'NAME': 'Alice'})
+        inputfile.close()
+
+    def test_csvflush(self):
+        filename = os.path.join(self.tempdir, 'people.csv')
+        flushinterval = csvdata.FLUSHINTERVAL
+        try:
+            csvdata.FLUSHINTERVAL = 3600
+            outputfile = csvdata.CSVData(filename, mode='w')
+            outputfile.setfields(self.fields)
+            outputfile.addrows(MOREROWS)
+            # the rows are still in the buffer
+            self.assertEqual(os.path.getsize(filename), 0)
+            self.assertTrue(outputfile.getsize() > 0)
+            # once the interval has passed, the next batch is flushed
+            csvdata.FLUSHINTERVAL = 0
+            outputfile.addrows(ROWS)
+            self.assertEqual(os.path.getsize(filename), outputfile.getsize())
+            # single rows don't flush
+            outputfile.addrow(ROWS[0])
+            self.assertTrue(os.path.getsize(filename) <
+                            outputfile.getsize())
+            outputfile.close()
+        finally:
+            csvdata.FLUSHINTERVAL = flushinterval
+        inputfile = csvdata.CSVData(filename)
+        self.assertEqual(len(list(inputfile.readrows())),
+                         len(MOREROWS) + len(ROWS) + 1)
+
+    def test_compressedcsvrows(self):
+        # .xz is only tested where lzma is available
+        for compression in sorted(csvdata.COMPRESSORS):
+            filename = os.path.join(self.tempdir, 'people.csv' + compression)
+            self.assertTrue(csvdata.CSVData.supportsextension(
+                'csv' + compression))
+            outputfile = csvdata.CSVData(filename, mode='w')
+            outputfile.setfields(self.fields)
+            outputfile.addrows(MOREROWS)
+            outputfile.close()
+            with open(filename, 'rb') as rawfile:
+                self.assertFalse(rawfile.read().startswith('ID,NAME'))
+            outputfile = csvdata.CSVData(filename, mode='w')
+            if compression == '.bz2':
+                # the python 2 bz2 library can't append
+                self.assertRaises(NotImplementedError, outputfile.reopen,
+                                  self.fields)
+                expectedrows = MOREROWS
+            else:
+                outputfile.reopen(self.fields)
+                outputfile.addrows(ROWS[:2])
+                outputfile.close()
+                expectedrows = MOREROWS + ROWS[:2]
+            inputfile = csvdata.CSVData(filename)
+            self.assertEqual([newfield.name
+                              for newfield in inputfile.getfields()],
+                             ['ID', 'NAME'])
+            self.assertEqual(list(inputfile.readrows()),
+                             [(str(i), name) for i, name in expectedrows])
+
+    def test_sqliterows(self):
+        filename = os.path.join(self.tempdir, 'people.db')
+        outputfile = sqlitedata.SQLiteData(filename, 'people', mode='w')
+        outputfile.setfields(self.fields)
+        outputfile.addindex('NAME')
+        outputfile.addrows(ROWS[:2])
+        outputfile.addrow(ROWS[2])
+        outputfile.close()
+        inputfile = sqlitedata.SQLiteData(filename, 'people')
+        inputfile.initfields()
+        self.assertEqual(list(inputfile.readrows()), ROWS)
+        with sqlite3.connect(filename) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT name FROM sqlite_master WHERE type='index'")
+            self.assertEqual(cur.fetchall(), [('people_NAME_index',)])
+        self.assertEqual([len(batch) for batch in inputfile.readbatches(2)],
+                         [2, 1])
+        # writing to an existing database keeps its safe settings
+        self.assertTrue(outputfile.newfile)
+        outputfile = sqlitedata.SQLiteData(filename, 'others', mode='w')
+        outputfile.setfields(self.fields)
+        self.assertFalse(outputfile.newfile)
+        outputfile.cur.execute('PRAGMA synchronous')
+        self.assertNotEqual(outputfile.cur.fetchone()[0], 0)
+        outputfile.close()
+        # column names that are keywords
+        with sqlite3.connect(filename) as conn:
+            conn.execute('CREATE TABLE roles (CAST TEXT, ID INTEGER)')
+            conn.execute("INSERT INTO roles VALUES ('lead', 1)")
+        inputfile = sqlitedata.SQLiteData(filename, 'roles')
+        inputfile.initfields()
+        self.assertEqual(list(inputfile.readrows()), [(u'lead', 1)])
+
+    @unittest.skipIf(dbfdata is None, 'dbfpy is not available')
+    def test_dbfrows(self):
+        dbffields = [field.Field('ID', OrderedDict([('type', 'NUMERIC'),
+                                                    ('length', 10),
+                                                    ('decimals', 0)]),
+                                 dataformat='dbf'),
+                     field.Field('NAME', OrderedDict([('type', 'TEXT'),
+                                                      ('length', 20),
+                                                      ('decimals', 0)]),
+                                 dataformat='dbf')]
+        rowsname = os.path.join(self.tempdir, 'rows.dbf')
+        outputfile = dbfdata.DBFData(rowsname, mode='w')
+        outputfile.setfields(dbffields)
+        outputfile.addrows(MOREROWS)
+        outputfile.addrows(ROWS[:2])
+        outputfile.addrow(ROWS[2])
+        outputfile.close()
+        # the batches are written the same as one record at a time
+        singlename = os.path.join(self.tempdir, 'single.dbf')
+        outputfile = dbfdata.DBFData(singlename, mode='w')
+        outputfile.setfields(dbffields)
+        for row in MOREROWS + ROWS:
+            outputfile.addrow(row)
+        outputfile.close()
+        with open(rowsname, 'rb') as rowsfile:
+            with open(singlename, 'rb') as singlefile:
+                self.assertEqual(rowsfile.read(), singlefile.read())
+        inputfile = dbfdata.DBFData(rowsname)
+        self.assertEqual(inputfile.getrecordcount(),
+                         len(MOREROWS) + len(ROWS))
+        inputfile.close()
+
+    def test_xlsxrows(self):
+        filename = os.path.join(self.tempdir, 'people.xlsx')
+        with zipfile.ZipFile(filename, 'w') as xlsxfile:
+            for partname in XLSXPARTS:
+                xlsxfile.writestr(partname, XLSXPARTS[partname])
+        with xlsxreader.XLSXReader(filename) as book:
+            self.assertEqual(book.sheet_names(), ['people'])
+            # there's no styles.xml, so no cell is a date
+            self.assertEqual(list(book.iterrowtypes('people'))[1:],
+                             [[2, 1, 2], [], [2, 1]])
+            self.assertEqual(book.datemode, 1)
+            self.assertEqual(book.getrowcount('people'), 4)
+            # the missing row is kept, cells after the last one aren't
+            self.assertEqual(list(book.iterrows('people')),
+                             [['ID', 'NAME', 'WHEN'], [1.0, 'Alice', 1.0],
+                              [], [3.5, 'Bob']])
+        inputfile = exceldata.ExcelData(filename, 'people',
+                                        fieldtypes=['Numeric', 'Text',
+                                                    'Date'])
+        self.assertEqual(inputfile.getfields()[1].name, 'NAME')
+        rows = list(inputfile.readrows())
+        # 1904 date mode
+        self.assertEqual(rows[0], (1.0, 'Alice', '1904-01-02 00:00:00'))
+        self.assertEqual(rows[2][:2], (3.5, 'Bob'))
+        # the workbook is parsed once for all the uses of the file
+        book = exceldata.openbook(filename)
+        self.assertTrue(inputfile.inputbook is book)
+        otherfile = exceldata.ExcelData(filename, 'people',
+                                        fieldtypes=['Numeric', 'Text',
+                                                    'Date'])
+        self.assertEqual(otherfile.getrecordcount(), 4)
+        self.assertTrue(otherfile.inputbook is book)
+        # held books aren't evicted for other files
+        copyname = os.path.join(self.tempdir, 'copy.xlsx')
+        shutil.copy(filename, copyname)
+        maxopenbooks = exceldata.MAXOPENBOOKS
+        exceldata.MAXOPENBOOKS = 1
+        try:
+            exceldata.openbook(copyname)
+            self.assertTrue(exceldata.openbook(filename) is book)
+        finally:
+            exceldata.MAXOPENBOOKS = maxopenbooks
+        # or closed until every file using them is closed
+        inputfile.close()
+        self.assertTrue(exceldata.openbook(filename) is book)
+        otherfile.close()
+        self.assertFalse(exceldata.openbook(filename) is book)
+        for bookkey in exceldata.OPENBOOKS.keys():
+            exceldata.releasebook(exceldata.OPENBOOKS[bookkey][0])
+        self.assertEqual(len(exceldata.OPENBOOKS), 0)
+
+    def test_xlsxoutput(self):
+        filename = os.path.join(self.tempdir, 'output.xlsx')
+        outputfile = exceldata.ExcelData(filename, 'people', mode='w')
+        outputfile.setfields(self.fields)
+        # start another sheet after 3 rows, counting the field names
+        outputfile.writer.maxrows = 3
+        outputfile.addrows(ROWS[:2])
+        outputfile.addrow((3, u'<\xe9>'))
+        outputfile.close()
+        with xlsxreader.XLSXReader(filename) as book:
+            self.assertEqual(book.sheet_names(), ['people', 'people_2'])
+            self.assertEqual(list(book.iterrows('people_2')),
+                             [['ID', 'NAME'], [3.0, u'<\xe9>']])
+            self.assertEqual(list(book.iterrows('people'))[2],
+                             [2.0, 'Bob, Jr.'])
+
+    def test_xlsrows(self):
+        filename = os.path.join(self.tempdir, 'dates.xls')
+        outputfile = exceldata.ExcelData(filename, 'dates', mode='w')
+        outputfile.setfields([field.Field('WHEN'), field.Field('OK')])
+        outputfile.addrows([(41275.5, 1), ('', 0), ('someday', 1),
+                            (41275.5, 0)])
+        outputfile.close()
+        # the date cells were written as numbers, the rest is mixed
+        self.assertEqual(exceldata.ExcelData.detectfieldtypes(filename,
+                                                              'dates'),
+                         ['Text', 'Numeric'])
+        self.assertEqual(exceldata.ExcelData.detectfieldtypes(filename,
+                                                              'dates', 1),
+                         ['Numeric', 'Numeric'])
+        inputfile = exceldata.ExcelData(filename, 'dates',
+                                        fieldtypes=['Date', 'Logical'])
+        self.assertEqual(list(inputfile.readrows()),
+                         [('2013-01-01 12:00:00', True), ('', False),
+                          ('someday', True), ('2013-01-01 12:00:00', False)])
+        inputfile.close()
+
+    def test_fixedwidthrows(self):
+        filename = os.path.join(self.tempdir, 'people.txt')
+        with open(os.path.join(self.tempdir, 'people.layout'), 'w') as layout:
+            # fields out of order, with a gap and a detected type
+            layout.write('name,start,length,type\nNAME,6,8,TEXT\nID,1,3,\n')
+        with open(filename, 'w') as datafile:
+            datafile.write('001  Alice   \r\n002  Bob, Jr.\r\n'
+                           '003         x\r\n004          ')
+        inputfile = fixedwidthdata.FixedWidthData(filename)
+        self.assertEqual(inputfile.getrecordcount(), 4)
+        inputfields = inputfile.getfields()
+        self.assertEqual([(inputfield.name, inputfield['type'])
+                          for inputfield in inputfields],
+                         [('NAME', 'TEXT'), ('ID', 'INTEGER')])
+        self.assertEqual(list(inputfile.readrows()),
+                         [('Alice', '001'), ('Bob, Jr.', '002'),
+                          ('x', '003'), ('', '004')])
+        self.assertEqual(inputfile.getrow(1), ('Bob, Jr.', '002'))
+        inputfile.close()
+        # written with the lengths of the fields, and a layout file
+        outputname = os.path.join(self.tempdir, 'output.txt')
+        outputfile = fixedwidthdata.FixedWidthData(outputname, mode='w')
+        outputfile.setfields([
+            fixedwidthdata.FixedWidthData.convertfield(outputfield)
+            for outputfield in inputfields])
+        # text is cut at a whole character, numbers can't be cut
+        outputfile.addrows([('Alexandria', 5), (None, 6),
+                            (u'a\xe9\xe9\xe9\xe9', -7)])
+        self.assertRaises(fixedwidthdata.ValueTooLongError,
+                          outputfile.addrow, ('Bob', 1234))
+        outputfile.close()
+        with open(outputname) as datafile:
+            self.assertEqual(datafile.read(),
+                             'Alexandr5  \n        6  \n'
+                             'a\xc3\xa9\xc3\xa9\xc3\xa9 -7 \n')
+        inputfile = fixedwidthdata.FixedWidthData(outputname)
+        self.assertEqual(list(inputfile.readrows())[:2],
+                         [('Alexandr', '5'), ('', '6')])
+        inputfile.close()
+        # numbers have to parse as numbers
+        detecttype = fixedwidthdata.FixedWidthData._detecttype
+        self.assertEqual(detecttype(0, [('-5',), ('1e3',), ('',)]), 'REAL')
+        for value in ('.', '1.2.3', '01.02.2013', 'nan'):
+            self.assertEqual(detecttype(0, [('1',), (value,)]), 'TEXT')
+
+    def test_jsonlrows(self):
+        filename = os.path.join(self.tempdir, 'people.jsonl')
+        outputfile = jsonldata.JSONLData(filename, mode='w')
+        outputfile.setfields(self.fields + [field.Field('100%')])
+        outputfile.addrows([(1, 'Alice', True), (2, u'Bob \u2603', None)])
+        outputfile.addrecord({'ID': 3.5, 'NAME': [1, {'a': 'b'}]})
+        # not utf-8, and not valid JSON numbers
+        outputfile.addrow(('caf\xe9', float('nan'), float('-inf')))
+        outputfile.close()
+        with open(filename) as jsonlfile:
+            lines = jsonlfile.read().splitlines()
+        self.assertEqual(lines[0], '{"ID":1,"NAME":"Alice","100%":true}')
+        self.assertEqual(lines[3],
+                         '{"ID":"caf\\u00e9","NAME":null,"100%":null}')
+        inputfile = jsonldata.JSONLData(filename)
+        inputfile.samplerows = 3
+        self.assertEqual([(inputfield.name, inputfield['type'])
+                          for inputfield in inputfile.getfields()],
+                         [('ID', 'REAL'), ('NAME', 'TEXT'),
+                          ('100%', 'INTEGER')])
+        self.assertEqual(list(inputfile.readrows())[:3],
+                         [(1, 'Alice', True), (2, u'Bob \u2603', None),
+                          (3.5, '[1,{"a":"b"}]', None)])
+        # only the sampled records decide the types
+        inputfile = jsonldata.JSONLData(filename)
+        inputfile.samplerows = 2
+        self.assertEqual(inputfile.getfields()[0]['type'], 'INTEGER')
+
+    def openshard(self, extension):
+        """Get a function that opens shards in the temporary directory."""
+        def openshard(shardname):
+            filename = os.path.join(self.tempdir, 'out_' + shardname)
+            if extension == '.db':
+                return sqlitedata.SQLiteData(filename + extension, 'people',
+                                             mode='w')
+            return csvdata.CSVData(filename + extension, mode='w')
+        return openshard
+
+    def readshard(self, shardname):
+        """Get the rows of a csv shard, without the header."""
+        with open(os.path.join(self.tempdir, 'out_' + shardname + '.csv')) \
+                as shardfile:
+            return shardfile.read().splitlines()[1:]
+
+    def test_shardedoutput(self):
+        # split by NAME, 2 records per file, only one file open at a time
+        outputfile = outputmanager.ShardedOutput(self.openshard('.csv'),
+                                                 maxrecords=2,
+                                                 keyfield='NAME', maxopen=1)
+        outputfile.setfields(self.fields)
+        # each batch is written a shard at a time
+        outputfile.addrows([(1, 'a'), (2, 'b'), (3, 'a'), (4, 'a')])
+        outputfile.addrow((5, 'a'))
+        outputfile.addrecord({'ID': 6, 'NAME': 'a b'})
+        outputfile.close()
+        self.assertEqual(outputfile.shardnames, ['a', 'a_1', 'b', 'a_b'])
+        self.assertEqual(self.readshard('a'), ['1,a', '3,a'])
+        # a_1 was closed to open b, and continued afterwards
+        self.assertEqual(self.readshard('a_1'), ['4,a', '5,a'])
+        self.assertEqual(self.readshard('b'), ['2,b'])
+        self.assertEqual(self.readshard('a_b'), ['6,a b'])
+
+    def test_shardedoutputkeys(self):
+        outputfile = outputmanager.ShardedOutput(self.openshard('.db'),
+                                                 maxrecords=2,
+                                                 keyfield='NAME')
+        outputfile.setfields(self.fields)
+        outputfile.addrows([(1, 'a'), (2, 'a'), (3, 'a'), (4, 'a_1'),
+                            (5, 'A'), (6, 'a b'), (7, 'a_b'),
+                            (8, u'caf\xe9')])
+        outputfile.addrow((9, 'a'))
+        outputfile.close()
+        # keys that clean to the same name, ignoring case, get a number, and
+        # the parts of different keys never share a name
+        self.assertEqual(outputfile.shardnames,
+                         ['a', 'a_1', 'a_1_1', 'A-2', 'a_b', 'a_b-2',
+                          'caf_'])
+        shardids = []
+        for shardname in outputfile.shardnames:
+            filename = os.path.join(self.tempdir, 'out_' + shardname + '.db')
+            with sqlite3.connect(filename) as conn:
+                shardids.append([row[0] for row in conn.execute(
+                    'SELECT ID FROM people ORDER BY ID')])
+        self.assertEqual(shardids, [[1, 2], [3, 9], [4], [5], [6], [7], [8]])
+
+    def test_shardedoutputsize(self):
+        outputfile = outputmanager.ShardedOutput(self.openshard('.csv'),
+                                                 maxbytes=10)
+        outputfile.setfields(self.fields)
+        # the size includes what's still in the output buffer
+        outputfile.addrows(ROWS[:2])
+        outputfile.addrows(ROWS[2:])
+        outputfile.close()
+        self.assertEqual(outputfile.shardnames, ['0', '1'])
+        self.assertEqual(self.readshard('1'), ['3,'])
+
+    def test_shardedoutputexists(self):
+        findshards = lambda: ['0']
+        outputfile = outputmanager.ShardedOutput(self.openshard('.db'),
+                                                 maxrecords=2,
+                                                 findshards=findshards)
+        outputfile.setfields(self.fields)
+        outputfile.addrows(ROWS)
+        outputfile.close()
+        # running it again asks before replacing the table
+        outputfile = outputmanager.ShardedOutput(self.openshard('.db'),
+                                                 maxrecords=2,
+                                                 findshards=findshards)
+        self.assertRaises(table.TableExistsError, outputfile.setfields,
+                          self.fields)
+        outputfile.setfields(self.fields, overwrite=True)
+        outputfile.addrows(ROWS[:1])
+        outputfile.close()
+        inputfile = sqlitedata.SQLiteData(
+            os.path.join(self.tempdir, 'out_0.db'), 'people')
+        self.assertEqual(list(inputfile.readrows()), ROWS[:1])
+
+    def tearDown(self):
+        os.chdir(self.startdir)
+        shutil.rmtree(self.tempdir)
+
+if __name__ == '__main__':
+    unittest.main()